@@ -0,0 +1,218 @@
+"""
+Index of the picture and table files under DATA_PATH, shared by the stages.
+
+The picture stages and the CSV/Directus stages used to walk their input tree
+with os.walk each time, re-deriving project and layer from the path and
+stat-ing every file. On network-backed storage with thousands of pictures
+those walks are measurable. Here a tree (or one project of it) is read with
+os.scandir once per run into DATA_PATH/catalog.sqlite, and later queries in
+the same run are answered from the index:
+
+- files(root, project) lists a tree, scanning it first if this run has not;
+- record(path), forget(path) and moved(src, dst) keep it up to date as the
+  stages write, move and remove files.
+
+The run is RUN_ID (set by launcher.sh and pipeline.py), or the process when it
+is unset, so a stage run on its own sees exactly what os.walk would. Paths
+outside the indexed trees, or without DATA_PATH, are walked directly.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+# Indexed trees, relative to DATA_PATH: number of folder levels above the files
+TREES = {
+    "in/pictures": 2,  # <project>/<layer>/<picture>
+    "renamed_pictures": 2,
+    "renamed_compressed_pictures": 2,
+    "raw_csv": 1,  # <project>/<table>
+    "formatted_csv": 1,
+}
+CATALOG_FILE = "catalog.sqlite"
+# Stands for the process in the scan marks when RUN_ID is unset
+_PROCESS_STARTED = time.time()
+
+_local = threading.local()
+
+
+class Entry(typing.NamedTuple):
+    project: str
+    layer: str  # "" in the table trees
+    name: str
+    path: str
+    size: int
+    mtime: float
+
+
+def current_run() -> str:
+    return os.getenv("RUN_ID") or f"process-{os.getpid()}-{_PROCESS_STARTED}"
+
+
+def _locate(path: str) -> tuple[str, str, list[str]] | None:
+    """(DATA_PATH, tree, path components below the tree), or None when the path is not indexed."""
+    data_path = os.getenv("DATA_PATH")
+    if not data_path:
+        return None
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(data_path))
+    parts = [] if rel == "." else rel.split(os.sep)
+    for tree, depth in TREES.items():
+        tree_parts = tree.split("/")
+        if parts[: len(tree_parts)] == tree_parts and len(parts) - len(tree_parts) <= depth + 1:
+            return data_path, tree, parts[len(tree_parts) :]
+    return None
+
+
+def _connection(data_path: str) -> sqlite3.Connection:
+    # One connection per thread and per process (never shared across a fork)
+    key = (os.getpid(), os.path.abspath(data_path))
+    connections: dict[tuple[int, str], sqlite3.Connection] = _local.__dict__.setdefault("connections", {})
+    conn = connections.get(key)
+    if conn is None:
+        os.makedirs(data_path, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(data_path, CATALOG_FILE), timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                tree TEXT, project TEXT, layer TEXT, name TEXT, size INTEGER, mtime REAL,
+                PRIMARY KEY (tree, project, layer, name)
+            );
+            CREATE TABLE IF NOT EXISTS scans (tree TEXT, project TEXT, run_id TEXT, PRIMARY KEY (tree, project));
+            """
+        )
+        connections[key] = conn
+    return conn
+
+
+def indexed(path: str) -> bool:
+    return _locate(path) is not None
+
+
+def _scandir_files(path: str) -> list[os.DirEntry]:
+    try:
+        with os.scandir(path) as entries:
+            return [entry for entry in entries if entry.is_file()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _scandir_dirs(path: str) -> list[str]:
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _scan(data_path: str, tree: str, project: str | None) -> list[tuple[str, str, str, str, int, float]]:
+    """Rows of a tree (or of one of its projects), read from disk."""
+    root = os.path.join(data_path, tree)
+    rows = []
+    for project_name in [project] if project else _scandir_dirs(root):
+        project_dir = os.path.join(root, project_name)
+        layers = _scandir_dirs(project_dir) if TREES[tree] == 2 else [""]
+        for layer in layers:
+            for entry in _scandir_files(os.path.join(project_dir, layer)):
+                st = entry.stat()
+                rows.append((tree, project_name, layer, entry.name, st.st_size, st.st_mtime))
+    return rows
+
+
+def _ensure_scanned(conn: sqlite3.Connection, data_path: str, tree: str, project: str | None) -> None:
+    run_id = current_run()
+    scanned = conn.execute(
+        "SELECT 1 FROM scans WHERE tree = ? AND project IN ('', ?) AND run_id = ?", (tree, project or "", run_id)
+    ).fetchone()
+    if scanned:
+        return
+    rows = _scan(data_path, tree, project)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if project:
+            conn.execute("DELETE FROM files WHERE tree = ? AND project = ?", (tree, project))
+        else:
+            conn.execute("DELETE FROM files WHERE tree = ?", (tree,))
+        conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?)", (tree, project or "", run_id))
+
+
+def _walk(root: str, project: str | None) -> list[Entry]:
+    # Not indexed: what the stages derived from os.walk (project and layer are the last two folders)
+    entries = []
+    for dirpath, _dirs, files in os.walk(root):
+        layer = os.path.basename(dirpath)
+        project_name = os.path.basename(os.path.dirname(dirpath))
+        if project and project_name != project:
+            continue
+        for name in sorted(files):
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            entries.append(Entry(project_name, layer, name, path, st.st_size, st.st_mtime))
+    return entries
+
+
+def files(root: str, project: str | None = None) -> list[Entry]:
+    """Files of a tree (or of root = <tree>/<project>), sorted by project, layer and name."""
+    located = _locate(root)
+    if located is None:
+        return _walk(root, project)
+    data_path, tree, parts = located
+    if parts:
+        if len(parts) > 1 or (project and project != parts[0]):
+            raise ValueError(f"{root} is not a tree or a project folder of the catalog")
+        project = parts[0]
+    conn = _connection(data_path)
+    _ensure_scanned(conn, data_path, tree, project)
+    query = "SELECT project, layer, name, size, mtime FROM files WHERE tree = ?"
+    params: list[str] = [tree]
+    if project:
+        query += " AND project = ?"
+        params.append(project)
+    rows = conn.execute(query + " ORDER BY project, layer, name", params).fetchall()
+    tree_root = os.path.join(data_path, tree)
+    return [
+        Entry(project_name, layer, name, os.path.join(tree_root, project_name, layer, name), size, mtime)
+        for project_name, layer, name, size, mtime in rows
+    ]
+
+
+def _key(located: tuple[str, str, list[str]]) -> tuple[str, str, str, str] | None:
+    _data_path, tree, parts = located
+    if len(parts) != TREES[tree] + 1:
+        return None
+    return (tree, parts[0], parts[1] if TREES[tree] == 2 else "", parts[-1])
+
+
+def record(path: str) -> None:
+    """A file was written (or replaced) at path."""
+    located = _locate(path)
+    key = _key(located) if located else None
+    if located is None or key is None:
+        return
+    st = os.stat(path)
+    _connection(located[0]).execute(
+        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", (*key, st.st_size, st.st_mtime)
+    )
+
+
+def forget(path: str) -> None:
+    """The file, or the project/layer folder, at path was removed."""
+    located = _locate(path)
+    if located is None:
+        return
+    _data_path, tree, parts = located
+    columns = ("project", "layer", "name") if TREES[tree] == 2 else ("project", "name")
+    if not parts or len(parts) > len(columns):
+        return
+    # The column names are constants, the values are bound
+    where = " AND ".join(f"{column} = ?" for column in columns[: len(parts)])
+    _connection(located[0]).execute(f"DELETE FROM files WHERE tree = ? AND {where}", (tree, *parts))  # noqa: S608
+
+
+def moved(src: str, dst: str) -> None:
+    forget(src)
+    record(dst)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Row-level change sets between two fetches of a project's GPKGs.
+
+Every row of every data layer is keyed by its sample_id (or by its feature id
+when it has none) and hashed over its stored values, geometry blob included.
+Diffing those hashes against the snapshot of the last completed run gives the
+inserted, updated and deleted rows of each table, written to
+DATA_PATH/changes/<project>/changes.json. Table names are the raw table stems
+csv_generator writes (see gpkg_reader.output_stem).
+
+The new snapshot is only staged next to it (snapshot.pending.json). The launcher
+runs `change_capture.py --commit` once the whole pipeline succeeded, so a failed
+run hands the same changes to the next one instead of losing them.
+
+csv_formatter, db_updater and pictures_metadata_editor take --changes-only to
+work from these change sets. A project without a change set, or whose first
+snapshot is being taken ("full": true), is processed in full.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from qfieldcloud_fetcher import gpkg_reader, metrics
+
+# Loads environment variables
+load_dotenv()
+
+# Access the environment variables
+data_path = os.getenv("DATA_PATH")
+
+# Construct folders paths
+in_gpkg_path = f"{data_path}/in/gpkg"
+changes_path = f"{data_path}/changes"
+
+CHANGE_KINDS = ("inserted", "updated", "deleted")
+
+
+@dataclass
+class ChangeSet:
+    project: str
+    full: bool = False
+    # table stem -> {"inserted": [...], "updated": [...], "deleted": [...]} (row keys)
+    tables: dict[str, dict[str, list[str]]] = field(default_factory=dict)
+    inserted: set[str] = field(default_factory=set)
+    updated: set[str] = field(default_factory=set)
+    deleted: set[str] = field(default_factory=set)
+    # Tables with changed rows that have no sample_id (their ids are generated downstream)
+    unkeyed_tables: set[str] = field(default_factory=set)
+
+    @property
+    def changed_ids(self) -> set[str]:
+        """sample_ids whose rows were inserted or updated."""
+        return self.inserted | self.updated
+
+    def table_changed(self, stem: str) -> bool:
+        return self.full or stem in self.tables
+
+    def includes(self, sample_id: str, table: str | None = None) -> bool:
+        """
+        Whether a row (or a picture) with this sample_id was inserted or updated. Rows without
+        a GPKG sample_id get an obs_ id downstream, so those are matched by table instead.
+        """
+        if self.full or sample_id in self.changed_ids:
+            return True
+        if not sample_id.startswith("obs_"):
+            return False
+        return table in self.unkeyed_tables if table is not None else bool(self.unkeyed_tables)
+
+    def to_json(self) -> dict:
+        return {
+            "project": self.project,
+            "full": self.full,
+            "tables": self.tables,
+            "sample_ids": {kind: sorted(getattr(self, kind)) for kind in CHANGE_KINDS},
+            "unkeyed_tables": sorted(self.unkeyed_tables),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "ChangeSet":
+        sample_ids = data.get("sample_ids") or {}
+        return cls(
+            project=data["project"],
+            full=bool(data.get("full")),
+            tables=data.get("tables") or {},
+            inserted=set(sample_ids.get("inserted", [])),
+            updated=set(sample_ids.get("updated", [])),
+            deleted=set(sample_ids.get("deleted", [])),
+            unkeyed_tables=set(data.get("unkeyed_tables", [])),
+        )
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Diff the fetched GPKGs against the last snapshot, row by row.")
+    parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
+    parser.add_argument(
+        "--commit",
+        action="store_true",
+        help="Promote the pending snapshots to the baseline of the next run (after a successful pipeline).",
+    )
+    return parser.parse_args(argv)
+
+
+def load_json(path: str) -> dict | None:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data: dict = json.load(f)
+    except FileNotFoundError:
+        return None
+    return data
+
+
+def save_json_atomic(obj: dict, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def row_hash(values: tuple) -> str:
+    return hashlib.blake2b(repr(values).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def sample_id_of(row_key: str) -> str | None:
+    return row_key[len("sample_id:") :] if row_key.startswith("sample_id:") else None
+
+
+def table_snapshot(conn: sqlite3.Connection, layer: gpkg_reader.GpkgLayer) -> dict[str, str]:
+    """row key -> hash of the row. The key is sample_id:<id>, or fid:<fid> for rows without one."""
+    names, pk, cursor = gpkg_reader.iter_raw_rows(conn, layer)
+    pk_index = names.index(pk) if pk else None
+    sample_index = names.index("sample_id") if "sample_id" in names else None
+    rows: dict[str, str] = {}
+    for position, row in enumerate(cursor):
+        fid = row[pk_index] if pk_index is not None else position
+        sample_id = row[sample_index] if sample_index is not None else None
+        sample_id = str(sample_id).strip() if sample_id is not None else ""
+        key = f"sample_id:{sample_id}" if sample_id else f"fid:{fid}"
+        if key in rows:
+            key = f"{key}#fid:{fid}"
+        # The feature id is left out: a row re-created with the same content is unchanged
+        values = tuple(value for i, value in enumerate(row) if i != pk_index)
+        rows[key] = row_hash(values)
+    return rows
+
+
+def project_snapshot(project_gpkg_dir: str) -> dict[str, dict[str, str]]:
+    """table stem -> row hashes, for every data layer of every GPKG of a project."""
+    snapshot: dict[str, dict[str, str]] = {}
+    for gpkg_name in sorted(os.listdir(project_gpkg_dir)):
+        gpkg_path = os.path.join(project_gpkg_dir, gpkg_name)
+        if not gpkg_name.endswith(".gpkg") or not os.path.isfile(gpkg_path):
+            continue
+        conn = gpkg_reader.connect(gpkg_path)
+        try:
+            for index, layer in enumerate(gpkg_reader.list_layers(conn)):
+                snapshot[gpkg_reader.output_stem(gpkg_name, layer.table_name, index)] = table_snapshot(conn, layer)
+        finally:
+            conn.close()
+    return snapshot
+
+
+def diff_snapshots(
+    project: str, previous: dict[str, dict[str, str]] | None, current: dict[str, dict[str, str]]
+) -> ChangeSet:
+    """Change set turning `previous` into `current`; no previous snapshot means a full run."""
+    changes = ChangeSet(project=project, full=previous is None)
+    previous = previous or {}
+    for stem in sorted(set(previous) | set(current)):
+        before, after = previous.get(stem, {}), current.get(stem, {})
+        table = {
+            "inserted": sorted(key for key in after if key not in before),
+            "updated": sorted(key for key in after if key in before and before[key] != after[key]),
+            "deleted": sorted(key for key in before if key not in after),
+        }
+        if not any(table.values()):
+            continue
+        changes.tables[stem] = table
+        for kind in CHANGE_KINDS:
+            for key in table[kind]:
+                sample_id = sample_id_of(key.split("#fid:", 1)[0])
+                if sample_id is None:
+                    changes.unkeyed_tables.add(stem)
+                else:
+                    getattr(changes, kind).add(sample_id)
+    return changes
+
+
+def table_key(filename: str) -> str:
+    """Change set table name of a raw or formatted table: 'observations_EPSG:4326.csv' -> 'observations'"""
+    return os.path.splitext(filename)[0].rsplit("_", 1)[0]
+
+
+def load_changes(data_dir: str | None, project: str) -> ChangeSet | None:
+    """The change set of the current run for a project, or None when there is none."""
+    data = load_json(os.path.join(f"{data_dir}/changes", project, "changes.json"))
+    return ChangeSet.from_json(data) if data else None
+
+
+def capture(project: str) -> ChangeSet:
+    project_dir = os.path.join(changes_path, project)
+    baseline = load_json(os.path.join(project_dir, "snapshot.json"))
+    current = project_snapshot(os.path.join(in_gpkg_path, project))
+    changes = diff_snapshots(project, baseline["tables"] if baseline else None, current)
+
+    created_at = datetime.now(timezone.utc).isoformat()
+    pending = {"project": project, "taken_at": created_at, "tables": current}
+    save_json_atomic(pending, os.path.join(project_dir, "snapshot.pending.json"))
+    save_json_atomic({**changes.to_json(), "created_at": created_at}, os.path.join(project_dir, "changes.json"))
+    return changes
+
+
+def commit(project: str) -> bool:
+    """Make the pending snapshot the baseline of the next run. False when there is none."""
+    project_dir = os.path.join(changes_path, project)
+    pending = os.path.join(project_dir, "snapshot.pending.json")
+    if not os.path.exists(pending):
+        return False
+    os.replace(pending, os.path.join(project_dir, "snapshot.json"))
+    return True
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    if args.project:
+        print(f"Filtering to project: {args.project}")
+
+    if args.commit:
+        committed = 0
+        if os.path.isdir(changes_path):
+            for project in sorted(os.listdir(changes_path)):
+                if args.project and project != args.project:
+                    continue
+                committed += commit(project)
+        print(f"Change capture committed: projects={committed}")
+        return
+
+    projects = 0
+    totals = dict.fromkeys(CHANGE_KINDS, 0)
+    for project in sorted(os.listdir(in_gpkg_path)):
+        if args.project and project != args.project:
+            continue
+        if not os.path.isdir(os.path.join(in_gpkg_path, project)):
+            continue
+
+        changes = capture(project)
+        projects += 1
+        counts = {kind: sum(len(table[kind]) for table in changes.tables.values()) for kind in CHANGE_KINDS}
+        for kind in CHANGE_KINDS:
+            totals[kind] += counts[kind]
+        label = " (first snapshot, full run)" if changes.full else ""
+        print(
+            f"{project}: inserted={counts['inserted']}, updated={counts['updated']}, "
+            f"deleted={counts['deleted']}, tables={len(changes.tables)}{label}"
+        )
+
+    metrics.count("rows_inserted", totals["inserted"])
+    metrics.count("rows_updated", totals["updated"])
+    metrics.count("rows_deleted", totals["deleted"])
+    print(
+        f"Change capture complete: projects={projects}, inserted={totals['inserted']}, "
+        f"updated={totals['updated']}, deleted={totals['deleted']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import functools
 import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-import geopandas  # type: ignore[import-untyped]
+import numpy as np
 import pandas as pd
 import pyproj
+import shapely  # type: ignore[import-untyped]
 from dotenv import load_dotenv
 
+from qfieldcloud_fetcher import catalog, change_capture, fs_utils, metrics, table_io
+from qfieldcloud_fetcher.stage_cache import StageCache
+
 # Loads environment variables
 load_dotenv()
 
@@ -20,75 +29,70 @@ in_csv_path = f"{data_path}/raw_csv"
 out_csv_path = f"{data_path}/formatted_csv"
 nextcloud_path = f"{nextcloud}/csv"
 
+OUT_CRS = "EPSG:4326"
+
+# Files of the same CRS reprojected together in one call (and handed to one worker)
+DEFAULT_BATCH_SIZE = 50
 
-def convert_csv_coordinates(root: str, filename: str, project: str) -> None:
+
+def to_flag(series: pd.Series) -> pd.Series:
     """
-    Converts the coordinates in a CSV file to EPSG:4326.
-    The base CRS system is inferred from the filename.
-    The converted CSV file is saved in the specified output folder
-    while preserving the directory structure of the input folder.
+    Convert a column to 0/1 with nan as 0. Text values (kept as-is by Parquet)
+    are parsed the way read_csv would parse them, so "False" and "0" stay false.
     """
-    csv_file_path = os.path.join(root, filename)
+    if series.dtype == object or isinstance(series.dtype, pd.StringDtype):
+        text = series.dropna().astype(str).str.strip()
+        parsed = text.str.lower().map({"true": 1.0, "false": 0.0}).fillna(pd.to_numeric(text, errors="coerce"))
+        # Any other non-empty text is truthy, as with astype(bool)
+        parsed = parsed.where(parsed.notna() | (text == ""), 1.0)
+        series = parsed.reindex(series.index)
+    return (
+        series
+        .fillna(0)
+        .astype(bool)  # convert everything to boolean first
+        .astype(int)  # then to 0 or 1
+    )
 
-    # Extract the base CRS system from the filename
-    file_name = os.path.splitext(os.path.basename(csv_file_path))[0]
+
+@functools.cache
+def get_transformer(base_crs: str) -> pyproj.Transformer:
+    """One Transformer per source CRS and process: building them dominates small files."""
+    return pyproj.Transformer.from_crs(pyproj.CRS.from_string(base_crs), pyproj.CRS(OUT_CRS), always_xy=True)
+
+
+def split_crs(filename: str) -> tuple[str, str]:
+    """'obs_EPSG:2056.csv' -> ('obs', 'EPSG:2056')"""
+    file_name = table_io.table_stem(os.path.basename(filename))
     base_crs = file_name.split("_")[-1]
-    file_name = file_name.replace(f"_{base_crs}", "")
+    return file_name.replace(f"_{base_crs}", ""), base_crs
+
 
-    # Load the CSV file into a pandas dataframe
+def load_raw_table(csv_file_path: str) -> tuple[pd.DataFrame | None, str]:
+    """Load a raw table, or return (None, reason) when it cannot be formatted."""
     try:
-        df = pd.read_csv(csv_file_path)
+        df = table_io.read_table(csv_file_path, schema="raw")
     except pd.errors.EmptyDataError:
-        print(f"Skipping {csv_file_path} (empty CSV file)")
-        return
+        return None, f"Skipping {csv_file_path} (empty CSV file)"
     except pd.errors.ParserError:
-        print(f"Skipping {csv_file_path} (invalid CSV file)")
-        return
+        return None, f"Skipping {csv_file_path} (invalid CSV file)"
 
     # Check if the dataframe contains the x_coord and y_coord columns
     if not all(col in df.columns for col in ["x_coord", "y_coord"]):
-        print(f"Skipping {csv_file_path} (missing x_coord or y_coord columns)")
-        return
+        return None, f"Skipping {csv_file_path} (missing x_coord or y_coord columns)"
+    return df, ""
 
-    # Define the input and output CRS systems using the pyproj library
-    in_crs = pyproj.CRS.from_string(base_crs)
-    out_crs = pyproj.CRS("EPSG:4326")
 
-    # Convert the coordinates using the pyproj library
-    transformer = pyproj.Transformer.from_crs(in_crs, out_crs, always_xy=True)
-    df["latitude"], df["longitude"] = transformer.transform(df["x_coord"].values, df["y_coord"].values)
-
-    # Apply transformation to the geometry column
-    df["geometry"] = geopandas.GeoDataFrame(
-        geometry=geopandas.points_from_xy(x=df["longitude"], y=df["latitude"]), crs="EPSG:4326"
+def add_derived_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Geometry, flag and sample_id columns, once latitude/longitude are set."""
+    # Geometry as WKT straight from the coordinate arrays (same text as a GeoSeries in to_csv)
+    df["geometry"] = shapely.to_wkt(
+        shapely.points(df["longitude"].to_numpy(), df["latitude"].to_numpy()), rounding_precision=-1
     )
 
-    # Convert nan in is_wild to 0
-    if "is_wild" in df.columns:
-        df["is_wild"] = (
-            df["is_wild"]
-            .fillna(0)
-            .astype(bool)  # convert everything to boolean first
-            .astype(int)  # then to 0 or 1
-        )
-
-    # Convert nan in inat_upload to 1
-    if "inat_upload" in df.columns:
-        df["inat_upload"] = (
-            df["inat_upload"]
-            .fillna(0)
-            .astype(bool)  # convert everything to boolean first
-            .astype(int)  # then to 0 or 1
-        )
-
-    # Convert nan in no_name_on_list to 0
-    if "no_name_on_list" in df.columns:
-        df["no_name_on_list"] = (
-            df["no_name_on_list"]
-            .fillna(0)
-            .astype(bool)  # convert everything to boolean first
-            .astype(int)  # then to 0 or 1
-        )
+    # Convert nan in is_wild, inat_upload and no_name_on_list to 0
+    for column in table_io.FLAG_COLUMNS:
+        if column in df.columns:
+            df[column] = to_flag(df[column])
 
     # Attribute sample_id to observations
     # Fill NA in 'sample_id' with a pattern based on 'latitude' and 'longitude'
@@ -103,50 +107,285 @@ def convert_csv_coordinates(root: str, filename: str, project: str) -> None:
             )
             .astype(str)
         )
+    return df
+
+
+def publish_to_nextcloud(df: pd.DataFrame | None, formatted_path: str, project: str, output_file_name: str) -> str:
+    """
+    Publish a formatted table to NextCloud as CSV and return the log line.
+    A CSV intermediate is linked (or copied) rather than serialized a second time;
+    a Parquet one is written as CSV once (df must then be given). NextCloud files
+    whose content did not change are left untouched so the scanner skips them.
+    """
+    destination = os.path.join(nextcloud_path, project, output_file_name)
+    if formatted_path.endswith(table_io.EXTENSIONS["csv"]):
+        method = fs_utils.publish_file(formatted_path, destination)
+    else:
+        if df is None:
+            raise ValueError("df is required for a parquet intermediate")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        tmp_path = destination + ".tmp"
+        df.to_csv(tmp_path, index=False)
+        method = "write" if fs_utils.replace_if_changed(tmp_path, destination) else "unchanged"
+    if method == "unchanged":
+        return f"{output_file_name} unchanged on NextCloud"
+    return f"{output_file_name} added to NextCloud ({method})"
+
+
+def convert_file_chunked(csv_file_path: str, project: str, base_crs: str, fmt: str, chunk_size: int) -> list[str]:
+    """
+    Same output as convert_batch for one file, streamed in chunks of chunk_size rows
+    so memory stays constant however large the raw table is.
+    """
+    try:
+        header = table_io.read_table(csv_file_path, nrows=0, schema="raw")
+    except pd.errors.EmptyDataError:
+        return [f"Skipping {csv_file_path} (empty CSV file)"]
+    except pd.errors.ParserError:
+        return [f"Skipping {csv_file_path} (invalid CSV file)"]
+    if not all(col in header.columns for col in ["x_coord", "y_coord"]):
+        return [f"Skipping {csv_file_path} (missing x_coord or y_coord columns)"]
+
+    file_name, _ = split_crs(csv_file_path)
+    output_stem = f"{file_name}_{OUT_CRS}"
+    output_file_name = f"{output_stem}.csv"
+    transformer = get_transformer(base_crs)
+    # A CSV intermediate is published by link afterwards; a Parquet one needs its own CSV stream
+    nextcloud_stream = (
+        table_io.TableAppender(os.path.join(nextcloud_path, project), output_stem, "csv", skip_unchanged=True)
+        if fmt != "csv"
+        else contextlib.nullcontext()
+    )
+    try:
+        with (
+            table_io.TableAppender(os.path.join(out_csv_path, project), output_stem, fmt) as formatted,
+            nextcloud_stream as published,
+        ):
+            for chunk in table_io.iter_table_chunks(csv_file_path, chunk_size, schema="raw"):
+                chunk["latitude"], chunk["longitude"] = transformer.transform(
+                    chunk["x_coord"].to_numpy(dtype="float64", na_value=np.nan),
+                    chunk["y_coord"].to_numpy(dtype="float64", na_value=np.nan),
+                )
+                add_derived_columns(chunk)
+                formatted.append(chunk)
+                if published is not None:
+                    published.append(chunk)
+    except pd.errors.ParserError:
+        return [f"Skipping {csv_file_path} (invalid CSV file)"]
 
-    # Extract the CRS from the output pyproj object and replace the original CRS in the output filename
-    out_crs_str = out_crs.to_string()
-    output_file_name = f"{file_name}_{out_crs_str}.csv"
+    log = [f"{os.path.basename(csv_file_path)} successfully converted (rows={formatted.rows}, chunked)"]
+    if published is None:
+        log.append(publish_to_nextcloud(None, formatted.path, project, output_file_name))
+    elif published.changed:
+        log.append(f"{output_file_name} added to NextCloud (write)")
+    else:
+        log.append(f"{output_file_name} unchanged on NextCloud")
+    return log
 
-    # Save the converted coordinates to a new CSV file in the specified output folder
-    output_file_path = os.path.join(out_csv_path, project, output_file_name)
 
-    # Add csv to formatted folder
-    os.makedirs(os.path.join(out_csv_path, project), exist_ok=True)
-    df.to_csv(output_file_path, index=False)
-    print(f"{filename} successfully converted")
+def convert_batch(items: list[tuple[str, str]], base_crs: str, fmt: str = "csv", chunk_size: int = 0) -> list[str]:
+    """
+    Converts the coordinates of several raw tables (CSV or Parquet) sharing the
+    same base CRS to EPSG:4326 with a single vectorized transform.
+    `items` are (raw table path, project) pairs. The converted tables are saved
+    in the output folder in `fmt` while preserving the project folders; NextCloud
+    always receives a CSV copy. Returns the log lines, so workers do not interleave output.
+    With chunk_size > 0 every file is streamed instead (see convert_file_chunked).
+    """
+    if chunk_size > 0:
+        log: list[str] = []
+        for csv_file_path, project in items:
+            log.extend(convert_file_chunked(csv_file_path, project, base_crs, fmt, chunk_size))
+        return log
+
+    log = []
+    loaded: list[tuple[str, str, pd.DataFrame]] = []
+    for csv_file_path, project in items:
+        df, reason = load_raw_table(csv_file_path)
+        if df is None:
+            log.append(reason)
+            continue
+        loaded.append((csv_file_path, project, df))
+    if not loaded:
+        return log
+
+    # Convert the coordinates of all files at once using the cached pyproj transformer
+    x = np.concatenate([df["x_coord"].to_numpy(dtype="float64", na_value=np.nan) for _, _, df in loaded])
+    y = np.concatenate([df["y_coord"].to_numpy(dtype="float64", na_value=np.nan) for _, _, df in loaded])
+    latitude, longitude = get_transformer(base_crs).transform(x, y)
+
+    offset = 0
+    for csv_file_path, project, df in loaded:
+        rows = len(df)
+        df["latitude"], df["longitude"] = latitude[offset : offset + rows], longitude[offset : offset + rows]
+        offset += rows
+        add_derived_columns(df)
+
+        # Replace the original CRS in the output filename
+        file_name, _ = split_crs(csv_file_path)
+        output_stem = f"{file_name}_{OUT_CRS}"
+        output_file_name = f"{output_stem}.csv"
+
+        # Save the converted coordinates to a new table in the specified output folder
+        formatted_path = table_io.write_table(df, os.path.join(out_csv_path, project), output_stem, fmt)
+        log.append(f"{os.path.basename(csv_file_path)} successfully converted")
 
-    # Add csv to NextCloud
-    nextcloud_csv_path = os.path.join(nextcloud_path, project)
-    os.makedirs(nextcloud_csv_path, exist_ok=True)
-    df.to_csv(os.path.join(nextcloud_csv_path, output_file_name), index=False)
-    print(f"{output_file_name} added to NextCloud")
+        # Add csv to NextCloud
+        log.append(publish_to_nextcloud(df, formatted_path, project, output_file_name))
+    return log
 
 
-def parse_args() -> argparse.Namespace:
+def convert_csv_coordinates(root: str, filename: str, project: str, fmt: str = "csv") -> None:
+    """Converts a single raw table to EPSG:4326 (see convert_batch)."""
+    _file_name, base_crs = split_crs(filename)
+    for line in convert_batch([(os.path.join(root, filename), project)], base_crs, fmt):
+        print(line)
+
+
+def plan_batches(tables: list[tuple[str, str, str]], batch_size: int) -> list[tuple[str, list[tuple[str, str]]]]:
+    """Group (project, filename, path) tables by source CRS into batches of at most batch_size files."""
+    by_crs: dict[str, list[tuple[str, str]]] = {}
+    for project, filename, path in tables:
+        _file_name, base_crs = split_crs(filename)
+        by_crs.setdefault(base_crs, []).append((path, project))
+
+    batches = []
+    size = max(batch_size, 1)
+    for base_crs, items in by_crs.items():
+        for start in range(0, len(items), size):
+            batches.append((base_crs, items[start : start + size]))
+    return batches
+
+
+def changed_tables(
+    project: str, project_tables: list[tuple[str, str, str]], changes: change_capture.ChangeSet, fmt: str
+) -> list[tuple[str, str, str]]:
+    """
+    Raw tables of a project to format again according to its change set (or because
+    their output is missing). Formatted tables of layers that no longer exist are removed.
+    """
+    project_dir = os.path.join(out_csv_path, project)
+    expected = set()
+    selected = []
+    for table in project_tables:
+        file_name, _base_crs = split_crs(table[1])
+        output = table_io.table_path(project_dir, f"{file_name}_{OUT_CRS}", fmt)
+        expected.add(os.path.basename(output))
+        if changes.table_changed(file_name) or not os.path.exists(output):
+            selected.append(table)
+    for _project, filename, path in table_io.iter_tables(project_dir):
+        if filename not in expected:
+            os.remove(path)
+            catalog.forget(path)
+    return selected
+
+
+def project_outputs(project: str) -> list[str]:
+    """Formatted tables of a project and their NextCloud copies."""
+    outputs = []
+    for _project, filename, path in table_io.iter_tables(os.path.join(out_csv_path, project)):
+        outputs.append(path)
+        outputs.append(os.path.join(nextcloud_path, project, f"{table_io.table_stem(filename)}.csv"))
+    return outputs
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Convert raw CSV files to EPSG:4326 and stage to NextCloud.")
     parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
-    return parser.parse_args()
+    parser.add_argument(
+        "--format",
+        choices=table_io.FORMATS,
+        default=table_io.default_format(),
+        help="Intermediate table format written to formatted_csv (default: $INTERMEDIATE_FORMAT or csv).",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes formatting batches in parallel (default: 1, sequential).",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=0,
+        help="Stream each file in chunks of this many rows to bound memory (default: 0, load whole files).",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Files of the same CRS reprojected together (default: {DEFAULT_BATCH_SIZE}).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Format every project, even those whose GPKGs are unchanged since the last successful run.",
+    )
+    parser.add_argument(
+        "--changes-only",
+        action="store_true",
+        help="Only format the tables with rows changed since the last run (see change_capture.py).",
+    )
+    return parser.parse_args(argv)
 
 
-def main() -> None:
-    args = parse_args()
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
     if args.project:
         print(f"Filtering to project: {args.project}")
+    table_io.require_format(args.format)
+
+    # Iterate over all raw tables in the input folder and its subdirectories,
+    # leaving out projects already formatted from the same GPKGs
+    cache = StageCache("csv_formatter", data_path, {"format": args.format}, enabled=not args.force)
+    by_project: dict[str, list[tuple[str, str, str]]] = {}
+    for table in table_io.iter_tables(in_csv_path, args.project):
+        by_project.setdefault(table[0], []).append(table)
 
-    processed = 0
-    # Iterate over all CSV files in the input folder and its subdirectories
-    for root, _dirs, files in os.walk(in_csv_path):
-        project = os.path.basename(root)
-        if args.project and project != args.project:
+    tables = []
+    projects = []
+    for project, project_tables in by_project.items():
+        if cache.is_fresh(project):
+            print(f"Skipping {project} (GPKGs unchanged since last run)")
             continue
-        for filename in files:
-            if filename.endswith(".csv"):
-                # Convert the CSV file and save the result in the output folder
-                convert_csv_coordinates(root, filename, project)
-                processed += 1
+        projects.append(project)
+        changes = change_capture.load_changes(data_path, project) if args.changes_only else None
+        if changes is None or changes.full:
+            # Start from an empty folder so tables of removed layers do not linger
+            shutil.rmtree(os.path.join(out_csv_path, project), ignore_errors=True)
+            catalog.forget(os.path.join(out_csv_path, project))
+            tables.extend(project_tables)
+        else:
+            selected = changed_tables(project, project_tables, changes, args.format)
+            print(f"{project}: {len(selected)} of {len(project_tables)} tables have changed rows")
+            tables.extend(selected)
+    batches = plan_batches(tables, args.batch_size)
 
-    print(f"CSV formatting complete: processed={processed}")
+    start = time.monotonic()
+    if args.jobs > 1 and len(batches) > 1:
+        print(f"Formatting {len(tables)} files in {len(batches)} batches with {args.jobs} worker processes")
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [
+                pool.submit(convert_batch, items, base_crs, args.format, args.chunk_size) for base_crs, items in batches
+            ]
+            for future in futures:
+                for line in future.result():
+                    print(line)
+    else:
+        for base_crs, items in batches:
+            for line in convert_batch(items, base_crs, args.format, args.chunk_size):
+                print(line)
+
+    for project in projects:
+        cache.record(project, project_outputs(project))
+    cache.save()
+
+    metrics.count("tables", len(tables))
+    elapsed = time.monotonic() - start
+    print(
+        f"CSV formatting complete: processed={len(tables)}, batches={len(batches)}, "
+        f"skipped_projects={len(cache.skipped)}, elapsed={elapsed:.2f}s"
+    )
 
 
 if __name__ == "__main__":
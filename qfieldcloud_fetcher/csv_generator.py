@@ -2,11 +2,21 @@
 
 import argparse
 import os
+import shutil
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import geopandas as gpd  # type: ignore[import-untyped]
-import pandas as pd
 from dotenv import load_dotenv
 
+from qfieldcloud_fetcher import catalog, gpkg_reader, metrics, table_io
+from qfieldcloud_fetcher.gpkg_reader import is_data_layer, output_stem
+from qfieldcloud_fetcher.stage_cache import StageCache
+from qfieldcloud_fetcher.table_io import arrow_available
+
+if typing.TYPE_CHECKING:
+    import pandas as pd
+
 # Loads environment variables
 load_dotenv()
 
@@ -17,16 +27,197 @@ data_path = os.getenv("DATA_PATH")
 in_gpkg_path = f"{data_path}/in/gpkg"
 in_csv_path = f"{data_path}/raw_csv"
 
-def parse_args() -> argparse.Namespace:
+ENGINES = ("geopandas", "arrow", "sqlite")
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Convert GPKG files to raw CSV files.")
     parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
-    return parser.parse_args()
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes converting GPKG files in parallel (default: 1, sequential).",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="geopandas",
+        help=(
+            "GPKG reader: 'geopandas' (default), 'arrow' (pyogrio with use_arrow, needs pyarrow) or "
+            "'sqlite' (standard library only, falls back to geopandas for non-point layers)."
+        ),
+    )
+    parser.add_argument(
+        "--format",
+        choices=table_io.FORMATS,
+        default=table_io.default_format(),
+        help="Intermediate table format written to raw_csv (default: $INTERMEDIATE_FORMAT or csv).",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Time every reader on the N biggest GPKGs in scope and exit without writing CSVs.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Convert every project, even those whose GPKGs are unchanged since the last successful run.",
+    )
+    return parser.parse_args(argv)
+
+
+def list_data_layers(gpkg_path: str) -> list[str]:
+    """Return every attribute/feature layer of a GPKG, skipping QGIS bookkeeping tables."""
+    import pyogrio  # type: ignore[import-untyped]
+
+    return [str(name) for name, _geometry_type in pyogrio.list_layers(gpkg_path) if is_data_layer(str(name))]
+
+
+def read_layer(gpkg_path: str, layer: str, engine: str) -> tuple["pd.DataFrame", str]:
+    """Read one layer and return (dataframe, crs suffix)."""
+    # Imported here so the sqlite engine never pays for the GDAL/geopandas import chain
+    import geopandas as gpd  # type: ignore[import-untyped]
+    import pyogrio
+
+    if engine == "arrow":
+        # Arrow batches are decoded in bulk instead of building Python objects row by row
+        df = pyogrio.read_dataframe(gpkg_path, layer=layer, use_arrow=arrow_available())
+        crs = pyogrio.read_info(gpkg_path, layer=layer).get("crs")
+        return df, str(crs) if crs else "None"
+
+    gdf = gpd.read_file(gpkg_path, layer=layer)
+    suffix = gdf.crs if hasattr(gdf, "geometry") and gdf.geometry.name in gdf.columns else "None"
+    return gdf, str(suffix)
+
+
+def convert_gpkg(
+    gpkg_path: str, output_dir: str, engine: str = "geopandas", fmt: str = "csv"
+) -> list[tuple[str, int, float]]:
+    """
+    Convert every data layer of a GPKG to <output_dir>/<name>_<crs>.<csv|parquet>.
+    Returns one (output path, row count, seconds spent) tuple per layer.
+    """
+    if engine == "sqlite":
+        return convert_gpkg_sqlite(gpkg_path, output_dir, fmt)
+
+    results = []
+    gpkg_name = os.path.basename(gpkg_path)
+    for index, layer in enumerate(list_data_layers(gpkg_path)):
+        start = time.monotonic()
+        df, suffix = read_layer(gpkg_path, layer, engine)
+
+        # Write the layer straight to the output table (geometries are serialized as WKT)
+        stem = f"{output_stem(gpkg_name, layer, index)}_{suffix}"
+        output_csv_path = table_io.write_table(df, output_dir, stem, fmt)
+        results.append((output_csv_path, len(df), time.monotonic() - start))
+    return results
+
 
+def convert_gpkg_sqlite(gpkg_path: str, output_dir: str, fmt: str = "csv") -> list[tuple[str, int, float]]:
+    """
+    Same output as convert_gpkg, read with sqlite3 directly. Layers the lightweight
+    reader cannot reproduce exactly are converted with geopandas instead.
+    """
+    results = []
+    gpkg_name = os.path.basename(gpkg_path)
+    os.makedirs(output_dir, exist_ok=True)
+    conn = gpkg_reader.connect(gpkg_path)
+    try:
+        for index, layer in enumerate(gpkg_reader.list_layers(conn)):
+            start = time.monotonic()
+            stem = output_stem(gpkg_name, layer.table_name, index)
+            try:
+                if fmt == "csv":
+                    output_csv_path = table_io.table_path(output_dir, f"{stem}_{layer.crs}", fmt)
+                    rows = gpkg_reader.write_layer_csv(conn, layer, output_csv_path)
+                else:
+                    frame = gpkg_reader.read_layer_frame(conn, layer)
+                    output_csv_path = table_io.write_table(frame, output_dir, f"{stem}_{layer.crs}", fmt)
+                    rows = len(frame)
+            except gpkg_reader.UnsupportedLayer as e:
+                print(f"Falling back to geopandas for {gpkg_name}:{layer.table_name} ({e})")
+                df, suffix = read_layer(gpkg_path, layer.table_name, "geopandas")
+                output_csv_path = table_io.write_table(df, output_dir, f"{stem}_{suffix}", fmt)
+                rows = len(df)
+            results.append((output_csv_path, rows, time.monotonic() - start))
+    finally:
+        conn.close()
+    return results
 
-def main() -> None:
-    args = parse_args()
+
+def report_conversion(gpkg_path: str, output_csv_path: str, rows: int, seconds: float) -> None:
+    rate = rows / seconds if seconds > 0 else float("inf")
+    print(
+        f"Converted {os.path.basename(gpkg_path)} -> {os.path.basename(output_csv_path)}: "
+        f"rows={rows} in {seconds:.2f}s ({rate:.0f} rows/s)"
+    )
+
+
+def count_rows(gpkg_path: str, engine: str) -> int:
+    """Read every data layer with the given engine and return the total row count."""
+    if engine == "sqlite":
+        conn = gpkg_reader.connect(gpkg_path)
+        try:
+            rows = 0
+            for layer in gpkg_reader.list_layers(conn):
+                try:
+                    columns = gpkg_reader.layer_columns(conn, layer)
+                    rows += sum(1 for _ in gpkg_reader.iter_rows(conn, layer, columns))
+                except gpkg_reader.UnsupportedLayer:
+                    df, _suffix = read_layer(gpkg_path, layer.table_name, "geopandas")
+                    rows += len(df)
+            return rows
+        finally:
+            conn.close()
+
+    rows = 0
+    for layer_name in list_data_layers(gpkg_path):
+        df, _suffix = read_layer(gpkg_path, layer_name, engine)
+        rows += len(df)
+    return rows
+
+
+def benchmark_readers(gpkg_paths: list[str], repeat: int = 3) -> None:
+    """Compare read times of every engine on the given GPKGs (best of `repeat`)."""
+    if not arrow_available():
+        print("pyarrow is not installed: the 'arrow' engine falls back to non-Arrow pyogrio reads.")
+    print(f"{'file':<40} {'rows':>8} " + " ".join(f"{engine + ' (s)':>15}" for engine in ENGINES))
+    for gpkg_path in gpkg_paths:
+        timings: dict[str, float] = {}
+        rows = 0
+        for engine in ENGINES:
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.monotonic()
+                rows = count_rows(gpkg_path, engine)
+                best = min(best, time.monotonic() - start)
+            timings[engine] = best
+        name = os.path.relpath(gpkg_path, in_gpkg_path)
+        print(f"{name:<40} {rows:>8} " + " ".join(f"{timings[e]:>15.3f}" for e in ENGINES))
+
+
+def project_of(gpkg_path: str) -> str:
+    """in/gpkg/<project>/<name>.gpkg -> <project>"""
+    return os.path.basename(os.path.dirname(gpkg_path))
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
     if args.project:
         print(f"Filtering to project: {args.project}")
+    table_io.require_format(args.format)
+    if args.engine == "arrow" and not arrow_available():
+        print("Warning: pyarrow is not installed, the arrow engine will read without Arrow.")
+
+    # Projects whose GPKGs did not change since the last successful conversion are skipped
+    cache = StageCache("csv_generator", data_path, {"format": args.format}, enabled=not (args.force or args.benchmark))
+
+    # Collect (gpkg, output dir) pairs first so they can be spread over workers
+    conversions: list[tuple[str, str]] = []
+    projects: list[str] = []
 
     # Loop over the subfolders in the gpkg directory
     for subfolder in os.listdir(in_gpkg_path):
@@ -39,6 +230,11 @@ def main() -> None:
         if not os.path.isdir(subfolder_gpkg_path):
             continue
 
+        if cache.is_fresh(subfolder):
+            print(f"Skipping {subfolder} (GPKGs unchanged since last run)")
+            continue
+        projects.append(subfolder)
+
         gpkg_files = [name for name in os.listdir(subfolder_gpkg_path) if name.endswith(".gpkg")]
         print(f"Processing gpkg files in subfolder: {subfolder} (count={len(gpkg_files)})")
 
@@ -50,22 +246,55 @@ def main() -> None:
             if not os.path.isfile(gpkg_path):
                 continue
 
-            # Read the gpkg file with geopandas and concatenate all layers into one dataframe
-            print(f"Converting {gpkg_name} to csv file")
-            gdf = gpd.read_file(gpkg_path, layer=0)
-            suffix = gdf.crs if hasattr(gdf, "geometry") and gdf.geometry.name in gdf.columns else "None"
+            conversions.append((gpkg_path, os.path.join(in_csv_path, subfolder)))
+
+    if args.benchmark:
+        biggest = sorted((gpkg for gpkg, _ in conversions), key=os.path.getsize, reverse=True)[: args.benchmark]
+        benchmark_readers(biggest)
+        return
+
+    # Start changed projects from an empty folder so removed layers do not linger
+    for project in projects:
+        shutil.rmtree(os.path.join(in_csv_path, project), ignore_errors=True)
+        catalog.forget(os.path.join(in_csv_path, project))
 
-            df = pd.concat([gdf], ignore_index=True)
+    start = time.monotonic()
+    outputs: dict[str, list[str]] = {project: [] for project in projects}
+    total_rows = 0
+    total_outputs = 0
+    if args.jobs > 1 and len(conversions) > 1:
+        print(f"Converting {len(conversions)} gpkg files with {args.jobs} worker processes")
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {
+                pool.submit(convert_gpkg, gpkg, out_dir, args.engine, args.format): gpkg
+                for gpkg, out_dir in conversions
+            }
+            for future in as_completed(futures):
+                for output_csv_path, rows, seconds in future.result():
+                    report_conversion(futures[future], output_csv_path, rows, seconds)
+                    outputs[project_of(futures[future])].append(output_csv_path)
+                    total_rows += rows
+                    total_outputs += 1
+    else:
+        for gpkg_path, output_dir in conversions:
+            print(f"Converting {os.path.basename(gpkg_path)} to csv file")
+            for output_csv_path, rows, seconds in convert_gpkg(gpkg_path, output_dir, args.engine, args.format):
+                report_conversion(gpkg_path, output_csv_path, rows, seconds)
+                outputs[project_of(gpkg_path)].append(output_csv_path)
+                total_rows += rows
+                total_outputs += 1
 
-            # Create the corresponding output directory for the csv file
-            output_dir = os.path.join(in_csv_path, subfolder)
-            os.makedirs(output_dir, exist_ok=True)
+    for project, project_outputs in outputs.items():
+        cache.record(project, project_outputs)
+    cache.save()
 
-            # Write the concatenated dataframe to a single CSV file with columns
-            output_csv_path = os.path.join(output_dir, f"{os.path.splitext(gpkg_name)[0]}_{suffix}.csv")
-            with open(output_csv_path, "w") as f:
-                f.write(",".join(df.columns) + "\n")
-                df.to_csv(f, header=False, index=False)
+    metrics.count("tables", total_outputs)
+    metrics.count("rows", total_rows)
+    elapsed = time.monotonic() - start
+    print(
+        f"CSV generation complete: files={len(conversions)}, layers={total_outputs}, "
+        f"rows={total_rows}, skipped_projects={len(cache.skipped)}, elapsed={elapsed:.2f}s"
+    )
 
 
 if __name__ == "__main__":
@@ -5,10 +5,14 @@ import typing
 from dataclasses import dataclass
 from urllib.parse import urlencode
 
+import numpy as np
 import pandas as pd
 import requests
 from dotenv import load_dotenv
 
+from qfieldcloud_fetcher import change_capture, directus_auth, metrics, table_io
+from qfieldcloud_fetcher.stage_cache import StageCache
+
 load_dotenv()
 
 # Access the environment variables
@@ -27,9 +31,11 @@ class PreparedObservation:
     project: str
     filename: str
     observation: dict[str, typing.Any]
+    # Updated rows of a change set are expected to exist in Directus already
+    expect_existing: bool = False
 
 
-def parse_args() -> argparse.Namespace:
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Create new observations from formatted CSVs in Directus.")
     parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
     parser.add_argument("--progress-every", type=int, default=100, help="Print progress every N rows.")
@@ -38,10 +44,25 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Update an existing Directus record when sample_id already exists. Intended for testing only.",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Import every project, even those whose GPKGs are unchanged since the last successful import.",
+    )
+    parser.add_argument(
+        "--changes-only",
+        action="store_true",
+        help="Only send the rows inserted or updated since the last run (see change_capture.py).",
+    )
+    return parser.parse_args(argv)
 
 
 def sanitize_value(value: typing.Any) -> typing.Any:
+    # Nullable (Int64/string) columns hold pd.NA, which is not JSON serializable
+    if value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
     if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
         return None if math.isnan(value) else float(value)
     return value
@@ -68,66 +89,73 @@ def build_observation(obs: dict[str, typing.Any], project: str) -> dict[str, typ
     return observation
 
 
-def collect_observations(args: argparse.Namespace) -> list[PreparedObservation]:
+def collect_observations(
+    args: argparse.Namespace,
+    projects: list[str] | None = None,
+    changes: dict[str, change_capture.ChangeSet] | None = None,
+) -> list[PreparedObservation]:
+    changes = changes or {}
     prepared: list[PreparedObservation] = []
     seen_sample_ids: dict[str, tuple[str, str]] = {}
     file_count = 0
 
-    for root, _dirs, files in os.walk(out_csv_path):
-        project = os.path.basename(root)
-        if args.project and project != args.project:
+    for project, filename, constructed_path in table_io.iter_tables(out_csv_path, args.project):
+        if projects is not None and project not in projects:
             continue
+        if table_io.table_stem(filename) == "SBL_20004_2022_EPSG:4326":
+            continue
+
+        file_count += 1
+        df = table_io.read_table(constructed_path, schema="field_data")
+
+        if df.empty:
+            continue
+
+        total_rows = len(df)
+        print(f"Preparing {constructed_path} (rows={total_rows})")
+        df["qfield_project"] = project
+
+        for i in range(len(df)):
+            if args.progress_every > 0 and i > 0 and i % args.progress_every == 0:
+                print(f"Progress {constructed_path}: {i}/{total_rows}")
 
-        for filename in files:
-            if not filename.endswith(".csv") or filename == "SBL_20004_2022_EPSG:4326.csv":
+            obs = df.iloc[i].to_dict()
+            sample_code = obs.get("sample_id")
+            if sample_code is None or sample_code is pd.NA or (isinstance(sample_code, float) and math.isnan(sample_code)):
+                print(f"sample_id null for project {project}, file {filename}, row={i + 1}")
                 continue
 
-            file_count += 1
-            constructed_path = root + "/" + filename
-            df = pd.read_csv(constructed_path)
+            sample_code = str(sample_code).strip()
+            if not sample_code:
+                print(f"sample_id empty for project {project}, file {filename}, row={i + 1}")
+                continue
+
+            if sample_code in seen_sample_ids:
+                first_project, first_file = seen_sample_ids[sample_code]
+                raise SystemExit(
+                    "Duplicate sample_id found in input CSVs before any Directus write:\n"
+                    f"sample_id={sample_code}\n"
+                    f"first_seen={first_project}/{first_file}\n"
+                    f"duplicate={project}/{filename}\n"
+                    "Fix the source data before retrying."
+                )
+            seen_sample_ids[sample_code] = (project, filename)
 
-            if df.empty:
+            project_changes = changes.get(project)
+            if project_changes is not None and not project_changes.includes(
+                sample_code, change_capture.table_key(filename)
+            ):
                 continue
 
-            total_rows = len(df)
-            print(f"Preparing {constructed_path} (rows={total_rows})")
-            project = root.split("/")[-1]
-            df["qfield_project"] = project
-
-            for i in range(len(df)):
-                if args.progress_every > 0 and i > 0 and i % args.progress_every == 0:
-                    print(f"Progress {constructed_path}: {i}/{total_rows}")
-
-                obs = df.iloc[i].to_dict()
-                sample_code = obs.get("sample_id")
-                if sample_code is None or (isinstance(sample_code, float) and math.isnan(sample_code)):
-                    print(f"sample_id null for project {project}, file {filename}, row={i + 1}")
-                    continue
-
-                sample_code = str(sample_code).strip()
-                if not sample_code:
-                    print(f"sample_id empty for project {project}, file {filename}, row={i + 1}")
-                    continue
-
-                if sample_code in seen_sample_ids:
-                    first_project, first_file = seen_sample_ids[sample_code]
-                    raise SystemExit(
-                        "Duplicate sample_id found in input CSVs before any Directus write:\n"
-                        f"sample_id={sample_code}\n"
-                        f"first_seen={first_project}/{first_file}\n"
-                        f"duplicate={project}/{filename}\n"
-                        "Fix the source data before retrying."
-                    )
-                seen_sample_ids[sample_code] = (project, filename)
-
-                prepared.append(
-                    PreparedObservation(
-                        sample_code=sample_code,
-                        project=project,
-                        filename=filename,
-                        observation=build_observation(obs, project),
-                    )
+            prepared.append(
+                PreparedObservation(
+                    sample_code=sample_code,
+                    project=project,
+                    filename=filename,
+                    observation=build_observation(obs, project),
+                    expect_existing=project_changes is not None and sample_code not in project_changes.inserted,
                 )
+            )
 
     print(f"Preparation finished. Files processed: {file_count}, observations prepared: {len(prepared)}")
     return prepared
@@ -155,30 +183,53 @@ def find_existing_sample_ids(
     return collisions
 
 
-def main() -> None:
-    args = parse_args()
+def record_projects(cache: StageCache, projects: list[str]) -> None:
+    for project in projects:
+        cache.record(project)
+    cache.save()
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
     if args.project:
         print(f"Filtering to project: {args.project}")
     if args.allow_existing_sample_id_overwrite:
         print("Existing sample_id overwrite enabled for this run.")
 
-    prepared = collect_observations(args)
+    # Projects imported from the same GPKGs are already in Directus (re-posting them would collide)
+    cache = StageCache("db_updater", data_path, enabled=not args.force)
+    projects = sorted({project for project, _filename, _path in table_io.iter_tables(out_csv_path, args.project)})
+    pending = [project for project in projects if not cache.is_fresh(project)]
+    print(f"Projects to import: {len(pending)}, skipped_projects={len(cache.skipped)}")
+
+    changes: dict[str, change_capture.ChangeSet] = {}
+    if args.changes_only:
+        for project in pending:
+            project_changes = change_capture.load_changes(data_path, project)
+            if project_changes is not None and not project_changes.full:
+                changes[project] = project_changes
+                if project_changes.deleted:
+                    print(
+                        f"{project}: {len(project_changes.deleted)} sample_id(s) deleted in QFieldCloud "
+                        "(left untouched in Directus)"
+                    )
+
+    prepared = collect_observations(args, pending, changes)
     if not prepared:
         print("No observations to import.")
+        record_projects(cache, pending)
         return
 
     # Create a session object for making requests
     session = requests.Session()
 
-    # Send a POST request to the login endpoint
-    directus_login = f"{directus_instance}/auth/login"
-    response = session.post(directus_login, json={"email": directus_email, "password": directus_password})
-
-    # Test if connection is successful
-    if response.status_code != 200:
+    # Log in (or reuse the token of an earlier stage of the same process)
+    try:
+        directus_token = directus_auth.access_token(session, directus_instance, directus_email, directus_password)
+    except directus_auth.LoginFailed as e:
         print("Connection to Directus failed")
-        print(f"Error: {response.status_code} - {response.text}")
-        raise SystemExit(1)
+        print(f"Error: {e.status_code} - {e.text}")
+        raise SystemExit(1) from e
 
     print("Connection to Directus successful")
 
@@ -186,10 +237,6 @@ def main() -> None:
     collection_name = "Field_Data"
     directus_api = f"{directus_instance}/items/{collection_name}/"
 
-    # Stores the access token
-    data = response.json()["data"]
-    directus_token = data["access_token"]
-
     # Construct headers with authentication token
     headers = {
         "Authorization": f"Bearer {directus_token}",
@@ -202,10 +249,13 @@ def main() -> None:
         directus_api=directus_api,
         sample_codes=[item.sample_code for item in prepared],
     )
-    if collisions:
+    # Records updated in QFieldCloud are patched; any other existing sample_id is a collision
+    expected = {item.sample_code for item in prepared if item.expect_existing}
+    unexpected = {code: collision for code, collision in collisions.items() if code not in expected}
+    if unexpected:
         if not args.allow_existing_sample_id_overwrite:
             print("FATAL: existing sample_id collision(s) detected in Directus. No records were written.")
-            for collision in list(collisions.values())[:20]:
+            for collision in list(unexpected.values())[:20]:
                 sample_id = collision.get("sample_id")
                 query = urlencode({"filter[sample_id][_eq]": sample_id})
                 print(
@@ -217,12 +267,12 @@ def main() -> None:
                     f"date_updated={collision.get('date_updated')}, "
                     f"url={directus_api}?{query}"
                 )
-            if len(collisions) > 20:
-                print(f" ... and {len(collisions) - 20} more collision(s)")
+            if len(unexpected) > 20:
+                print(f" ... and {len(unexpected) - 20} more collision(s)")
             raise SystemExit(1)
 
         print("WARNING: existing sample_id collision(s) detected in Directus. Updating those records because overwrite is enabled.")
-        for collision in list(collisions.values())[:20]:
+        for collision in list(unexpected.values())[:20]:
             sample_id = collision.get("sample_id")
             query = urlencode({"filter[sample_id][_eq]": sample_id})
             print(
@@ -234,8 +284,8 @@ def main() -> None:
                 f"date_updated={collision.get('date_updated')}, "
                 f"url={directus_api}?{query}"
             )
-        if len(collisions) > 20:
-            print(f" ... and {len(collisions) - 20} more collision(s)")
+        if len(unexpected) > 20:
+            print(f" ... and {len(unexpected) - 20} more collision(s)")
 
     created = 0
     updated = 0
@@ -262,7 +312,10 @@ def main() -> None:
             raise SystemExit(1)
         created += 1
 
+    metrics.count("records_created", created)
+    metrics.count("records_updated", updated)
     print(f"Import finished. New Directus records created: {created}, updated: {updated}")
+    record_projects(cache, pending)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Apply QFieldCloud deltas to the local GPKGs instead of downloading them again.
+
+QFieldCloud keeps every edit pushed from QField as a delta
+(GET /api/v1/deltas/<project_id>/). Once a project has been downloaded in full,
+the fetcher remembers a watermark (the newest applied delta it has seen). On the
+next run it can list the deltas applied since then and replay them (create,
+patch and delete of point features) on copies of the local GPKGs. The copies
+replace the originals only once every delta of the project went through.
+
+Anything unexpected raises DeltaError and the fetcher falls back to a full
+download of the project. Examples are an HTTP error, a delta on a layer or
+geometry type we cannot map, or an `old` value that does not match the local
+row. The row-level changes then reach the CSV stages through change_capture,
+which diffs the patched GPKGs like any other fetch.
+"""
+
+import json
+import os
+import re
+import shutil
+import sqlite3
+import typing
+
+import requests
+
+from qfieldcloud_fetcher import gpkg_reader
+from qfieldcloud_fetcher.gpkg_reader import quote_identifier
+
+UNSETTLED_STATUSES = {"pending", "started", "busy"}
+POINT_WKT = re.compile(r"^\s*POINT\s*(Z)?\s*\(\s*([^)]*)\)\s*$", re.IGNORECASE)
+
+
+class DeltaError(Exception):
+    """The deltas cannot be applied safely; download the project in full instead."""
+
+
+def delta_status(delta: dict) -> str:
+    # Depending on the server version the status is "applied" or "STATUS_APPLIED"
+    return str(delta.get("status", "")).lower().removeprefix("status_")
+
+
+def is_applied(delta: dict) -> bool:
+    return delta_status(delta) == "applied"
+
+
+def list_deltas(session: requests.Session, api_base: str, project_id: str, auth_header: str) -> list[dict]:
+    """Every delta of a project, following pagination when the server paginates."""
+    url: str | None = f"{api_base}deltas/{project_id}/"
+    deltas: list[dict] = []
+    while url:
+        try:
+            response = session.get(url, headers={"Authorization": auth_header}, timeout=60)
+        except requests.RequestException as e:
+            raise DeltaError(f"could not list deltas: {e}") from e
+        if response.status_code != 200:
+            raise DeltaError(f"listing deltas returned HTTP {response.status_code}")
+        try:
+            payload = response.json()
+        except ValueError as e:
+            raise DeltaError("delta listing is not JSON") from e
+        if isinstance(payload, list):
+            deltas.extend(payload)
+            url = None
+        else:
+            deltas.extend(payload.get("results", []))
+            url = payload.get("next")
+    return deltas
+
+
+def new_applied_deltas(deltas: list[dict], watermark: dict) -> list[dict]:
+    """Applied deltas the local GPKGs do not contain yet, oldest first."""
+    since = watermark.get("created_at") or ""
+    seen = set(watermark.get("ids", []))
+    unsettled = set(watermark.get("unsettled", []))
+    selected = [
+        d
+        for d in deltas
+        if is_applied(d)
+        and str(d.get("id")) not in seen
+        and ((d.get("created_at") or "") >= since or str(d.get("id")) in unsettled)
+    ]
+    return sorted(selected, key=lambda d: (d.get("created_at") or "", str(d.get("id"))))
+
+
+def make_watermark(deltas: list[dict]) -> dict:
+    """
+    Watermark of a project whose local GPKGs contain every applied delta of `deltas`:
+    the newest created_at, the ids applied at that instant, and the older deltas
+    still waiting to be applied (they would otherwise land behind the watermark).
+    """
+    applied = [d for d in deltas if is_applied(d)]
+    newest = max((d.get("created_at") or "" for d in applied), default="")
+    return {
+        "created_at": newest,
+        "ids": sorted(str(d.get("id")) for d in applied if (d.get("created_at") or "") == newest),
+        "unsettled": sorted(str(d.get("id")) for d in deltas if delta_status(d) in UNSETTLED_STATUSES),
+    }
+
+
+def delta_content(delta: dict) -> dict:
+    content = delta.get("content")
+    if isinstance(content, str):
+        try:
+            content = json.loads(content)
+        except ValueError as e:
+            raise DeltaError(f"delta {delta.get('id')} content is not JSON") from e
+    if not isinstance(content, dict):
+        raise DeltaError(f"delta {delta.get('id')} has no content")
+    return content
+
+
+def parse_point(wkt: str | None, srs_id: int) -> bytes | None:
+    if wkt is None or wkt == "":
+        return None
+    match = POINT_WKT.match(wkt)
+    if not match:
+        raise DeltaError(f"geometry {wkt[:40]!r} is not a point")
+    try:
+        coords = tuple(float(c) for c in match.group(2).split())
+    except ValueError as e:
+        raise DeltaError(f"invalid point {wkt[:40]!r}") from e
+    if len(coords) not in (2, 3) or (match.group(1) and len(coords) != 3):
+        raise DeltaError(f"invalid point {wkt[:40]!r}")
+    return gpkg_reader.encode_point(coords, srs_id)
+
+
+class GpkgTable(typing.NamedTuple):
+    gpkg_path: str
+    table: str
+    pk: str
+    geometry_column: str | None
+    srs_id: int
+    columns: list[str]
+
+
+def project_tables(conn_by_path: dict[str, sqlite3.Connection]) -> list[GpkgTable]:
+    tables = []
+    for gpkg_path, conn in conn_by_path.items():
+        for layer in gpkg_reader.list_layers(conn):
+            names, pk, _cursor = gpkg_reader.iter_raw_rows(conn, layer)
+            srs = conn.execute(
+                "SELECT srs_id FROM gpkg_geometry_columns WHERE table_name = ?", (layer.table_name,)
+            ).fetchone()
+            tables.append(
+                GpkgTable(
+                    gpkg_path, layer.table_name, pk or "rowid", layer.geometry_column, srs[0] if srs else 0, names
+                )
+            )
+    return tables
+
+
+def resolve_table(layer_id: str, tables: list[GpkgTable]) -> GpkgTable:
+    """
+    QGIS layer ids are '<layer name>_<uuid>'. Find the one table whose name (or
+    GPKG stem) prefixes the id; anything else is ambiguous.
+    """
+    candidates = []
+    for table in tables:
+        for name in {table.table, os.path.splitext(os.path.basename(table.gpkg_path))[0]}:
+            if layer_id == name or layer_id.startswith(name + "_"):
+                candidates.append((len(name), table))
+    if not candidates:
+        raise DeltaError(f"no local layer matches {layer_id!r}")
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    if len(candidates) > 1 and candidates[0][0] == candidates[1][0] and candidates[0][1] != candidates[1][1]:
+        raise DeltaError(f"layer {layer_id!r} matches several local tables")
+    return candidates[0][1]
+
+
+def same_value(local: typing.Any, remote: typing.Any) -> bool:
+    if local is None or remote is None:
+        return local is None and remote is None
+    if isinstance(local, (int, float)) and not isinstance(local, bool):
+        try:
+            return float(local) == float(remote)
+        except (TypeError, ValueError):
+            return False
+    return str(local) == str(remote)
+
+
+def sql_value(value: typing.Any) -> typing.Any:
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def register_geometry_functions(conn: sqlite3.Connection) -> None:
+    """The R-tree triggers of a GPKG call these SpatiaLite functions; points only."""
+
+    def coordinate(index: int) -> typing.Callable[[bytes | None], float | None]:
+        def get(blob: bytes | None) -> float | None:
+            coords = gpkg_reader.decode_point(blob) if blob else None
+            return coords[index] if coords else None
+
+        return get
+
+    conn.create_function("ST_IsEmpty", 1, lambda blob: 1 if not blob or gpkg_reader.decode_point(blob) is None else 0)
+    conn.create_function("ST_MinX", 1, coordinate(0))
+    conn.create_function("ST_MaxX", 1, coordinate(0))
+    conn.create_function("ST_MinY", 1, coordinate(1))
+    conn.create_function("ST_MaxY", 1, coordinate(1))
+
+
+def apply_delta(conn: sqlite3.Connection, table: GpkgTable, content: dict) -> str:
+    method = str(content.get("method", "")).lower()
+    pk_value = content.get("sourcePk")
+    # Only quoted identifiers are interpolated in the SQL below, values are always bound
+    quoted, pk = quote_identifier(table.table), quote_identifier(table.pk)
+    new = content.get("new") or {}
+    old = content.get("old") or {}
+
+    def values_from(section: dict) -> dict[str, typing.Any]:
+        values = {k: sql_value(v) for k, v in (section.get("attributes") or {}).items()}
+        unknown = set(values) - set(table.columns)
+        if unknown:
+            raise DeltaError(f"{table.table}: unknown column(s) {', '.join(sorted(unknown))}")
+        if "geometry" in section:
+            if table.geometry_column is None:
+                raise DeltaError(f"{table.table} has no geometry column")
+            values[table.geometry_column] = parse_point(section.get("geometry"), table.srs_id)
+        return values
+
+    def current_row() -> dict[str, typing.Any] | None:
+        cursor = conn.execute(f"SELECT * FROM {quoted} WHERE {pk} = ?", (pk_value,))  # noqa: S608
+        row = cursor.fetchone()
+        return dict(zip([c[0] for c in cursor.description], row)) if row else None
+
+    if method == "create":
+        values = values_from(new)
+        if pk_value is not None:
+            values.setdefault(table.pk, pk_value)
+            if current_row() is not None:
+                raise DeltaError(f"{table.table}: feature {pk_value} already exists")
+        columns = ", ".join(quote_identifier(c) for c in values)
+        placeholders = ", ".join("?" * len(values))
+        conn.execute(f"INSERT INTO {quoted} ({columns}) VALUES ({placeholders})", list(values.values()))  # noqa: S608
+        return "created"
+
+    row = current_row()
+    if row is None:
+        raise DeltaError(f"{table.table}: feature {pk_value} does not exist locally")
+    for column, value in (old.get("attributes") or {}).items():
+        if column in row and not same_value(row[column], value):
+            raise DeltaError(f"{table.table}: feature {pk_value}.{column} differs from the delta's old value")
+
+    if method == "delete":
+        conn.execute(f"DELETE FROM {quoted} WHERE {pk} = ?", (pk_value,))  # noqa: S608
+        return "deleted"
+    if method == "patch":
+        values = values_from(new)
+        if values:
+            assignments = ", ".join(f"{quote_identifier(c)} = ?" for c in values)
+            query = f"UPDATE {quoted} SET {assignments} WHERE {pk} = ?"  # noqa: S608
+            conn.execute(query, [*values.values(), pk_value])
+        return "patched"
+    raise DeltaError(f"unsupported delta method {method!r}")
+
+
+def apply_deltas(gpkg_dir: str, deltas: list[dict]) -> dict[str, int]:
+    """
+    Replay deltas on copies of the project's GPKGs and swap them in once all
+    succeeded. Returns counts per method; raises DeltaError and leaves the
+    originals untouched otherwise.
+    """
+    gpkg_paths = sorted(os.path.join(gpkg_dir, name) for name in os.listdir(gpkg_dir) if name.endswith(".gpkg"))
+    if not gpkg_paths:
+        raise DeltaError("no local GPKG to apply deltas to")
+
+    counts = {"created": 0, "patched": 0, "deleted": 0}
+    copies = {path: path + ".delta.tmp" for path in gpkg_paths}
+    conns: dict[str, sqlite3.Connection] = {}
+    try:
+        for path, copy in copies.items():
+            shutil.copyfile(path, copy)
+            conn = sqlite3.connect(copy, isolation_level=None)
+            register_geometry_functions(conn)
+            conn.execute("BEGIN")
+            conns[path] = conn
+        tables = project_tables(conns)
+        for delta in deltas:
+            content = delta_content(delta)
+            table = resolve_table(str(content.get("sourceLayerId") or content.get("localLayerId") or ""), tables)
+            try:
+                counts[apply_delta(conns[table.gpkg_path], table, content)] += 1
+            except (sqlite3.Error, gpkg_reader.UnsupportedLayer) as e:
+                raise DeltaError(f"delta {delta.get('id')}: {e}") from e
+        for conn in conns.values():
+            conn.execute("COMMIT")
+            conn.close()
+        conns.clear()
+        for path, copy in copies.items():
+            os.replace(copy, path)
+    finally:
+        for conn in conns.values():
+            conn.close()
+        for copy in copies.values():
+            if os.path.exists(copy):
+                os.remove(copy)
+    return counts
+
+
+def ingest_project(
+    session: requests.Session, api_base: str, project_id: str, gpkg_dir: str, watermark: dict | None, auth_header: str
+) -> tuple[dict, dict[str, int]]:
+    """
+    Bring the local GPKGs of a project up to date from its deltas.
+    Returns (new watermark, counts); raises DeltaError when a full download is needed.
+    """
+    if not watermark:
+        raise DeltaError("no watermark yet")
+    if not os.path.isdir(gpkg_dir):
+        raise DeltaError("no local copy of the project")
+    deltas = list_deltas(session, api_base, project_id, auth_header)
+    pending = new_applied_deltas(deltas, watermark)
+    if not pending:
+        # The GPKG changed remotely without any delta (e.g. a re-upload from QGIS)
+        raise DeltaError("the project changed but no new applied delta was found")
+    counts = apply_deltas(gpkg_dir, pending)
+    return make_watermark(deltas), counts
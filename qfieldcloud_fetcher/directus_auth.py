@@ -0,0 +1,48 @@
+"""
+Directus login shared by the stages running in one process.
+
+Run as separate scripts, db_updater, fields_creator and directus_link_maker each
+log in once. Run in-process by pipeline.py, they reuse the access token of the
+first login until shortly before Directus expires it.
+"""
+
+import time
+
+import requests
+
+# Log in again this long before the access token expires
+EXPIRY_MARGIN_S = 60
+
+# (instance, email) -> (access token, monotonic deadline)
+_tokens: dict[tuple[str, str], tuple[str, float]] = {}
+
+
+class LoginFailed(Exception):
+    def __init__(self, response: requests.Response):
+        super().__init__(f"Directus login failed: {response.status_code}")
+        self.status_code = response.status_code
+        self.text = response.text
+
+
+def access_token(
+    session: requests.Session,
+    instance: str | None,
+    email: str | None,
+    password: str | None,
+    timeout: float | tuple[float, float] | None = None,
+) -> str:
+    """Access token for a Directus account, logging in only when no valid one is cached."""
+    key = (str(instance), str(email))
+    cached = _tokens.get(key)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    response = session.post(f"{instance}/auth/login", json={"email": email, "password": password}, timeout=timeout)
+    if response.status_code != 200:
+        raise LoginFailed(response)
+    data = response.json()["data"]
+    # "expires" is the token lifetime in milliseconds
+    token: str = data["access_token"]
+    lifetime_s = (data.get("expires") or 0) / 1000
+    _tokens[key] = (token, time.monotonic() + lifetime_s - EXPIRY_MARGIN_S)
+    return token
@@ -2,13 +2,23 @@
 import os
 import sys
 import json
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+from qfieldcloud_fetcher import directus_auth, metrics, tracing
+
+# Keep lookup URLs well below common proxy/gateway limits (nginx defaults to 8k)
+MAX_URL_LEN = 6000
+
 
 def make_session() -> requests.Session:
     s = requests.Session()
@@ -32,7 +42,8 @@ def api_get(session: requests.Session, url: str, params: Optional[dict] = None)
     r = session.get(url, params=params, timeout=(10, 60))
     if r.status_code != 200:
         raise RuntimeError(f"GET {url} failed: {r.status_code} {r.text[:500]}")
-    return r.json()
+    data: dict = r.json()
+    return data
 
 
 def api_patch(session: requests.Session, url: str, json_body: Any) -> dict:
@@ -46,6 +57,342 @@ def chunked(seq: List[Any], n: int) -> List[List[Any]]:
     return [seq[i:i + n] for i in range(0, len(seq), n)]
 
 
+def iter_dried_pages(
+    session: requests.Session, dried_url: str, page_size: int
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Keyset pagination over Dried_Samples_Data rows still missing field_data.
+    Pages are sorted by id and continue after the last id seen, so rows that get
+    linked (and therefore drop out of the filter) never shift the next page.
+    """
+    last_id: Optional[int] = None
+    while True:
+        params: Dict[str, Any] = {
+            "filter[field_data][_null]": "true",
+            # expand the related container to get its id and container_id in one query
+            "fields": "id,sample_container.id,sample_container.container_id",
+            "sort": "id",
+            "limit": page_size,
+        }
+        if last_id is not None:
+            params["filter[id][_gt]"] = last_id
+        rows = api_get(session, dried_url, params=params).get("data", [])
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_id = int(rows[-1]["id"])
+
+
+def build_targets(rows: List[Dict[str, Any]]) -> Tuple[List[Tuple[int, str]], int]:
+    """Return (dried_id, sample_code) pairs worth resolving and the number of obs_* rows skipped."""
+    dried_targets: List[Tuple[int, str]] = []
+    skipped_obs = 0
+    for row in rows:
+        dried_id = row.get("id")
+        container = row.get("sample_container") or {}
+        sample_code = container.get("container_id")
+        if not dried_id or not sample_code:
+            continue
+        if isinstance(sample_code, str) and sample_code.startswith("obs_"):
+            skipped_obs += 1
+            continue
+        dried_targets.append((int(dried_id), str(sample_code)))
+    return dried_targets, skipped_obs
+
+
+def resolve_batch(session: requests.Session, field_url: str, batch: List[str]) -> Dict[str, int]:
+    params = {
+        "filter[sample_id][_in]": ",".join(batch),
+        "fields": "id,sample_id",
+        "limit": -1,
+    }
+    field_map: Dict[str, int] = {}
+    data = api_get(session, field_url, params=params).get("data", [])
+    for rec in data:
+        sid = rec.get("sample_id")
+        fid = rec.get("id")
+        if sid is not None and fid is not None:
+            field_map[str(sid)] = int(fid)
+    return field_map
+
+
+def resolve_field_ids(
+    session: requests.Session, field_url: str, sample_codes: List[str], batch_size: int
+) -> Dict[str, int]:
+    field_map: Dict[str, int] = {}
+    for batch in chunked(sorted(set(sample_codes)), batch_size):
+        field_map.update(resolve_batch(session, field_url, batch))
+    return field_map
+
+
+def build_updates(
+    dried_targets: List[Tuple[int, str]], field_map: Dict[str, int]
+) -> Tuple[List[Dict[str, int]], int]:
+    updates = []
+    unmatched = 0
+    for dried_id, code in dried_targets:
+        fid = field_map.get(code)
+        if fid is not None:
+            updates.append({"id": dried_id, "field_data": fid})
+        else:
+            unmatched += 1
+    return updates, unmatched
+
+
+# ---------------------------
+# Run bookkeeping
+# ---------------------------
+@dataclass
+class LinkStats:
+    pending: int = 0
+    pages: int = 0
+    prepared: int = 0
+    applied: int = 0
+    skipped_obs: int = 0
+    unmatched: int = 0
+    failed_batches: int = 0
+    example_updates: List[Dict[str, int]] = field(default_factory=list)
+    timings: Dict[str, float] = field(default_factory=lambda: {"fetch": 0.0, "resolve": 0.0, "patch": 0.0})
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, **counts: int) -> None:
+        with self.lock:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        with self.lock:
+            self.timings[phase] += seconds
+
+    def add_examples(self, updates: List[Dict[str, int]]) -> None:
+        with self.lock:
+            self.example_updates.extend(updates[: max(0, 5 - len(self.example_updates))])
+
+
+def timed_pages(pages: Iterator[List[Dict[str, Any]]], stats: LinkStats) -> Iterator[List[Dict[str, Any]]]:
+    """Yield pages while charging the time spent waiting on Directus to the fetch phase."""
+    while True:
+        t0 = time.monotonic()
+        page = next(pages, None)
+        stats.add_time("fetch", time.monotonic() - t0)
+        if page is None:
+            return
+        stats.add(pages=1, pending=len(page))
+        yield page
+
+
+# ---------------------------
+# Pipelined mode helpers
+# ---------------------------
+class AdaptiveBatcher:
+    """
+    Batch sizing driven by observed response times: grows while requests come back
+    well under the target latency, shrinks when they exceed it. Resolution batches
+    are additionally capped so the `_in` filter keeps the query string under max_url_len.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = 10,
+        maximum: int = 1000,
+        target_seconds: float = 2.0,
+        max_url_len: int = MAX_URL_LEN,
+    ) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.size = min(max(initial, self.minimum), self.maximum)
+        self.target_seconds = target_seconds
+        self.max_url_len = max_url_len
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            if seconds > self.target_seconds:
+                self.size = max(self.minimum, self.size // 2)
+            elif seconds < self.target_seconds / 2:
+                self.size = min(self.maximum, int(self.size * 1.5) + 1)
+
+    def split(self, items: List[Any]) -> List[List[Any]]:
+        return chunked(items, self.size)
+
+    def split_codes(self, codes: List[str], base_url: str) -> List[List[str]]:
+        batches: List[List[str]] = []
+        current: List[str] = []
+        # query string overhead besides the codes themselves (param names, fields, limit)
+        url_len = len(base_url) + 80
+        for code in codes:
+            code_len = len(quote(code, safe="")) + 3  # + encoded comma
+            if current and (len(current) >= self.size or url_len + code_len > self.max_url_len):
+                batches.append(current)
+                current = []
+                url_len = len(base_url) + 80
+            current.append(code)
+            url_len += code_len
+        if current:
+            batches.append(current)
+        return batches
+
+
+def with_retries(label: str, fn: Callable[[], Any], attempts: int) -> Any:
+    """Retry a single batch on its own, so one bad batch does not sink the whole run."""
+    with tracing.span("directus batch", {"directus.batch": label}) as span:
+        for attempt in range(1, attempts + 1):
+            try:
+                result = fn()
+            except (RuntimeError, requests.exceptions.RequestException) as e:
+                span.add_event("retry", attempt=attempt, error=str(e))
+                if attempt >= attempts:
+                    raise
+                sleep = min(30, 1.5**attempt)
+                print(f"Warn: {label} failed ({e}) — retry {attempt}/{attempts} in {sleep:.1f}s")
+                time.sleep(sleep)
+                continue
+            span.set_attribute("directus.attempts", attempt)
+            return result
+    return None
+
+
+# ---------------------------
+# Linking drivers
+# ---------------------------
+def run_serial(
+    session: requests.Session, dried_url: str, field_url: str, args: Any, stats: LinkStats
+) -> None:
+    # Each page is resolved against Field_Data and patched before the next one is
+    # requested, so memory stays bounded by --page-size whatever the backlog.
+    for page in timed_pages(iter_dried_pages(session, dried_url, args.page_size), stats):
+        page_start = time.monotonic()
+
+        dried_targets, page_skipped = build_targets(page)
+        stats.add(skipped_obs=page_skipped)
+        if not dried_targets:
+            print(f"Page {stats.pages}: rows={len(page)}, nothing to link (obs_* or incomplete rows)")
+            continue
+
+        t0 = time.monotonic()
+        field_map = resolve_field_ids(session, field_url, [code for _, code in dried_targets], args.batch_size)
+        stats.add_time("resolve", time.monotonic() - t0)
+        updates, page_unmatched = build_updates(dried_targets, field_map)
+        stats.add(unmatched=page_unmatched, prepared=len(updates))
+
+        if args.dry_run:
+            stats.add_examples(updates)
+        else:
+            t0 = time.monotonic()
+            for batch in chunked(updates, args.batch_size):
+                api_patch(session, dried_url, json_body=batch)
+                stats.add(applied=len(batch))
+            stats.add_time("patch", time.monotonic() - t0)
+
+        elapsed = max(time.monotonic() - page_start, 1e-6)
+        print(
+            f"Page {stats.pages}: rows={len(page)}, prepared={len(updates)}, unmatched={page_unmatched}, "
+            f"skipped_obs={page_skipped} in {elapsed:.2f}s ({len(page) / elapsed:.1f} rows/s)"
+        )
+
+
+def run_pipelined(
+    session: requests.Session, dried_url: str, field_url: str, args: Any, stats: LinkStats
+) -> None:
+    """
+    Overlap Field_Data resolution and PATCH batches on a small thread pool.
+    Resolution tasks enqueue their PATCH batches as soon as they finish, while the
+    main thread keeps paging through Dried_Samples_Data (bounded by in-flight tasks).
+    """
+    resolve_batcher = AdaptiveBatcher(args.batch_size)
+    patch_batcher = AdaptiveBatcher(args.batch_size)
+    in_flight: Set["Future[None]"] = set()
+    in_flight_lock = threading.Lock()
+    max_in_flight = 2 * args.workers
+
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="link") as pool:
+
+        def submit(fn: Callable[..., None], *fn_args: Any) -> None:
+            future = pool.submit(fn, *fn_args)
+            with in_flight_lock:
+                in_flight.add(future)
+
+        def patch_task(batch: List[Dict[str, int]]) -> None:
+            t0 = time.monotonic()
+            try:
+                with_retries(
+                    f"PATCH batch of {len(batch)}",
+                    lambda: api_patch(session, dried_url, json_body=batch),
+                    args.retries,
+                )
+            except (RuntimeError, requests.exceptions.RequestException) as e:
+                print(f"ERROR: PATCH batch of {len(batch)} failed after {args.retries} attempts: {e}")
+                stats.add(failed_batches=1)
+                return
+            finally:
+                elapsed = time.monotonic() - t0
+                stats.add_time("patch", elapsed)
+            patch_batcher.observe(elapsed)
+            stats.add(applied=len(batch))
+
+        def resolve_task(targets: List[Tuple[int, str]]) -> None:
+            codes = sorted({code for _, code in targets})
+            t0 = time.monotonic()
+            try:
+                field_map = with_retries(
+                    f"Field_Data lookup of {len(codes)} codes",
+                    lambda: resolve_batch(session, field_url, codes),
+                    args.retries,
+                )
+            except (RuntimeError, requests.exceptions.RequestException) as e:
+                print(f"ERROR: Field_Data lookup of {len(codes)} codes failed after {args.retries} attempts: {e}")
+                stats.add(failed_batches=1)
+                return
+            finally:
+                elapsed = time.monotonic() - t0
+                stats.add_time("resolve", elapsed)
+            resolve_batcher.observe(elapsed)
+
+            updates, unmatched = build_updates(targets, field_map)
+            stats.add(unmatched=unmatched, prepared=len(updates))
+            if args.dry_run:
+                stats.add_examples(updates)
+                return
+            for batch in patch_batcher.split(updates):
+                submit(patch_task, batch)
+
+        for page in timed_pages(iter_dried_pages(session, dried_url, args.page_size), stats):
+            dried_targets, page_skipped = build_targets(page)
+            stats.add(skipped_obs=page_skipped)
+
+            # group rows by code so every row of a code lands in the batch that resolves it
+            by_code: Dict[str, List[Tuple[int, str]]] = {}
+            for target in dried_targets:
+                by_code.setdefault(target[1], []).append(target)
+            for codes in resolve_batcher.split_codes(sorted(by_code), field_url):
+                submit(resolve_task, [t for code in codes for t in by_code[code]])
+
+            print(
+                f"Page {stats.pages}: rows={len(page)}, queued={len(dried_targets)}, "
+                f"lookup batch={resolve_batcher.size}, patch batch={patch_batcher.size}"
+            )
+            _wait_in_flight(in_flight, in_flight_lock, max_in_flight)
+
+        _wait_in_flight(in_flight, in_flight_lock, 0)
+
+
+def _wait_in_flight(in_flight: Set["Future[None]"], lock: threading.Lock, limit: int) -> None:
+    # tasks may enqueue further tasks, so re-check until the backlog is under the limit
+    while True:
+        with lock:
+            done = {f for f in in_flight if f.done()}
+            in_flight.difference_update(done)
+            pending = list(in_flight)
+        for future in done:
+            future.result()  # surface unexpected errors from worker threads
+        if len(pending) <= limit:
+            return
+        wait(pending, return_when=FIRST_COMPLETED)
+
+
 def main(argv: List[str]) -> int:
     # --- very small argparse (no dependency) ---
     import argparse
@@ -54,7 +401,22 @@ def main(argv: List[str]) -> int:
     )
     parser.add_argument("--dry-run", action="store_true", help="Preview updates without applying them.")
     parser.add_argument("--summary-file", default=None, help="Path to write a JSON summary.")
-    parser.add_argument("--batch-size", type=int, default=100, help="Batch size for API updates and lookups.")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Batch size for API updates and lookups (initial size in --pipeline mode).",
+    )
+    parser.add_argument(
+        "--page-size", type=int, default=500, help="Number of Dried_Samples_Data rows fetched per page."
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Overlap lookups and PATCH batches on a worker pool with adaptive batch sizes.",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Worker threads for --pipeline mode.")
+    parser.add_argument("--retries", type=int, default=3, help="Attempts per batch in --pipeline mode.")
     parser.add_argument("--project", default=None, help="Ignored (not applicable for linking).")
     args = parser.parse_args(argv)
 
@@ -74,152 +436,70 @@ def main(argv: List[str]) -> int:
     summary_path = args.summary_file or os.path.join(data_path, "last_directus_link_summary.json")
 
     items = f"{base}/items"
-    login = f"{base}/auth/login"
 
     session = make_session()
 
-    # --- login ---
-    r = session.post(login, json={"email": email, "password": password}, timeout=(10, 30))
-    if r.status_code != 200:
-        print(f"Connection to Directus failed: {r.status_code} {r.text[:300]}", file=sys.stderr)
+    # --- login (reuses the token of an earlier stage of the same process) ---
+    try:
+        token = directus_auth.access_token(session, base, email, password, timeout=(10, 30))
+    except directus_auth.LoginFailed as e:
+        print(f"Connection to Directus failed: {e.status_code} {e.text[:300]}", file=sys.stderr)
         _write_summary(summary_path, {
-            "ok": False, "error": f"login_failed:{r.status_code}", "dry_run": args.dry_run
+            "ok": False, "error": f"login_failed:{e.status_code}", "dry_run": args.dry_run
         })
         return 1
 
-    token = r.json()["data"]["access_token"]
     session.headers.update({"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
 
     print("Connection to Directus successful")
 
-    # --- 1) Get only dried rows needing linking (field_data is null) ---
     dried_url = f"{items}/Dried_Samples_Data"
-    dried_params = {
-        "filter[field_data][_null]": "true",
-        # expand the related container to get its id and container_id in one query
-        "fields": "id,sample_container.id,sample_container.container_id",
-        "limit": -1,
-    }
-    dried_rows = api_get(session, dried_url, params=dried_params).get("data", [])
-
-    pending_total = len(dried_rows)
-    if pending_total == 0:
-        print("Nothing to link: no Dried_Samples_Data with field_data == null")
-        _write_summary(summary_path, {
-            "ok": True,
-            "dry_run": args.dry_run,
-            "pending": 0,
-            "prepared_updates": 0,
-            "applied_updates": 0,
-            "skipped_obs": 0,
-            "unmatched": 0,
-        })
-        return 0
-
-    # Build target list
-    sample_codes: List[str] = []
-    dried_targets: List[Tuple[int, str]] = []  # (dried_id, sample_code)
-    skipped_obs = 0
-
-    for row in dried_rows:
-        dried_id = row.get("id")
-        container = row.get("sample_container") or {}
-        sample_code = container.get("container_id")
-        if not dried_id or not sample_code:
-            continue
-        if isinstance(sample_code, str) and sample_code.startswith("obs_"):
-            skipped_obs += 1
-            continue
-        sample_codes.append(str(sample_code))
-        dried_targets.append((int(dried_id), str(sample_code)))
-
-    if not dried_targets:
-        print("Nothing to link after filtering (e.g., only obs_* present).")
-        _write_summary(summary_path, {
-            "ok": True,
-            "dry_run": args.dry_run,
-            "pending": pending_total,
-            "prepared_updates": 0,
-            "applied_updates": 0,
-            "skipped_obs": skipped_obs,
-            "unmatched": 0,
-        })
-        return 0
-
-    # --- 2) Resolve Field_Data IDs for those sample_ids (batched) ---
-    field_map: Dict[str, int] = {}
     field_url = f"{items}/Field_Data"
-    unique_codes = sorted(set(sample_codes))
-
-    for batch in chunked(unique_codes, args.batch_size):
-        params = {
-            "filter[sample_id][_in]": ",".join(batch),
-            "fields": "id,sample_id",
-            "limit": -1,
-        }
-        data = api_get(session, field_url, params=params).get("data", [])
-        for rec in data:
-            sid = rec.get("sample_id")
-            fid = rec.get("id")
-            if sid is not None and fid is not None:
-                field_map[str(sid)] = int(fid)
-
-    # --- 3) Build updates for dried rows with a matching Field_Data ID ---
-    updates = []
-    unmatched = 0
-    for dried_id, code in dried_targets:
-        fid = field_map.get(code)
-        if fid is not None:
-            updates.append({"id": dried_id, "field_data": fid})
-        else:
-            unmatched += 1
 
-    prepared = len(updates)
+    stats = LinkStats()
+    wall_start = time.monotonic()
+    if args.pipeline:
+        print(f"Pipelined linking with {args.workers} workers")
+        run_pipelined(session, dried_url, field_url, args, stats)
+    else:
+        run_serial(session, dried_url, field_url, args, stats)
+    wall = time.monotonic() - wall_start
+
+    summary: Dict[str, Any] = {
+        "ok": stats.failed_batches == 0,
+        "dry_run": args.dry_run,
+        "mode": "pipeline" if args.pipeline else "serial",
+        "pending": stats.pending,
+        "pages": stats.pages,
+        "prepared_updates": stats.prepared,
+        "applied_updates": stats.applied,
+        "skipped_obs": stats.skipped_obs,
+        "unmatched": stats.unmatched,
+        "failed_batches": stats.failed_batches,
+        # per-phase seconds; in pipeline mode phases overlap, so they can exceed wall time
+        "timings": {**{k: round(v, 3) for k, v in stats.timings.items()}, "wall": round(wall, 3)},
+    }
 
-    if prepared == 0:
+    if stats.pending == 0:
+        print("Nothing to link: no Dried_Samples_Data with field_data == null")
+    elif stats.prepared == 0:
         print("No updates to apply (no matches found).")
-        _write_summary(summary_path, {
-            "ok": True,
-            "dry_run": args.dry_run,
-            "pending": pending_total,
-            "prepared_updates": 0,
-            "applied_updates": 0,
-            "skipped_obs": skipped_obs,
-            "unmatched": unmatched,
-        })
-        return 0
-
-    if args.dry_run:
-        print(f"DRY RUN: would update {prepared} Dried_Samples_Data records.")
-        _write_summary(summary_path, {
-            "ok": True,
-            "dry_run": True,
-            "pending": pending_total,
-            "prepared_updates": prepared,
-            "applied_updates": 0,
-            "skipped_obs": skipped_obs,
-            "unmatched": unmatched,
-            # optional: list a small sample of planned updates
-            "example_updates": updates[:5],
-        })
-        return 0
-
-    # --- 4) Apply in batches ---
-    applied = 0
-    for batch in chunked(updates, args.batch_size):
-        api_patch(session, dried_url, json_body=batch)
-        applied += len(batch)
-
-    print(f"Linking finished — updated {applied} Dried_Samples_Data records.")
-    _write_summary(summary_path, {
-        "ok": True,
-        "dry_run": False,
-        "pending": pending_total,
-        "prepared_updates": prepared,
-        "applied_updates": applied,
-        "skipped_obs": skipped_obs,
-        "unmatched": unmatched,
-    })
+    elif args.dry_run:
+        print(f"DRY RUN: would update {stats.prepared} Dried_Samples_Data records.")
+        # optional: list a small sample of planned updates
+        summary["example_updates"] = stats.example_updates
+    else:
+        print(f"Linking finished — updated {stats.applied} Dried_Samples_Data records.")
+
+    print(
+        "Timings: "
+        + ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in summary["timings"].items())
+    )
+    _write_summary(summary_path, summary)
+    metrics.count("links", stats.applied)
+    if stats.failed_batches:
+        print(f"{stats.failed_batches} batch(es) failed after retries — see log above.", file=sys.stderr)
+        return 1
     return 0
 
 
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Watch QFieldCloud and run the pipeline as soon as a project changes.
+
+From cron, every launcher.sh run logs into QFieldCloud, lists the files of every
+project and, most of the time, finds nothing new. This daemon logs in once and
+keeps the sdk.Client, with the HTTP connections of its session, for its whole
+life. Each project is polled (one file listing) on its own schedule:
+
+- a project starts at --min-interval; every poll that finds its files unchanged
+  multiplies its interval by --backoff, up to --max-interval;
+- a project whose files changed since the previous poll goes back to
+  --min-interval, as more uploads usually follow;
+- the project list is refreshed every --list-interval, for new and deleted projects.
+
+A project is queued when its GPKG checksums differ from DATA_PATH/state.json,
+the rule of the fetcher's incremental mode. The queue is processed by
+`pipeline.py --overlap` in a child process: its fetcher downloads the changed
+projects, and only the projects it fetched go through the downstream chains.
+One run at a time: projects that change meanwhile wait for the next one. After
+a failed run, the next one waits --retry-after seconds.
+
+GET /status on 127.0.0.1:--status-port returns the queue, the running and last
+runs and, per project, its interval, last poll and last seen change, as JSON.
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import typing
+from dataclasses import dataclass
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+from qfieldcloud_sdk import sdk  # type: ignore[import-untyped]
+
+from qfieldcloud_fetcher import fetcher
+
+# Loads environment variables
+load_dotenv()
+
+# Access the environment variables
+instance = os.getenv("QFIELDCLOUD_INSTANCE")
+username = os.getenv("QFIELDCLOUD_USERNAME")
+password = os.getenv("QFIELDCLOUD_PASSWORD")
+data_path = os.getenv("DATA_PATH")
+logs_path = os.getenv("LOGS_PATH")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# How often a running pipeline is checked for completion
+RUN_CHECK_S = 5.0
+# Shortest sleep of the main loop
+MIN_SLEEP_S = 1.0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Poll QFieldCloud projects with adaptive intervals and run the pipeline for the changed ones."
+    )
+    parser.add_argument(
+        "--min-interval",
+        type=float,
+        default=float(os.getenv("FETCH_DAEMON_MIN_INTERVAL") or 60),
+        help="Seconds between two polls of a project that just changed (default: FETCH_DAEMON_MIN_INTERVAL or 60).",
+    )
+    parser.add_argument(
+        "--max-interval",
+        type=float,
+        default=float(os.getenv("FETCH_DAEMON_MAX_INTERVAL") or 1800),
+        help="Longest interval of an idle project (default: FETCH_DAEMON_MAX_INTERVAL or 1800).",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=2.0,
+        help="Factor applied to a project's interval after each poll without changes (default: 2).",
+    )
+    parser.add_argument(
+        "--list-interval",
+        type=float,
+        default=600.0,
+        help="Seconds between two refreshes of the project list (default: 600).",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=900.0,
+        help="Seconds to wait after a failed pipeline run before the next one (default: 900).",
+    )
+    parser.add_argument(
+        "--status-port",
+        type=int,
+        default=int(os.getenv("FETCH_DAEMON_PORT") or 8765),
+        help="Port of the status endpoint on 127.0.0.1, 0 to disable (default: FETCH_DAEMON_PORT or 8765).",
+    )
+    parser.add_argument(
+        "--state-file",
+        default=None,
+        help="Fetcher state file the checksums are compared to (defaults to DATA_PATH/state.json).",
+    )
+    return parser.parse_args(argv)
+
+
+def iso(ts: float | None) -> str | None:
+    return datetime.fromtimestamp(ts).astimezone().isoformat(timespec="seconds") if ts else None
+
+
+@dataclass
+class ProjectWatch:
+    """Polling schedule of one project."""
+
+    project_id: str
+    name: str
+    interval: float
+    next_poll: float
+    last_poll: float | None = None
+    # Last time its files differed from the previous poll
+    last_change: float | None = None
+    # (file name, md5) of the previous listing
+    files: frozenset[tuple[str, str]] | None = None
+    polls: int = 0
+    errors: int = 0
+
+
+@dataclass
+class PipelineRun:
+    # subprocess.Popen, or anything with poll() and wait()
+    process: typing.Any
+    projects: list[str]
+    start: float
+
+
+class Watcher:
+    """
+    The polling schedules, the queue of changed projects and the pipeline run.
+    tick() is called by the main loop, status() by the threads of the status server.
+    """
+
+    def __init__(
+        self,
+        connect: typing.Callable[[], typing.Any],
+        start_run: typing.Callable[[], typing.Any],
+        state_path: str,
+        files_base: str,
+        min_interval: float = 60.0,
+        max_interval: float = 1800.0,
+        backoff: float = 2.0,
+        list_interval: float = 600.0,
+        retry_after: float = 900.0,
+    ):
+        self.connect = connect
+        self.start_run = start_run
+        self.state_path = state_path
+        self.files_base = files_base
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.list_interval = list_interval
+        self.retry_after = retry_after
+        self.client: typing.Any = None
+        # by project id
+        self.projects: dict[str, ProjectWatch] = {}
+        # ids of the changed projects waiting for a run
+        self.queue: list[str] = []
+        self.run: PipelineRun | None = None
+        self.last_run: dict[str, typing.Any] | None = None
+        self.next_listing = 0.0
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+
+    def _client(self) -> typing.Any:
+        # Logged in once, and again after a failed request (e.g. an expired token)
+        if self.client is None:
+            self.client = self.connect()
+        return self.client
+
+    def refresh_projects(self, now: float) -> None:
+        try:
+            listed = {p["id"]: p["name"] for p in self._client().list_projects()}
+        except Exception as e:
+            print(f"Listing projects failed: {e}")
+            self.client = None
+            self.next_listing = now + self.min_interval
+            return
+        with self.lock:
+            for pid, name in listed.items():
+                if pid in self.projects:
+                    self.projects[pid].name = name
+                else:
+                    self.projects[pid] = ProjectWatch(pid, name, self.min_interval, next_poll=now)
+            for pid in set(self.projects) - set(listed):
+                print(f"{self.projects.pop(pid).name}: no longer on QFieldCloud")
+                if pid in self.queue:
+                    self.queue.remove(pid)
+            self.next_listing = now + self.list_interval
+
+    def _schedule(self, watch: ProjectWatch, now: float, active: bool) -> None:
+        watch.interval = self.min_interval if active else min(self.max_interval, watch.interval * self.backoff)
+        watch.next_poll = now + watch.interval
+
+    def changed(self, project_id: str, name: str, listing: frozenset[tuple[str, str]]) -> bool:
+        """Whether the fetcher would download the project again (its incremental mode)."""
+        state_files = fetcher.load_state(self.state_path).get("files", {})
+        if not state_files:
+            return True
+        gpkgs = {
+            f"{self.files_base}{project_id}/{file_name}": md5
+            for file_name, md5 in listing
+            if fetcher.is_project_gpkg(file_name)
+        }
+        preview = fetcher.build_preview(
+            {project_id: name},
+            {project_id: list(gpkgs)},
+            {url: md5 for url, md5 in gpkgs.items() if md5},
+            {},
+            fetcher.previous_gpkgs(state_files),
+        )
+        return bool(preview[project_id]["changed"])
+
+    def poll(self, watch: ProjectWatch, now: float) -> None:
+        try:
+            files = self._client().list_remote_files(project_id=watch.project_id)
+        except Exception as e:
+            print(f"{watch.name}: listing files failed: {e}")
+            self.client = None
+            with self.lock:
+                watch.errors += 1
+                self._schedule(watch, now, active=False)
+            return
+        listing = frozenset((f.get("name", ""), fetcher.extract_md5_and_version(f)[0] or "") for f in files)
+        changed = self.changed(watch.project_id, watch.name, listing)
+        with self.lock:
+            first = watch.files is None
+            active = listing != watch.files if not first else changed
+            if active:
+                watch.last_change = now
+            watch.files = listing
+            watch.last_poll = now
+            watch.polls += 1
+            running = self.run is not None and watch.name in self.run.projects
+            if changed and not running and watch.project_id not in self.queue:
+                self.queue.append(watch.project_id)
+                print(f"{watch.name}: changed, queued ({len(self.queue)} waiting)")
+            self._schedule(watch, now, active)
+
+    def check_run(self, now: float) -> None:
+        if self.run is None or (status := self.run.process.poll()) is None:
+            return
+        with self.lock:
+            run, self.run = self.run, None
+            self.last_run = {
+                "projects": run.projects,
+                "start": iso(run.start),
+                "end": iso(now),
+                "status": "ok" if status == 0 else "failed",
+                "exit_status": status,
+            }
+            if status != 0:
+                self.retry_at = now + self.retry_after
+            # Compared to the state the run left behind at their next poll
+            for watch in self.projects.values():
+                if watch.name in run.projects:
+                    watch.next_poll = now
+        print(f"Pipeline {self.last_run['status']} (exit status {status}) for {', '.join(run.projects)}")
+
+    def start_if_queued(self, now: float) -> None:
+        if self.run is not None or not self.queue or now < self.retry_at:
+            return
+        with self.lock:
+            projects = [self.projects[pid].name for pid in self.queue]
+            try:
+                process = self.start_run()
+            except OSError as e:
+                print(f"Starting the pipeline failed: {e}")
+                self.retry_at = now + self.retry_after
+                return
+            self.queue.clear()
+            self.run = PipelineRun(process, projects, now)
+        print(f"Pipeline started for {', '.join(projects)}")
+
+    def tick(self, now: float) -> float:
+        """Poll what is due, reap or start the pipeline. Returns the seconds until something is due again."""
+        self.check_run(now)
+        if now >= self.next_listing:
+            self.refresh_projects(now)
+        for watch in [watch for watch in self.projects.values() if watch.next_poll <= now]:
+            self.poll(watch, now)
+        self.start_if_queued(now)
+
+        due = [self.next_listing, *(watch.next_poll for watch in self.projects.values())]
+        if self.queue and self.run is None:
+            due.append(self.retry_at)
+        delay = min(due) - now
+        if self.run is not None:
+            delay = min(delay, RUN_CHECK_S)
+        return max(delay, 0.0)
+
+    def status(self, now: float) -> dict[str, typing.Any]:
+        with self.lock:
+            running = None
+            if self.run is not None:
+                running = {
+                    "projects": self.run.projects,
+                    "start": iso(self.run.start),
+                    "pid": getattr(self.run.process, "pid", None),
+                }
+            return {
+                "now": iso(now),
+                "queue_depth": len(self.queue),
+                "queue": [self.projects[pid].name for pid in self.queue],
+                "running": running,
+                "last_run": self.last_run,
+                "retry_at": iso(self.retry_at) if self.retry_at > now else None,
+                "projects": {
+                    watch.name: {
+                        "id": watch.project_id,
+                        "queued": watch.project_id in self.queue,
+                        "interval_s": round(watch.interval, 1),
+                        "last_poll": iso(watch.last_poll),
+                        "next_poll": iso(watch.next_poll),
+                        "last_seen_change": iso(watch.last_change),
+                        "polls": watch.polls,
+                        "errors": watch.errors,
+                    }
+                    for watch in sorted(self.projects.values(), key=lambda watch: watch.name.lower())
+                },
+            }
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    watcher: Watcher
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] not in ("/", "/status"):
+            self.send_error(404)
+            return
+        body = json.dumps(self.watcher.status(time.time()), indent=2).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: typing.Any) -> None:
+        # One line per request would drown the daemon's own output
+        pass
+
+
+def serve_status(watcher: Watcher, port: int) -> ThreadingHTTPServer:
+    """Serve the watcher's status on 127.0.0.1:port, from a background thread."""
+    handler = type("Handler", (StatusHandler,), {"watcher": watcher})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, name="status", daemon=True).start()
+    return server
+
+
+def connect() -> typing.Any:
+    client = sdk.Client(url=f"{instance}/api/v1/")
+    credentials = client.login(username=username, password=password)
+    if not credentials.get("token"):
+        raise RuntimeError("Could not authenticate with the server")
+    return client
+
+
+def start_pipeline() -> subprocess.Popen:
+    """Start `pipeline.py --overlap`, appending its console output to LOGS_PATH/fetch_daemon_pipeline.log."""
+    command = [sys.executable, "-m", "qfieldcloud_fetcher.pipeline", "--overlap"]
+    if not logs_path:
+        return subprocess.Popen(
+            command, cwd=REPO_ROOT, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    os.makedirs(logs_path, exist_ok=True)
+    with open(os.path.join(logs_path, "fetch_daemon_pipeline.log"), "a", encoding="utf-8") as log:
+        log.write(f"--- {datetime.now().isoformat(timespec='seconds')} pipeline.py --overlap\n")
+        log.flush()
+        return subprocess.Popen(command, cwd=REPO_ROOT, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    if not all([instance, username, password, data_path]):
+        raise SystemExit(
+            "Missing env vars: QFIELDCLOUD_INSTANCE, QFIELDCLOUD_USERNAME, QFIELDCLOUD_PASSWORD, DATA_PATH"
+        )
+    # With --overlap the fetcher drops --interactive and downloads the changed projects; a dry-run would
+    # leave them changed and start the same run over and over
+    if os.getenv("FETCHER_DEFAULT_MODE") == "dry-run":
+        raise SystemExit("FETCHER_DEFAULT_MODE=dry-run: the daemon needs a fetcher that downloads")
+
+    watcher = Watcher(
+        connect,
+        start_pipeline,
+        args.state_file or os.path.join(str(data_path), "state.json"),
+        f"{instance}/api/v1/files/",
+        min_interval=args.min_interval,
+        max_interval=args.max_interval,
+        backoff=args.backoff,
+        list_interval=args.list_interval,
+        retry_after=args.retry_after,
+    )
+    server = serve_status(watcher, args.status_port) if args.status_port else None
+    if server:
+        print(f"Status: http://127.0.0.1:{server.server_address[1]}/status")
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+    while not stop.is_set():
+        stop.wait(max(watcher.tick(time.time()), MIN_SLEEP_S))
+
+    print("Stopping")
+    if server:
+        server.shutdown()
+    if watcher.run is not None:
+        print(f"Waiting for the running pipeline to finish (pid {watcher.run.process.pid})")
+        watcher.run.process.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,6 +17,7 @@ from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from qfieldcloud_sdk import sdk  # type: ignore[import-untyped]
 
+from qfieldcloud_fetcher import delta_ingest, metrics, tracing
 from qfieldcloud_fetcher.fs_utils import require_directory_access, require_replaceable_tree
 
 PLAIN_MD5_HEX_LEN = 32
@@ -25,7 +26,7 @@ PLAIN_MD5_HEX_LEN = 32
 # ---------------------------
 # CLI & state
 # ---------------------------
-def parse_args():
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     p = argparse.ArgumentParser(
         description="Fetch QFieldCloud projects. In incremental mode, if any GPKG changes in a project, re-download the whole project. Starts with a clean per-project dir."
     )
@@ -65,7 +66,19 @@ def parse_args():
         action="store_true",
         help="Also wipe local pictures for selected projects before fetching.",
     )
-    return p.parse_args()
+    p.add_argument(
+        "--deltas",
+        action="store_true",
+        help="Apply the project's QFieldCloud deltas to the local GPKGs instead of re-downloading them "
+        "(falls back to a full download when they are unavailable or inconsistent).",
+    )
+    p.add_argument(
+        "--events-dir",
+        default=None,
+        help="Publish a 'fetched' event (<dir>/<project>.json) as soon as a project's GPKGs and pictures "
+        "are downloaded, so that downstream stages can start before the whole fetch is done.",
+    )
+    return p.parse_args(argv)
 
 
 def utcnow_iso() -> str:
@@ -97,6 +110,27 @@ def atomic_write_text(path: str, content: str) -> None:
     os.replace(tmp, path)
 
 
+def clear_events(events_dir: str) -> None:
+    """Drop the events of the previous run."""
+    os.makedirs(events_dir, exist_ok=True)
+    for name in os.listdir(events_dir):
+        if name.endswith(".json"):
+            os.remove(os.path.join(events_dir, name))
+
+
+def publish_fetched(events_dir: str, project_name: str, project_id: str, downloaded_files: int) -> None:
+    """'fetched' event: the project's GPKGs and pictures are complete on disk."""
+    event = {
+        "project": project_name,
+        "project_id": project_id,
+        "downloaded_files": downloaded_files,
+        "fetched_at": utcnow_iso(),
+    }
+    atomic_write_text(
+        os.path.join(events_dir, f"{project_name}.json"), json.dumps(event, indent=2, sort_keys=True) + "\n"
+    )
+
+
 # ---------------------------
 # HTTP session & downloader
 # ---------------------------
@@ -138,6 +172,7 @@ def is_plain_md5(value: Optional[str]) -> bool:
     return all(c in "0123456789abcdefABCDEF" for c in value)
 
 
+@tracing.traced("download")
 def download_with_retries(
     url: str,
     dest_path: str,
@@ -156,6 +191,8 @@ def download_with_retries(
     """
     headers_base = {"Authorization": auth_header, "Accept": "*/*"}
     tmp_path = dest_path + ".part"
+    span = tracing.current()
+    span.set_attributes({"url.full": url.split("?")[0], "file.path": dest_path, "file.expected_size": expected_size})
 
     for attempt in range(1, max_attempts + 1):
         try:
@@ -203,6 +240,7 @@ def download_with_retries(
                     raise IOError(f"MD5 mismatch: got {local_md5}, expected {expected_md5}")
 
             os.replace(tmp_path, dest_path)
+            span.set_attributes({"file.size": os.path.getsize(dest_path), "download.attempts": attempt})
             print(f"Downloaded {url}")
             return True
 
@@ -213,7 +251,9 @@ def download_with_retries(
             requests.exceptions.ConnectionError,
             IOError,
         ) as e:
+            span.add_event("retry", attempt=attempt, error=str(e))
             if attempt >= max_attempts:
+                span.set_error(f"giving up after {attempt} attempts: {e}")
                 print(f"ERROR: {e} (giving up) for {url}")
                 with suppress(Exception):
                     os.remove(tmp_path)
@@ -247,6 +287,24 @@ def url_project_id(file_url: str) -> Optional[str]:
         return None
 
 
+def is_project_gpkg(file_name: str) -> bool:
+    """The GPKGs whose checksums decide whether a project changed (basemaps excluded)."""
+    return file_name.endswith(".gpkg") and "map" not in file_name
+
+
+def previous_gpkgs(state_files: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, str]]:
+    """project id -> {GPKG url: md5} of the last fetch, from the state file."""
+    prev_gpkg_by_project: Dict[str, Dict[str, str]] = {}
+    for url, info in state_files.items():
+        if not url.endswith(".gpkg"):
+            continue
+        pid = url_project_id(url)
+        if not pid:
+            continue
+        prev_gpkg_by_project.setdefault(pid, {})[url] = (info.get("md5") or "")
+    return prev_gpkg_by_project
+
+
 def jpg_layer_and_file_name(file_name_or_url: str) -> Tuple[str, str]:
     if "/DCIM/" in file_name_or_url:
         after_dcim = file_name_or_url.split("/DCIM/", 1)[1]
@@ -362,8 +420,88 @@ def append_manifest(path: str, entry: dict) -> None:
 # ---------------------------
 # Main logic
 # ---------------------------
-def main():
-    args = parse_args()
+@tracing.traced("fetch project")
+def fetch_project(
+    pid: str,
+    pname: str,
+    gpkg_dir: str,
+    jpg_base: str,
+    gpkg_urls: list[str],
+    jpg_urls_by_layer: Dict[str, list[str]],
+    gpkg_md5_by_url: Dict[str, str],
+    meta_by_url: Dict[str, Dict[str, Any]],
+    auth_header: str,
+    manifest: str,
+    new_state_files: Dict[str, Dict[str, Any]],
+    download_gpkgs: bool = True,
+) -> Tuple[int, bool, bool]:
+    """
+    Download one project's GPKGs and pictures. Downloaded GPKGs are recorded in
+    new_state_files, pictures are queued in the manifest for remote deletion.
+    Returns (downloaded files, GPKGs ok, pictures ok).
+    """
+    tracing.current().set_attributes({"pipeline.project": pname, "qfieldcloud.project_id": pid})
+    os.makedirs(gpkg_dir, exist_ok=True)
+    os.makedirs(jpg_base, exist_ok=True)
+    downloaded_files = 0
+    gpkgs_ok = pictures_ok = True
+
+    # GPKGs
+    for file_url in gpkg_urls if download_gpkgs else []:
+        filename = os.path.basename(file_url)
+        dest = os.path.join(gpkg_dir, filename)
+        remote_md5 = gpkg_md5_by_url.get(file_url)
+        remote_size = meta_by_url.get(file_url, {}).get("size")
+        ok = download_with_retries(file_url, dest, auth_header, remote_md5, remote_size)
+        if ok:
+            downloaded_files += 1
+            new_state_files[file_url] = {"md5": (remote_md5 or file_md5(dest)), "downloaded_at": utcnow_iso()}
+        else:
+            gpkgs_ok = False
+
+    # Prepare layer subdirs by GPKG stems
+    stems = [os.path.splitext(os.path.basename(u))[0] for u in gpkg_urls]
+    layer_dirs = {s: os.path.join(jpg_base, s) for s in stems}
+    for d in layer_dirs.values():
+        os.makedirs(d, exist_ok=True)
+
+    # JPGs (download all) — queue remote delete for finalizer (no deletion here)
+    for layer_name, urls in jpg_urls_by_layer.items():
+        save_dir = layer_dirs.get(layer_name) or os.path.join(jpg_base, layer_name)
+        os.makedirs(save_dir, exist_ok=True)
+        for file_url in urls:
+            _remote_layer_name, file_name = jpg_layer_and_file_name(file_url)
+            dest = os.path.join(save_dir, file_name.replace("/", "_"))
+
+            meta = meta_by_url.get(file_url, {})
+            remote_md5 = meta.get("md5")
+            remote_size = meta.get("size")
+            ok = download_with_retries(file_url, dest, auth_header, remote_md5, remote_size)
+            if ok:
+                downloaded_files += 1
+                name_in_project = meta.get("name") or os.path.join("DCIM", layer_name, file_name)
+                append_manifest(
+                    manifest,
+                    {
+                        "project_id": pid,
+                        "project_name": pname,
+                        "remote_name": name_in_project,
+                        "remote_md5": remote_md5,
+                        "local_path": dest,
+                        "queued_at": utcnow_iso(),
+                    },
+                )
+            else:
+                pictures_ok = False
+
+    tracing.current().set_attribute("pipeline.files", downloaded_files)
+    if not (gpkgs_ok and pictures_ok):
+        tracing.current().set_error("some downloads failed")
+    return downloaded_files, gpkgs_ok, pictures_ok
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
 
     load_dotenv()
     instance = os.getenv("QFIELDCLOUD_INSTANCE")
@@ -382,10 +520,14 @@ def main():
     # ✳️ marker & summary
     marker_path = os.path.join(data_path, ".qfc_changed")
     summary_path = os.path.join(data_path, "last_fetch_summary.json")
+    if args.events_dir:
+        clear_events(args.events_dir)
 
     state_path = args.state_file or os.path.join(data_path, "state.json")
     state = load_state(state_path)
     state_files: Dict[str, Dict[str, Any]] = state.get("files", {})
+    # project id -> watermark of the last delta contained in the local GPKGs
+    delta_state: Dict[str, Dict[str, Any]] = state.get("deltas", {})
 
     # Connect
     client = sdk.Client(url=f"{api_base}")
@@ -411,7 +553,7 @@ def main():
         gpkg_urls: list[str] = []
         for f in project_files:
             fname = f.get("name", "")
-            if fname.endswith(".gpkg") and "map" not in fname:
+            if is_project_gpkg(fname):
                 file_url = f"{files_base}{proj_id}/{fname}"
                 md5, vid = extract_md5_and_version(f)
                 if md5:
@@ -432,14 +574,7 @@ def main():
         jpg_urls_by_project[proj_id] = by_layer
 
     # Detect previous md5 snapshot per project (GPKGs only)
-    prev_gpkg_by_project: Dict[str, Dict[str, str]] = {}
-    for url, info in state_files.items():
-        if not url.endswith(".gpkg"):
-            continue
-        pid = url_project_id(url)
-        if not pid:
-            continue
-        prev_gpkg_by_project.setdefault(pid, {})[url] = (info.get("md5") or "")
+    prev_gpkg_by_project = previous_gpkgs(state_files)
 
     # Build preview (name, counts, changed flags)
     preview = build_preview(
@@ -557,16 +692,36 @@ def main():
     os.makedirs(in_gpkg_path, exist_ok=True)
     os.makedirs(in_jpg_path, exist_ok=True)
 
+    # Bring projects up to date from their deltas where possible (their GPKGs are kept)
+    delta_ingested: set[str] = set()
+    if args.deltas:
+        for pid in projects_to_fetch:
+            pname = proj_id_to_name[pid]
+            try:
+                watermark, counts = delta_ingest.ingest_project(
+                    SESSION, api_base, pid, os.path.join(in_gpkg_path, pname), delta_state.get(pid), auth_header
+                )
+            except delta_ingest.DeltaError as e:
+                print(f"{pname}: full GPKG download ({e})")
+                continue
+            delta_state[pid] = watermark
+            delta_ingested.add(pid)
+            print(
+                f"{pname}: deltas applied (created={counts['created']}, patched={counts['patched']}, "
+                f"deleted={counts['deleted']})"
+            )
+
     # Clean only the selected projects' subdirs
     for pid in projects_to_fetch:
         pname = proj_id_to_name[pid]
         gpkg_dir = os.path.join(in_gpkg_path, pname)
-        require_replaceable_tree(
-            Path(gpkg_dir),
-            f"replace local GPKG directory for project '{pname}'",
-        )
-        with suppress(FileNotFoundError):
-            shutil.rmtree(gpkg_dir)
+        if pid not in delta_ingested:
+            require_replaceable_tree(
+                Path(gpkg_dir),
+                f"replace local GPKG directory for project '{pname}'",
+            )
+            with suppress(FileNotFoundError):
+                shutil.rmtree(gpkg_dir)
         os.makedirs(gpkg_dir, exist_ok=True)
 
         jpg_dir = os.path.join(in_jpg_path, pname)
@@ -617,58 +772,38 @@ def main():
 
     for pid in projects_to_fetch:
         pname = proj_id_to_name[pid]
-        gpkg_dir = os.path.join(in_gpkg_path, pname)
-        jpg_base = os.path.join(in_jpg_path, pname)
-        os.makedirs(gpkg_dir, exist_ok=True)
-        os.makedirs(jpg_base, exist_ok=True)
-
-        # GPKGs
-        for file_url in gpkg_urls_by_project.get(pid, []):
-            filename = os.path.basename(file_url)
-            dest = os.path.join(gpkg_dir, filename)
-            remote_md5 = gpkg_md5_by_url.get(file_url)
-            remote_size = meta_by_url.get(file_url, {}).get("size")
-            ok = download_with_retries(file_url, dest, auth_header, remote_md5, remote_size)
-            if ok:
-                downloaded_files += 1
-                new_state_files[file_url] = {"md5": (remote_md5 or file_md5(dest)), "downloaded_at": utcnow_iso()}
-            else:
-                all_ok = False
-
-        # Prepare layer subdirs by GPKG stems
-        stems = [os.path.splitext(os.path.basename(u))[0] for u in gpkg_urls_by_project.get(pid, [])]
-        layer_dirs = {s: os.path.join(jpg_base, s) for s in stems}
-        for d in layer_dirs.values():
-            os.makedirs(d, exist_ok=True)
-
-        # JPGs (download all) — queue remote delete for finalizer (no deletion here)
-        for layer_name, urls in jpg_urls_by_project.get(pid, {}).items():
-            save_dir = layer_dirs.get(layer_name) or os.path.join(jpg_base, layer_name)
-            os.makedirs(save_dir, exist_ok=True)
-            for file_url in urls:
-                _remote_layer_name, file_name = jpg_layer_and_file_name(file_url)
-                dest = os.path.join(save_dir, file_name.replace("/", "_"))
-
-                meta = meta_by_url.get(file_url, {})
-                remote_md5 = meta.get("md5")
-                remote_size = meta.get("size")
-                ok = download_with_retries(file_url, dest, auth_header, remote_md5, remote_size)
-                if ok:
-                    downloaded_files += 1
-                    name_in_project = meta.get("name") or os.path.join("DCIM", layer_name, file_name)
-                    append_manifest(
-                        manifest,
-                        {
-                            "project_id": pid,
-                            "project_name": pname,
-                            "remote_name": name_in_project,
-                            "remote_md5": remote_md5,
-                            "local_path": dest,
-                            "queued_at": utcnow_iso(),
-                        },
-                    )
-                else:
-                    all_ok = False
+        if args.deltas and pid not in delta_ingested:
+            # Listed before the download so that no delta applied in between is skipped later
+            try:
+                delta_state[pid] = delta_ingest.make_watermark(
+                    delta_ingest.list_deltas(SESSION, api_base, pid, auth_header)
+                )
+            except delta_ingest.DeltaError as e:
+                print(f"{pname}: no delta watermark, next run downloads in full again ({e})")
+                delta_state.pop(pid, None)
+
+        project_files, gpkgs_ok, pictures_ok = fetch_project(
+            pid,
+            pname,
+            os.path.join(in_gpkg_path, pname),
+            os.path.join(in_jpg_path, pname),
+            gpkg_urls_by_project.get(pid, []),
+            jpg_urls_by_project.get(pid, {}),
+            gpkg_md5_by_url,
+            meta_by_url,
+            auth_header,
+            manifest,
+            new_state_files,
+            # Already patched in place when the deltas were applied
+            download_gpkgs=pid not in delta_ingested,
+        )
+        downloaded_files += project_files
+        if not gpkgs_ok:
+            delta_state.pop(pid, None)
+        if not (gpkgs_ok and pictures_ok):
+            all_ok = False
+        elif args.events_dir:
+            publish_fetched(args.events_dir, pname, pid, project_files)
 
     # Update state to current snapshot (GPKGs only)
     for pid, urls in gpkg_urls_by_project.items():
@@ -679,6 +814,8 @@ def main():
 
     state["files"] = new_state_files
     state["last_pull"] = utcnow_iso()
+    if args.deltas:
+        state["deltas"] = delta_state
     save_state(state, state_path)
 
     # Write summary + marker
@@ -688,8 +825,11 @@ def main():
         "had_changes": had_changes,
         "projects_selected": [proj_id_to_name[p] for p in projects_to_fetch],
         "downloaded_files": downloaded_files,
+        "delta_projects": [proj_id_to_name[p] for p in projects_to_fetch if p in delta_ingested],
         "manifest": manifest,
     }
+    metrics.count("projects", len(projects_to_fetch))
+    metrics.count("files", downloaded_files)
     with open(summary_path, "w", encoding="utf-8") as f:
         json.dump(summary, f, indent=2)
 
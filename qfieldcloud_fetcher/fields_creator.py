@@ -1,10 +1,16 @@
 import argparse
+import hashlib
+import json
 import os
+from datetime import datetime, timezone
 
 import pandas as pd
 import requests
 from dotenv import load_dotenv
 
+from qfieldcloud_fetcher import directus_auth, metrics, table_io
+from qfieldcloud_fetcher.stage_cache import StageCache
+
 # Loads .env variables
 load_dotenv()
 
@@ -16,127 +22,330 @@ data_path = os.getenv("DATA_PATH")
 
 # Construct folders paths
 out_csv_path = f"{data_path}/formatted_csv"
+schema_state_path = f"{data_path}/fields_schema_state.json"
+
+# Rows read per CSV to infer column types (0 reads whole files)
+SCHEMA_SAMPLE_ROWS = 1000
 
-def parse_args() -> argparse.Namespace:
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Create or update Directus fields based on formatted CSVs.")
     parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
-    return parser.parse_args()
+    parser.add_argument(
+        "--sample-rows",
+        type=int,
+        default=SCHEMA_SAMPLE_ROWS,
+        help="Rows read per CSV to infer column types (0 reads whole files).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help=(
+            "Inspect every project and sync with Directus, even if the GPKGs or the schema fingerprint "
+            "match the last successful sync."
+        ),
+    )
+    return parser.parse_args(argv)
+
+
+# Mapping pandas dtypes to Directus types
+PANDAS_TO_DIRECTUS = {
+    "int64": "integer",
+    "float64": "float",
+    "object": "string",
+    "bool": "boolean",
+    "datetime64[ns]": "datetime",
+    "timedelta64[ns]": "duration",
+}
+
+collection_name = "Field_Data"
+
+
+def directus_type(dtype: str) -> str:
+    """Directus type for a pandas dtype name, including nullable and sized dtypes (Int64, float32, string)."""
+    if dtype in PANDAS_TO_DIRECTUS:
+        return PANDAS_TO_DIRECTUS[dtype]
+    name = dtype.lower()
+    if name.startswith(("int", "uint")):
+        return "integer"
+    if name.startswith("float"):
+        return "float"
+    if name.startswith("bool"):
+        return "boolean"
+    if name.startswith("datetime64"):
+        return "datetime"
+    if name.startswith("timedelta64"):
+        return "duration"
+    return "string"
+
+
+def sample_column_dtypes(path: str, sample_rows: int) -> dict[str, str | None]:
+    """
+    Infer {column: pandas dtype} from the header plus the first sample_rows rows
+    (None for columns that are entirely null). When the file is longer than the
+    sample, columns whose type could still change further down (all-null, integer,
+    float or boolean so far) are re-read in full with usecols, so the result matches a
+    full read without parsing every column of every file.
+    """
+    df = table_io.read_table(path, nrows=sample_rows if sample_rows > 0 else None, schema="field_data")
+    if df.empty:
+        return {}
+
+    dtypes: dict[str, str | None] = {
+        column: None if df[column].isnull().all() else str(df[column].dtype) for column in df.columns
+    }
+    # Parquet keeps the column types, only CSV samples can be ambiguous
+    if sample_rows <= 0 or len(df) < sample_rows or not path.endswith(".csv"):
+        return dtypes
+
+    ambiguous = [column for column, dtype in dtypes.items() if dtype in (None, "int64", "float64", "bool")]
+    if ambiguous:
+        full = table_io.read_table(path, columns=ambiguous, schema="field_data")
+        for column in ambiguous:
+            dtypes[column] = None if full[column].isnull().all() else str(full[column].dtype)
+    return dtypes
+
+
+def infer_field_types(
+    project_filter: str | None, sample_rows: int = SCHEMA_SAMPLE_ROWS, projects: list[str] | None = None
+) -> tuple[dict[str, str], int]:
+    """Union of the column types of the formatted tables, restricted to `projects` when given."""
+    # Create an empty dictionary to store the column types
+    field_types: dict[str, str] = {}
+
+    file_count = 0
+    # Iterate over all formatted tables in the input folder and its subdirectories
+    for project, filename, constructed_path in table_io.iter_tables(out_csv_path, project_filter):
+        if projects is not None and project not in projects:
+            continue
+        # Ignore old layer without sample_id
+        if table_io.table_stem(filename) != "SBL_20004_2022_EPSG:4326":
+            file_count += 1
+            print(f"Inspecting {constructed_path}")
+            try:
+                dtypes = sample_column_dtypes(constructed_path, sample_rows)
+            except pd.errors.EmptyDataError:
+                dtypes = {}
+
+            # Skip empty files
+            if not dtypes:
+                continue
+
+            # Add qfield project column (always filled by db_updater)
+            dtypes["qfield_project"] = "object"
+
+            # Iterate over all columns of the union schema
+            for column, dtype in dtypes.items():
+                # Skip columns with all null values
+                if dtype is None:
+                    continue
+
+                # Replace dots with underscores
+                new_column = column.replace(".", "_").replace("(", "").replace(")", "")
+
+                # Add types to dictionary if not already present
+                if new_column not in field_types:
+                    if new_column.__contains__("comment"):
+                        column_type = "text"
+                    elif new_column.__contains__("geometry"):
+                        column_type = "geometry.Point"
+                    elif new_column.__contains__("date"):
+                        column_type = "bigInteger"
+                    else:
+                        column_type = directus_type(dtype)
+
+                    field_types[new_column] = column_type
+
+    return field_types, file_count
+
+
+def schema_fingerprint(field_types: dict[str, str]) -> str:
+    return hashlib.sha256(json.dumps(field_types, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_schema_state(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            state: dict = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return state
+
+
+def save_schema_state(state: dict, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
 
 
-def main() -> None:
-    args = parse_args()
+def schema_already_synced(field_types: dict[str, str], state: dict) -> bool:
+    """True when the last successful sync already covered every inferred field with the same type."""
+    if state.get("collection") != collection_name:
+        return False
+    if state.get("fingerprint") == schema_fingerprint(field_types):
+        return True
+    synced = state.get("fields") or {}
+    return all(synced.get(key) == value for key, value in field_types.items())
+
+
+def record_projects(cache: StageCache, projects: list[str]) -> None:
+    for project in projects:
+        cache.record(project)
+    cache.save()
+
+
+def fetch_existing_fields(session: requests.Session, headers: dict[str, str]) -> dict[str, str]:
+    """Return {field: type} for every field Directus already knows in the collection (one request)."""
+    response = session.get(f"{directus_instance}/fields/{collection_name}", headers=headers)
+    if response.status_code != 200:
+        print(f"Error listing fields of {collection_name}: {response.status_code} - {response.text}")
+        raise SystemExit(1)
+    return {item["field"]: item.get("type") for item in response.json().get("data", [])}
+
+
+def diff_fields(
+    inferred: dict[str, str], existing: dict[str, str]
+) -> tuple[dict[str, str], dict[str, tuple[str, str]]]:
+    """
+    Compare the inferred schema with the fields already in Directus.
+    Returns the fields to create and the existing fields whose type differs
+    (reported only; existing fields are never altered).
+    """
+    missing = {key: value for key, value in inferred.items() if key not in existing}
+    mismatched = {}
+    for key, value in inferred.items():
+        current = existing.get(key)
+        # Directus reports geometry.Point fields with type "geometry"
+        if current is not None and current != value and current != value.split(".")[0]:
+            mismatched[key] = (value, current)
+    return missing, mismatched
+
+
+def geometry_validation(key: str) -> dict:
+    # If field is of type geometry.Point, add a validation to correctly display map
+    return {"validation": {"_and": [{key: {"_intersects_bbox": None}}]}}
+
+
+def add_geometry_validations(session: requests.Session, headers: dict[str, str], keys: list[str]) -> int:
+    """Add the map validation to the given geometry fields and return the number of fields that failed."""
+    if not keys:
+        return 0
+    fields_url = f"{directus_instance}/fields/{collection_name}"
+    payload = [{"field": key, "meta": geometry_validation(key)} for key in keys]
+    response = session.patch(fields_url, json=payload, headers=headers)
+    if response.status_code == 200:
+        print(f"validation correctly added for fields {', '.join(keys)}")
+        return 0
+
+    # Older Directus versions only accept single-field updates
+    print(f"Batched validation update failed ({response.status_code}), falling back to per-field updates")
+    failures = 0
+    for key in keys:
+        response = session.patch(f"{fields_url}/{key}", json={"meta": geometry_validation(key)}, headers=headers)
+        if response.status_code == 200:
+            print(f"validation correctly added for field {key}")
+        else:
+            print(f"error adding validation to field {key}: {response.status_code} - {response.text}")
+            failures += 1
+    return failures
+
+
+def print_diff_summary(
+    inferred: dict[str, str], existing: dict[str, str], missing: dict[str, str], mismatched: dict[str, tuple[str, str]]
+) -> None:
+    print(
+        f"Schema diff for {collection_name}: detected={len(inferred)}, "
+        f"already present={len(inferred) - len(missing)}, missing={len(missing)}, "
+        f"type mismatches={len(mismatched)} (Directus has {len(existing)} fields)"
+    )
+    for key, value in sorted(missing.items()):
+        print(f" + {key} ({value})")
+    for key, (wanted, current) in sorted(mismatched.items()):
+        print(f" ~ {key}: inferred {wanted}, Directus has {current} (left unchanged)")
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
     if args.project:
         print(f"Filtering to project: {args.project}")
 
+    # Fields of projects synced from the same GPKGs already exist in Directus
+    cache = StageCache("fields_creator", data_path, enabled=not args.force)
+    projects = sorted({project for project, _filename, _path in table_io.iter_tables(out_csv_path, args.project)})
+    pending = [project for project in projects if not cache.is_fresh(project)]
+    print(f"Projects to inspect: {len(pending)}, skipped_projects={len(cache.skipped)}")
+    if not pending:
+        print("All projects unchanged since last successful sync, skipping Directus.")
+        return
+
+    field_types, file_count = infer_field_types(args.project, args.sample_rows, pending)
+    print(f"Detected {len(field_types)} fields from {file_count} CSV files.")
+
+    # Short-circuit before logging in when nothing changed since the last successful sync
+    state = load_schema_state(schema_state_path)
+    fingerprint = schema_fingerprint(field_types)
+    if not args.force and schema_already_synced(field_types, state):
+        print(f"Schema unchanged since last successful sync ({fingerprint[:12]}), skipping Directus.")
+        record_projects(cache, pending)
+        return
+
     # Create a session object for making requests
     session = requests.Session()
 
-    # Send a POST request to the login endpoint
-    directus_login = f"{directus_instance}/auth/login"
-    response = session.post(directus_login, json={"email": directus_email, "password": directus_password})
+    # Log in (or reuse the token of an earlier stage of the same process)
+    try:
+        directus_token = directus_auth.access_token(session, directus_instance, directus_email, directus_password)
+    except directus_auth.LoginFailed as e:
+        print("Connection to Directus failed")
+        print(f"Error: {e.status_code} - {e.text}")
+        raise SystemExit(1) from e
 
-    # Test if connection is successful
-    if response.status_code == 200:
-        print("Connection to Directus successful")
-
-        # Stores the access token
-        data = response.json()["data"]
-        directus_token = data["access_token"]
-
-        # Create an empty dictionary to store the column types
-        field_types = {}
-
-        # Mapping pandas dtypes to Directus types
-        pandas_to_directus = {
-            "int64": "integer",
-            "float64": "float",
-            "object": "string",
-            "bool": "boolean",
-            "datetime64[ns]": "datetime",
-            "timedelta64[ns]": "duration",
-        }
-
-        file_count = 0
-        # Iterate over all CSV files in the input folder and its subdirectories
-        for root, _dirs, files in os.walk(out_csv_path):
-            project = os.path.basename(root)
-            if args.project and project != args.project:
-                continue
-            for filename in files:
-                # Ignore old layer without sample_id and non-csv files
-                if filename.endswith(".csv") and filename != "SBL_20004_2022_EPSG:4326.csv":
-                    file_count += 1
-                    constructed_path = root + "/" + filename
-                    print(f"Inspecting {constructed_path}")
-                    df = pd.read_csv(constructed_path)
-
-                    # Skip empty files
-                    if df.empty:
-                        continue
-
-                    # Add qfield project to dataframe
-                    project = root.split("/")[-1]
-                    df["qfield_project"] = project
-
-                    # Iterate over all columns in the dataframe
-                    for column in df.columns:
-                        # Skip columns with all null values
-                        if df[column].isnull().all():
-                            continue
-
-                        # Replace dots with underscores
-                        new_column = column.replace(".", "_").replace("(", "").replace(")", "")
-                        df.rename(columns={column: new_column}, inplace=True)
-
-                        # Add types to dictionary if not already present
-                        if new_column not in field_types:
-                            if new_column.__contains__("comment"):
-                                column_type = "text"
-                            elif new_column.__contains__("geometry"):
-                                column_type = "geometry.Point"
-                            elif new_column.__contains__("date"):
-                                column_type = "bigInteger"
-                            else:
-                                column_type = pandas_to_directus[str(df[new_column].dtype)]
-
-                            field_types[new_column] = column_type
-
-        print(f"Detected {len(field_types)} fields from {file_count} CSV files.")
-
-        # Define api urls
-        collection_name = "Field_Data"
-
-        # Construct headers with authentication token
-        headers = {"Authorization": f"Bearer {directus_token}", "Content-Type": "application/json"}
-        post_url = f"{directus_instance}/fields/{collection_name}/"
-        for key, value in field_types.items():
-            field_url = f"{directus_instance}/fields/{collection_name}/{key}"
-            response = session.get(field_url)
-
-            if response.status_code == 200:
-                print(f"Field {key} already exists")
-            elif response.status_code == 403:
-                print(f"Creating field {key} with type {value}")
-                data = {"field": key, "type": value}
-                response = session.post(post_url, json=data, headers=headers)
-                if value == "geometry.Point":
-                    # If field is of type geometry.Point, add a validation to correctly display map
-                    validation = {"meta": {"validation": {"_and": [{key: {"_intersects_bbox": None}}]}}}
-                    url_patch = f"{directus_instance}/fields/{collection_name}/{key}"
-                    response = session.patch(url_patch, json=validation, headers=headers)
-                    if response.status_code == 200:
-                        print(f"validation correctly added for field {key}")
-                    else:
-                        print("error adding validation")
-                if response.status_code != 200:
-                    print(f"Error creating field: {response.status_code} - {response.text}")
-            else:
-                print(f"Error: {response.status_code} - {response.text}")
+    print("Connection to Directus successful")
 
-    else:
-        print("Connection to Directus failed")
-        print(f"Error: {response.status_code} - {response.text}")
-        raise SystemExit(1)
+    # Construct headers with authentication token
+    headers = {"Authorization": f"Bearer {directus_token}", "Content-Type": "application/json"}
+
+    # One request for the whole collection, then diff locally
+    existing = fetch_existing_fields(session, headers)
+    missing, mismatched = diff_fields(field_types, existing)
+    print_diff_summary(field_types, existing, missing, mismatched)
+
+    post_url = f"{directus_instance}/fields/{collection_name}/"
+    created_geometry: list[str] = []
+    errors = 0
+    for key, value in missing.items():
+        print(f"Creating field {key} with type {value}")
+        response = session.post(post_url, json={"field": key, "type": value}, headers=headers)
+        if response.status_code != 200:
+            print(f"Error creating field: {response.status_code} - {response.text}")
+            errors += 1
+            continue
+        if value == "geometry.Point":
+            created_geometry.append(key)
+
+    validation_errors = add_geometry_validations(session, headers, created_geometry)
+    metrics.count("fields_created", len(missing) - errors)
+    print(
+        f"Field sync finished. Created: {len(missing) - errors}, errors: {errors}, "
+        f"validation errors: {validation_errors}"
+    )
+    errors += validation_errors
+
+    # Only remember the schema once Directus has every field
+    if errors == 0:
+        synced = {**(state.get("fields") or {}), **field_types}
+        save_schema_state(
+            {
+                "collection": collection_name,
+                "fingerprint": fingerprint,
+                "fields": synced,
+                "synced_at": datetime.now(timezone.utc).isoformat(),
+            },
+            schema_state_path,
+        )
+        record_projects(cache, pending)
 
 
 if __name__ == "__main__":
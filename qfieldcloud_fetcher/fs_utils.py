@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
 import os
 import pwd
 import grp
+import shutil
 import stat
+import typing
 from pathlib import Path
 
+# ioctl request cloning a file's extents (Linux, btrfs/XFS/overlay reflinks)
+FICLONE = 0x40049409
+
 
 def current_user_label() -> str:
     uid = os.geteuid()
@@ -107,3 +117,113 @@ def permission_error_message(target: Path, blocked: Path, purpose: str) -> str:
         "This pipeline must run with a single service user, or you need to fix ownership/permissions "
         "on the existing project folders before retrying."
     )
+
+
+def file_digest(path: str, chunk: int = 4 * 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(chunk)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+
+def same_content(path: str, other: str) -> bool:
+    """True when both files exist with the same bytes (sizes are compared before hashing)."""
+    try:
+        if os.path.samefile(path, other):
+            return True
+        if os.path.getsize(path) != os.path.getsize(other):
+            return False
+    except FileNotFoundError:
+        return False
+    return file_digest(path) == file_digest(other)
+
+
+def replace_if_changed(tmp_path: str, destination: str) -> bool:
+    """
+    Move tmp_path over destination unless destination already holds the same
+    bytes, in which case tmp_path is dropped and destination keeps its mtime.
+    """
+    if same_content(tmp_path, destination):
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, destination)
+    return True
+
+
+def reflink(source: str, destination: str) -> None:
+    """Clone source into a new destination file sharing its extents; OSError where unsupported."""
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+
+
+def publish_file(source: str, destination: str) -> str:
+    """
+    Make destination hold the bytes of source without serializing them again:
+    hardlink when both are on the same filesystem, else a reflink, else one
+    buffered copy. The destination is swapped in atomically and left untouched
+    when its content is unchanged. Returns "unchanged", "hardlink", "reflink" or "copy".
+    """
+    if same_content(source, destination):
+        return "unchanged"
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    tmp_path = f"{destination}.{os.getpid()}.tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+        method = "hardlink"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+            raise
+        try:
+            reflink(source, tmp_path)
+            method = "reflink"
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+            method = "copy"
+    os.replace(tmp_path, destination)
+    return method
+
+
+@contextlib.contextmanager
+def locked(path: str) -> typing.Iterator[None]:
+    """
+    Exclusive advisory lock on `path` (through `path`.lock), for state files that
+    stages running in parallel per project read, update and rewrite.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd = os.open(path + ".lock", os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def update_json(path: str, updates: dict) -> dict:
+    """
+    Merge `updates` into the JSON object stored at `path` under its lock, so that
+    keys written meanwhile by other processes are kept. Returns the merged object.
+    """
+    with locked(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                data: dict = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        data.update(updates)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+    return data
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Lightweight GeoPackage attribute extractor.
+
+A GPKG is a SQLite database: feature/attribute tables are listed in gpkg_contents,
+their geometry column and SRS in gpkg_geometry_columns/gpkg_spatial_ref_sys.
+This module reads them with the standard library only (no GDAL, fiona, geopandas)
+and writes CSVs identical to what csv_generator produces through geopandas:
+same column order, pandas-style value formatting and GEOS-style point WKT.
+
+Layers this reader cannot reproduce exactly (non-point geometries, M values,
+DATETIME/BLOB columns, non-EPSG SRS) raise UnsupportedLayer so callers can fall
+back to the geopandas path for that layer.
+"""
+
+import csv
+import os
+import sqlite3
+import struct
+import typing
+from collections.abc import Iterator
+from dataclasses import dataclass
+from decimal import ROUND_HALF_EVEN, Decimal
+
+from qfieldcloud_fetcher import catalog
+
+if typing.TYPE_CHECKING:
+    import pandas as pd
+
+# GPKG tables written by QGIS/QField that are not observation data
+IGNORED_LAYERS = {"layer_styles", "qgis_projects"}
+
+# Declared column types -> how pandas ends up formatting them in to_csv
+INTEGER_TYPES = {"INTEGER", "INT", "MEDIUMINT", "SMALLINT", "TINYINT"}
+FLOAT_TYPES = {"REAL", "DOUBLE", "FLOAT"}
+TEXT_TYPES = {"TEXT", "DATE"}  # DATE is stored as YYYY-MM-DD, which pandas writes back unchanged
+
+# GPKG binary header envelope sizes by envelope indicator
+ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+
+class UnsupportedLayer(Exception):
+    """The layer needs features this reader does not reproduce exactly."""
+
+
+@dataclass
+class GpkgLayer:
+    table_name: str
+    geometry_column: str | None
+    geometry_type: str | None
+    has_m: bool
+    crs: str  # CSV suffix, e.g. "EPSG:2056" or "None"
+
+
+@dataclass
+class GpkgColumn:
+    name: str
+    kind: str  # "integer", "float", "boolean", "text"
+    has_nulls: bool = False
+
+
+def connect(gpkg_path: str) -> sqlite3.Connection:
+    # read-only so a concurrent fetch can never be corrupted by the extractor
+    return sqlite3.connect(f"file:{gpkg_path}?mode=ro", uri=True)
+
+
+def output_stem(gpkg_name: str, layer: str, layer_index: int) -> str:
+    """
+    The first layer keeps the historical <gpkg stem> name, further layers get
+    <gpkg stem>_<layer> so multi-layer GPKGs are no longer truncated.
+    """
+    stem = os.path.splitext(gpkg_name)[0]
+    if layer_index == 0 or layer == stem:
+        return stem
+    return f"{stem}_{layer}"
+
+
+def is_data_layer(name: str) -> bool:
+    return name not in IGNORED_LAYERS and not name.startswith(("gpkg_", "rtree_"))
+
+
+def list_layers(conn: sqlite3.Connection) -> list[GpkgLayer]:
+    """Feature and attribute tables in gpkg_contents order (the order OGR reports them)."""
+    rows = conn.execute(
+        """
+        SELECT c.table_name, g.column_name, g.geometry_type_name, g.m,
+               s.organization, s.organization_coordsys_id, g.srs_id
+        FROM gpkg_contents c
+        LEFT JOIN gpkg_geometry_columns g ON g.table_name = c.table_name
+        LEFT JOIN gpkg_spatial_ref_sys s ON s.srs_id = g.srs_id
+        WHERE c.data_type IN ('features', 'attributes')
+        ORDER BY c.rowid
+        """
+    ).fetchall()
+    layers = []
+    for table_name, geom_col, geom_type, m, organization, coordsys_id, srs_id in rows:
+        if not is_data_layer(table_name):
+            continue
+        if geom_col is None or srs_id in (None, -1, 0):
+            crs = "None"
+        elif (organization or "").upper() == "EPSG":
+            crs = f"EPSG:{coordsys_id}"
+        else:
+            crs = f"unsupported:{organization}:{coordsys_id}"
+        layers.append(
+            GpkgLayer(
+                table_name=table_name,
+                geometry_column=geom_col,
+                geometry_type=(geom_type or "").upper() or None,
+                has_m=bool(m),
+                crs=crs,
+            )
+        )
+    return layers
+
+
+def quote_identifier(identifier: str) -> str:
+    """Double-quote a SQLite table or column name."""
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def layer_columns(conn: sqlite3.Connection, layer: GpkgLayer) -> list[GpkgColumn]:
+    """Attribute columns in table order, without the FID and geometry columns."""
+    if layer.crs.startswith("unsupported:"):
+        raise UnsupportedLayer(f"{layer.table_name}: SRS {layer.crs[12:]} is not an EPSG code")
+    if layer.geometry_column is not None and (layer.geometry_type != "POINT" or layer.has_m):
+        raise UnsupportedLayer(f"{layer.table_name}: geometry type {layer.geometry_type} is not a 2D/3D point")
+
+    columns = []
+    for _cid, name, declared, _notnull, _default, pk in conn.execute(
+        f"PRAGMA table_info({quote_identifier(layer.table_name)})"
+    ):
+        if name == layer.geometry_column or (pk and (declared or "").upper() == "INTEGER"):
+            continue
+        base_type = (declared or "").upper().split("(")[0].strip()
+        if base_type in INTEGER_TYPES:
+            kind = "integer"
+        elif base_type in FLOAT_TYPES:
+            kind = "float"
+        elif base_type == "BOOLEAN":
+            kind = "boolean"
+        elif base_type in TEXT_TYPES:
+            kind = "text"
+        else:
+            raise UnsupportedLayer(f"{layer.table_name}.{name}: column type {declared!r} is not supported")
+        columns.append(GpkgColumn(name=name, kind=kind))
+
+    # pandas turns integer columns containing nulls into floats ("3.0") and boolean
+    # ones into objects, so find out up front
+    nullable_columns = [c for c in columns if c.kind in ("integer", "boolean")]
+    if nullable_columns:
+        # Only quoted identifiers are interpolated, never values
+        counts = conn.execute(
+            "SELECT "  # noqa: S608
+            + ", ".join(f"SUM({quote_identifier(c.name)} IS NULL)" for c in nullable_columns)
+            + f" FROM {quote_identifier(layer.table_name)}"
+        ).fetchone()
+        for column, nulls in zip(nullable_columns, counts):
+            column.has_nulls = bool(nulls)
+    return columns
+
+
+def format_ordinate(value: float) -> str:
+    """Format a coordinate the way GEOS' WKT writer does (shapely str())."""
+    if value == 0:
+        return "0"
+    text = repr(value)
+    magnitude = abs(value)
+    if magnitude >= 1e17 or magnitude < 1e-4:
+        mantissa, _, exponent = text.partition("e")
+        if "." in mantissa:
+            mantissa = mantissa.rstrip("0").rstrip(".")
+        return f"{mantissa}e{int(exponent):+d}"
+    number = Decimal(text)
+    if number.as_tuple().exponent < -16:  # type: ignore[operator]
+        number = number.quantize(Decimal("1e-16"), rounding=ROUND_HALF_EVEN)
+    formatted = format(number, "f")
+    if "." in formatted:
+        formatted = formatted.rstrip("0").rstrip(".")
+    return formatted
+
+
+def decode_point(blob: bytes) -> tuple[float, ...] | None:
+    """
+    Decode a GPKG binary point geometry to (x, y) or (x, y, z).
+    Returns None for empty points; raises UnsupportedLayer for anything else.
+    """
+    if blob[:2] != b"GP":
+        raise UnsupportedLayer("geometry blob is not a GeoPackage binary")
+    flags = blob[3]
+    envelope = (flags >> 1) & 0x07
+    if envelope not in ENVELOPE_SIZES:
+        raise UnsupportedLayer(f"invalid envelope indicator {envelope}")
+    if flags & 0x10:
+        return None
+    offset = 8 + ENVELOPE_SIZES[envelope]
+
+    byte_order = "<" if blob[offset] == 1 else ">"
+    (wkb_type,) = struct.unpack_from(f"{byte_order}I", blob, offset + 1)
+    # ISO (1001 = Z) and EWKB (0x80000000 = Z) flavours
+    has_z = wkb_type & 0x80000000 or (wkb_type & 0xFFFF) // 1000 in (1, 3)
+    has_m = wkb_type & 0x40000000 or (wkb_type & 0xFFFF) // 1000 in (2, 3)
+    if (wkb_type & 0xFFFF) % 1000 != 1 or has_m:
+        raise UnsupportedLayer(f"WKB type {wkb_type} is not a 2D/3D point")
+    dims = 3 if has_z else 2
+    coords = struct.unpack_from(f"{byte_order}{dims}d", blob, offset + 5)
+    if all(c != c for c in coords):  # NaN coordinates encode POINT EMPTY
+        return None
+    return coords
+
+
+def encode_point(coords: tuple[float, ...], srs_id: int) -> bytes:
+    """GPKG binary (little endian, no envelope) for an (x, y) or (x, y, z) point."""
+    wkb_type = 1001 if len(coords) == 3 else 1
+    return b"GP" + struct.pack(f"<BBiBI{len(coords)}d", 0, 0x01, srs_id, 1, wkb_type, *coords)
+
+
+def point_wkt(blob: bytes | None) -> str:
+    if blob is None:
+        return ""
+    coords = decode_point(blob)
+    if coords is None:
+        return "POINT EMPTY"
+    tag = "POINT Z" if len(coords) == 3 else "POINT"
+    return f"{tag} ({' '.join(format_ordinate(c) for c in coords)})"
+
+
+def _formatter(column: GpkgColumn) -> typing.Callable[[typing.Any], str]:
+    if column.kind == "integer":
+        if column.has_nulls:
+            return lambda v: "" if v is None else repr(float(v))
+        return lambda v: "" if v is None else str(int(v))
+    if column.kind == "float":
+        return lambda v: "" if v is None else repr(float(v))
+    if column.kind == "boolean":
+        return lambda v: "" if v is None else str(bool(v))
+    return lambda v: "" if v is None else str(v)
+
+
+def iter_values(conn: sqlite3.Connection, layer: GpkgLayer, columns: list[GpkgColumn]) -> Iterator[list[typing.Any]]:
+    """Yield raw rows (attributes then geometry WKT or None), streaming from SQLite."""
+    selected = [quote_identifier(c.name) for c in columns]
+    if layer.geometry_column is not None:
+        selected.append(quote_identifier(layer.geometry_column))
+    boolean_indexes = [i for i, c in enumerate(columns) if c.kind == "boolean"]
+    # OGR returns features in FID order; only quoted identifiers are interpolated
+    table = quote_identifier(layer.table_name)
+    cursor = conn.execute(f"SELECT {', '.join(selected) or 'NULL'} FROM {table} ORDER BY rowid")  # noqa: S608
+    n_attributes = len(columns)
+    for row in cursor:
+        values = list(row[:n_attributes])
+        for i in boolean_indexes:
+            if values[i] is not None:
+                values[i] = bool(values[i])
+        if layer.geometry_column is not None:
+            values.append(point_wkt(row[n_attributes]) or None)
+        yield values
+
+
+def iter_raw_rows(conn: sqlite3.Connection, layer: GpkgLayer) -> tuple[list[str], str | None, Iterator[tuple]]:
+    """
+    (column names, primary key column, row cursor) over every column of a layer as
+    stored in SQLite, geometry blobs included. Works for any layer, supported or not.
+    """
+    info = conn.execute(f"PRAGMA table_info({quote_identifier(layer.table_name)})").fetchall()
+    names = [row[1] for row in info]
+    pk = next((row[1] for row in info if row[5]), None)
+    # Only the quoted table name is interpolated
+    return names, pk, conn.execute(f"SELECT * FROM {quote_identifier(layer.table_name)} ORDER BY rowid")  # noqa: S608
+
+
+def iter_rows(conn: sqlite3.Connection, layer: GpkgLayer, columns: list[GpkgColumn]) -> Iterator[list[str]]:
+    """Yield rows formatted the way DataFrame.to_csv writes them."""
+    formatters = [_formatter(c) for c in columns]
+    if layer.geometry_column is not None:
+        formatters.append(lambda v: "" if v is None else v)
+    for values in iter_values(conn, layer, columns):
+        yield [fmt(value) for fmt, value in zip(formatters, values)]
+
+
+def column_dtype(column: GpkgColumn) -> str:
+    """The dtype geopandas ends up with for a column."""
+    if column.kind == "integer":
+        return "float64" if column.has_nulls else "int64"
+    if column.kind == "float":
+        return "float64"
+    if column.kind == "boolean":
+        return "object" if column.has_nulls else "bool"
+    return "object"
+
+
+def read_layer_frame(conn: sqlite3.Connection, layer: GpkgLayer) -> "pd.DataFrame":
+    """Load a layer as a typed DataFrame (geometry as WKT), for non-CSV intermediates."""
+    import pandas as pd
+
+    columns = layer_columns(conn, layer)
+    names = [c.name for c in columns]
+    if layer.geometry_column is not None:
+        names.append("geometry")
+    df = pd.DataFrame.from_records(list(iter_values(conn, layer, columns)), columns=names)
+    for column in columns:
+        dtype = column_dtype(column)
+        if dtype == "object":
+            df[column.name] = df[column.name].astype(object).where(df[column.name].notna(), None)
+        else:
+            df[column.name] = df[column.name].astype(pd.api.types.pandas_dtype(dtype))
+    return df
+
+
+def write_layer_csv(conn: sqlite3.Connection, layer: GpkgLayer, output_csv_path: str) -> int:
+    """
+    Write one layer to CSV and return the row count. The file is written to a temp
+    path first, so an UnsupportedLayer raised mid-stream leaves nothing behind, and
+    recorded in the catalog like the files of table_io.write_table.
+    """
+    columns = layer_columns(conn, layer)
+    header = [c.name for c in columns]
+    if layer.geometry_column is not None:
+        header.append("geometry")
+
+    tmp_path = output_csv_path + ".tmp"
+    rows = 0
+    try:
+        with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator=os.linesep)
+            writer.writerow(header)
+            for values in iter_rows(conn, layer, columns):
+                writer.writerow(values)
+                rows += 1
+        os.replace(tmp_path, output_csv_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    catalog.record(output_csv_path)
+    return rows
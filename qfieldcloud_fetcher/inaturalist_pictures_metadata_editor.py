@@ -11,6 +11,8 @@ import pandas as pd
 import requests
 from dotenv import load_dotenv
 
+from qfieldcloud_fetcher import table_io
+
 # Loads environment variables
 load_dotenv()
 
@@ -38,11 +40,9 @@ pattern = "(" + "|".join(project_names) + ")_[0-9]{6}|[0-9]{14}|obs_[0-9]6,20}_[
 dfs = []
 
 # Get common dataframe
-for root, _dirs, files in os.walk(out_csv_path):
-    for filename in files:
-        file = root + "/" + filename
-        df = pd.read_csv(file)
-        dfs.append(df)
+for _project, _filename, file in table_io.iter_tables(out_csv_path):
+    df = table_io.read_table(file, schema="field_data")
+    dfs.append(df)
 
 # Concatenate, automatically aligning columns
 df = pd.concat(dfs, ignore_index=True, sort=False)
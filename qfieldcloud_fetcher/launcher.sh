@@ -12,6 +12,17 @@ cd "$p"
 source "$p/.env"
 mkdir -p "${DATA_PATH}" "${LOGS_PATH}"
 
+# Optional: run every stage in one Python process (same options, logs and runs.jsonl; see pipeline.py)
+if [[ "${PIPELINE_IN_PROCESS:-}" =~ ^(1|true|yes|on)$ ]]; then
+  exec ${POETRY_PATH} run python3 -m qfieldcloud_fetcher.pipeline "$@"
+fi
+
+# Optional profiling of selected stages: --profile fetcher,db_updater (or PIPELINE_PROFILE; see profiling.py)
+if [[ "${1:-}" == "--profile" ]]; then
+  PIPELINE_PROFILE="${2:?--profile needs a comma-separated list of stages}"
+fi
+export PIPELINE_PROFILE="${PIPELINE_PROFILE:-}"
+
 # Default fetcher behavior (interactive or dry-run)
 FETCHER_DEFAULT_MODE="${FETCHER_DEFAULT_MODE:-interactive}"
 case "${FETCHER_DEFAULT_MODE}" in
@@ -23,6 +34,13 @@ case "${FETCHER_DEFAULT_MODE}" in
     ;;
 esac
 
+# Optional delta ingestion (patch local GPKGs from QFieldCloud deltas instead of re-downloading them)
+FETCHER_DELTAS="${FETCHER_DELTAS:-}"
+FETCHER_DELTA_ARGS=()
+if [[ "${FETCHER_DELTAS}" =~ ^(1|true|yes|on)$ ]]; then
+  FETCHER_DELTA_ARGS=(--deltas)
+fi
+
 # Optional downstream project filter (single project by exact name)
 PIPELINE_PROJECT="${PIPELINE_PROJECT:-}"
 PROJECT_FILTER_ARGS=()
@@ -44,6 +62,13 @@ if [[ "${ALLOW_EXISTING_SAMPLE_ID_OVERWRITE}" =~ ^(1|true|yes|on)$ ]]; then
   DB_UPDATER_ARGS=(--allow-existing-sample-id-overwrite)
 fi
 
+# Optional row-level deltas for csv_formatter, db_updater and pictures_metadata_editor
+PIPELINE_CHANGES_ONLY="${PIPELINE_CHANGES_ONLY:-}"
+CHANGES_ONLY_ARGS=()
+if [[ "${PIPELINE_CHANGES_ONLY}" =~ ^(1|true|yes|on)$ ]]; then
+  CHANGES_ONLY_ARGS=(--changes-only)
+fi
+
 # Optional finalizer force delete
 FINALIZER_FORCE_DELETE="${FORCE_REMOTE_DELETE:-}"
 FINALIZER_FORCE_ARGS=()
@@ -62,6 +87,8 @@ iso_ts() {
 
 # --- pipeline logging setup ---
 RUN_ID="$(date '+%Y%m%d-%H%M%S')"
+# Stages share their directory scans within a run (see catalog.py)
+export RUN_ID
 PIPELINE_LOG="${LOGS_PATH}/pipeline_${RUN_ID}.log"
 ln -sf "$(basename "$PIPELINE_LOG")" "${LOGS_PATH}/pipeline_latest.log"
 
@@ -79,11 +106,16 @@ record_status() {
   local reason="${2:-}"
   local end_ts
   end_ts="$(iso_ts)"
+  local record finalized
   # append one JSON object per run (easy to grep/parse later)
-  printf '{"run_id":"%s","start":"%s","end":"%s","status":"%s","reason":"%s","projects_selected":"%s","downloaded_files":%s,"had_changes":%s}\n' \
+  record="$(printf '{"run_id":"%s","start":"%s","end":"%s","status":"%s","reason":"%s","projects_selected":"%s","downloaded_files":%s,"had_changes":%s}' \
     "$RUN_ID" "$START_TS" "$end_ts" "$final_status" "$reason" \
-    "${PROJECTS_SELECTED//\"/\\\"}" "${DOWNLOADED_FILES}" "${HAD_CHANGES}" \
-    >> "${LOGS_PATH}/runs.jsonl"
+    "${PROJECTS_SELECTED//\"/\\\"}" "${DOWNLOADED_FILES}" "${HAD_CHANGES}")"
+  # with the metrics of every stage, also written to the Prometheus textfile (see metrics.py)
+  if finalized="$(${POETRY_PATH} run python3 -m qfieldcloud_fetcher.metrics finalize <<< "$record")"; then
+    record="$finalized"
+  fi
+  echo "$record" >> "${LOGS_PATH}/runs.jsonl"
 }
 
 on_err() {
@@ -112,7 +144,7 @@ FOLDER_SIZE_MB=$(du -sm "${LOGS_PATH}" | awk '{print $1}')
 if (( FOLDER_SIZE_MB > SIZE_LIMIT_MB )); then
   echo "Logs folder ${FOLDER_SIZE_MB} MB > ${SIZE_LIMIT_MB} MB — pruning older logs"
   # delete only old pipeline_* logs; keep runs.jsonl
-  find "${LOGS_PATH}" -maxdepth 1 -type f -name 'pipeline_*.log' -mtime +14 -print -delete || true
+  find "${LOGS_PATH}" -maxdepth 1 -type f \( -name 'pipeline_*.log' -o -name 'profile_*' \) -mtime +14 -print -delete || true
 fi
 
 scripts_folder="${p}/qfieldcloud_fetcher"
@@ -122,7 +154,8 @@ run_script() {
   local script_basename="$1"; shift
   local logfile="$LOGS_PATH/${script_basename}.log"
   echo "--- $(iso_ts) :: running ${script_basename}.py $* ---"
-  if ! { ${POETRY_PATH} run python3 "${scripts_folder}/${script_basename}.py" "$@" 2>&1 | tee -a "$logfile"; }; then
+  # same as python3 "${scripts_folder}/${script_basename}.py", recording the stage metrics (see metrics.py)
+  if ! { ${POETRY_PATH} run python3 -m qfieldcloud_fetcher.metrics run "${script_basename}" "$@" 2>&1 | tee -a "$logfile"; }; then
     echo "!!! ${script_basename} failed — see $logfile"
     STATUS="failed"
     record_status "failed" "script_failed:${script_basename}"
@@ -132,7 +165,7 @@ run_script() {
 }
 
 # --- 1) Fetcher FIRST (improved) ---
-run_script fetcher "${FETCHER_DEFAULT_FLAG}"
+run_script fetcher "${FETCHER_DEFAULT_FLAG}" "${FETCHER_DELTA_ARGS[@]}"
 
 # read fetcher summary (if jq is available)
 SUMMARY_JSON="${DATA_PATH}/last_fetch_summary.json"
@@ -156,26 +189,47 @@ if [[ ! -f "$MARKER" ]]; then
   exit 0
 fi
 
-# --- 2) Clean CSV staging dirs (inputs already cleaned by fetcher) ---
-rm -rf "${DATA_PATH}/raw_csv" "${DATA_PATH}/formatted_csv"
+# --- 2) CSV staging dirs are cleaned per project by the stages themselves ---
+# csv_generator/csv_formatter only rebuild projects whose GPKGs changed (see DATA_PATH/stage_cache.json);
+# set FORCE_CSV_STAGES=1 to rebuild everything.
+CSV_STAGE_ARGS=()
+if [[ "${FORCE_CSV_STAGES:-}" =~ ^(1|true|yes|on)$ ]]; then
+  CSV_STAGE_ARGS=(--force)
+fi
+
+# --- 3) Row-level change sets against the last successful run (committed at the end) ---
+run_script "change_capture" "${PROJECT_FILTER_ARGS[@]}"
 
-# --- 3) Downstream steps (only if changes) ---
+# --- 4) Downstream steps (only if changes) ---
 # after you confirmed HAD_CHANGES and before renamer/resizer:
-run_script "stage_to_nextcloud_raw" "${PROJECT_FILTER_ARGS[@]}"
+if [[ "${PICTURE_STREAM:-}" =~ ^(1|true|yes|on)$ ]]; then
+  PICTURE_STREAM=1
+else
+  PICTURE_STREAM=""
+  run_script "stage_to_nextcloud_raw" "${PROJECT_FILTER_ARGS[@]}"
+fi
 
 # ... your existing steps ...
-run_script "csv_generator" "${PROJECT_FILTER_ARGS[@]}"
-run_script "csv_formatter" "${PROJECT_FILTER_ARGS[@]}"
-run_script "fields_creator" "${PROJECT_FILTER_ARGS[@]}"
-run_script "db_updater" "${PROJECT_FILTER_ARGS[@]}" "${DB_UPDATER_ARGS[@]}"
+run_script "csv_generator" "${PROJECT_FILTER_ARGS[@]}" "${CSV_STAGE_ARGS[@]}"
+run_script "csv_formatter" "${PROJECT_FILTER_ARGS[@]}" "${CSV_STAGE_ARGS[@]}" "${CHANGES_ONLY_ARGS[@]}"
+run_script "fields_creator" "${PROJECT_FILTER_ARGS[@]}" "${CSV_STAGE_ARGS[@]}"
+run_script "db_updater" "${PROJECT_FILTER_ARGS[@]}" "${DB_UPDATER_ARGS[@]}" "${CSV_STAGE_ARGS[@]}" "${CHANGES_ONLY_ARGS[@]}"
 run_script "directus_link_maker" "${PROJECT_FILTER_ARGS[@]}"
-run_script "pictures_renamer" "${PROJECT_FILTER_ARGS[@]}"
-run_script "pictures_resizer" "${PROJECT_FILTER_ARGS[@]}"
-run_script "pictures_metadata_editor" "${PROJECT_FILTER_ARGS[@]}"
+if [[ -n "${PICTURE_STREAM}" ]]; then
+  # Stages, renames, compresses, tags and publishes one picture at a time
+  run_script "picture_stream" "${PROJECT_FILTER_ARGS[@]}" "${CHANGES_ONLY_ARGS[@]}"
+else
+  run_script "pictures_renamer" "${PROJECT_FILTER_ARGS[@]}"
+  run_script "pictures_resizer" "${PROJECT_FILTER_ARGS[@]}"
+  run_script "pictures_metadata_editor" "${PROJECT_FILTER_ARGS[@]}" "${CHANGES_ONLY_ARGS[@]}"
+fi
 
 # Optional cleanup: delete remote DCIM photos and matching raw files only when explicitly enabled
 run_script "pictures_finalizer" "${PROJECT_FILTER_ARGS[@]}" "${FINALIZER_ENABLE_ARGS[@]}" "${FINALIZER_FORCE_ARGS[@]}"
 
+# Every stage went through: the snapshots taken by change_capture become the new baseline
+run_script "change_capture" "${PROJECT_FILTER_ARGS[@]}" --commit
+
 STATUS="ok"
 record_status "ok" "completed"
 echo "=== $(iso_ts) :: pipeline completed successfully (RUN_ID=${RUN_ID}) ==="
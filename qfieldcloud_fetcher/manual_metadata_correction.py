@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import csv
 import os
 import re
 import subprocess
@@ -9,6 +8,8 @@ from datetime import datetime
 import requests
 from dotenv import load_dotenv
 
+from qfieldcloud_fetcher import table_io
+
 # Loads environment variables
 load_dotenv()
 
@@ -61,33 +62,31 @@ for root, _dirs, files in os.walk(inat_jpg_path):
             found = False
 
             # Get picture metadata from CSV file
-            with open(csv_filename) as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    # Match the corresponding data
-                    if "sample_id" in row and row["sample_id"] and row["sample_id"].replace(" ", "") == unique_id:
-                        found = True
-                        date = row["date"]
-                        # Check if a date exists. If not, skip the picture
-                        if date == "":
-                            date = datetime.now().strftime("%Y%m%d%H%M%S")
-
-                        # Get and format data
-                        formatted_date = datetime.strptime(date, "%Y%m%d%H%M%S")
-                        collector = row["collector_fullname"]
-                        collector_prefix = "emi_collector:" + collector
-                        inat_upload = row["inat_upload"]
-                        is_wild = row["is_wild"]
-                        is_wild_prefix = {"emi_is_wild:": is_wild}
-                        orcid = row["collector_orcid"]
-                        orcid_prefix = "emi_collector_orcid:" + orcid
-                        inat = row["collector_inat"]
-                        inat_prefix = "emi_collector_inat:" + inat
-                        lon = row["longitude"]
-                        lat = row["latitude"]
-
-                        # Stop iterating when match is found
-                        break
+            for row in table_io.read_rows(csv_filename, schema="field_data"):
+                # Match the corresponding data
+                if "sample_id" in row and row["sample_id"] and row["sample_id"].replace(" ", "") == unique_id:
+                    found = True
+                    date = row["date"]
+                    # Check if a date exists. If not, skip the picture
+                    if date == "":
+                        date = datetime.now().strftime("%Y%m%d%H%M%S")
+
+                    # Get and format data
+                    formatted_date = datetime.strptime(date, "%Y%m%d%H%M%S")
+                    collector = row["collector_fullname"]
+                    collector_prefix = "emi_collector:" + collector
+                    inat_upload = row["inat_upload"]
+                    is_wild = row["is_wild"]
+                    is_wild_prefix = {"emi_is_wild:": is_wild}
+                    orcid = row["collector_orcid"]
+                    orcid_prefix = "emi_collector_orcid:" + orcid
+                    inat = row["collector_inat"]
+                    inat_prefix = "emi_collector_inat:" + inat
+                    lon = row["longitude"]
+                    lat = row["latitude"]
+
+                    # Stop iterating when match is found
+                    break
 
             if not found:
                 print(f"No data found for {unique_id}")
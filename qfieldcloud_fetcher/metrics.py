@@ -0,0 +1,475 @@
+"""
+Per-stage performance metrics.
+
+measure(stage, argv) wraps one run of a stage and appends its record to
+LOGS_PATH/stage_metrics.jsonl:
+
+- wall time and CPU time (the process and the children it waited for: ExifTool, worker pools);
+- peak RSS of the process;
+- bytes read and written by the process (from /proc/self/io, Linux only);
+- items processed, as counted by the stage itself with count() (pictures, rows, files...);
+- HTTP requests sent through requests (QFieldCloud, Directus), with errors and latency percentiles.
+
+finalize_run(record) adds the stage records of a run to its runs.jsonl line and
+rewrites the Prometheus textfile (METRICS_TEXTFILE, default
+LOGS_PATH/metrics/qfieldcloud_pipeline.prom) for node_exporter's textfile collector.
+
+pipeline.py calls both directly. launcher.sh goes through the command line:
+`python3 -m qfieldcloud_fetcher.metrics run <stage> [args]` runs a stage like
+`python3 <stage>.py [args]` would (profiled when PIPELINE_PROFILE selects it),
+and `... finalize` reads the run record on stdin and prints it back with its metrics.
+"""
+
+import argparse
+import functools
+import importlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+from collections import Counter
+from contextlib import contextmanager, suppress
+from datetime import datetime
+
+import requests
+from dotenv import load_dotenv
+
+from qfieldcloud_fetcher import tracing
+
+STAGE_METRICS_FILE = "stage_metrics.jsonl"
+TEXTFILE_NAME = os.path.join("metrics", "qfieldcloud_pipeline.prom")
+# Upper bounds (seconds) of the HTTP latency histogram; the last bucket is +Inf
+HTTP_BUCKETS_S = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = "qfieldcloud_pipeline"
+
+_lock = threading.Lock()
+# Stages being measured in this process (one, except in tests)
+_active: list["StageMetrics"] = []
+
+
+class StageMetrics:
+    """Items and HTTP requests of a stage being measured; shared by its threads."""
+
+    def __init__(self, stage: str, project: str | None = None):
+        self.stage = stage
+        self.project = project
+        self.status = "ok"
+        self.items: Counter[str] = Counter()
+        self.latencies: list[float] = []
+        self.http_errors = 0
+
+    def count(self, name: str, n: int = 1) -> None:
+        with _lock:
+            self.items[name] += n
+
+    def observe_http(self, seconds: float, ok: bool) -> None:
+        with _lock:
+            self.latencies.append(seconds)
+            if not ok:
+                self.http_errors += 1
+
+    def http_record(self) -> dict[str, typing.Any]:
+        latencies = sorted(self.latencies)
+        buckets = [0] * (len(HTTP_BUCKETS_S) + 1)
+        for seconds in latencies:
+            buckets[next((i for i, le in enumerate(HTTP_BUCKETS_S) if seconds <= le), len(HTTP_BUCKETS_S))] += 1
+        return {
+            "requests": len(latencies),
+            "errors": self.http_errors,
+            "seconds": round(sum(latencies), 3),
+            "p50_ms": percentile_ms(latencies, 50),
+            "p95_ms": percentile_ms(latencies, 95),
+            "p99_ms": percentile_ms(latencies, 99),
+            "buckets": buckets,
+        }
+
+
+def percentile_ms(sorted_seconds: list[float], q: float) -> float | None:
+    """Nearest-rank percentile, in milliseconds (None without samples)."""
+    if not sorted_seconds:
+        return None
+    rank = max(0, -(-len(sorted_seconds) * q // 100) - 1)
+    return round(sorted_seconds[int(rank)] * 1000, 1)
+
+
+def count(name: str, n: int = 1) -> None:
+    """Count n items for the stage being measured (no-op outside measure())."""
+    for metrics in list(_active):
+        metrics.count(name, n)
+
+
+def _observe_http(seconds: float, ok: bool) -> None:
+    for metrics in list(_active):
+        metrics.observe_http(seconds, ok)
+
+
+def _instrument_requests() -> None:
+    # Every HTTP client of the stages (qfieldcloud_sdk included) sends through requests.Session.send
+    send = requests.Session.send
+    if getattr(send, "_metrics_wrapped", False):
+        return
+
+    @functools.wraps(send)
+    def timed_send(
+        self: requests.Session, request: requests.PreparedRequest, **kwargs: typing.Any
+    ) -> requests.Response:
+        if not _active:
+            return send(self, request, **kwargs)
+        url = urllib.parse.urlsplit(str(request.url or ""))
+        attributes = {
+            "http.request.method": request.method,
+            # Without the query string, which may carry tokens
+            "url.full": urllib.parse.urlunsplit((url.scheme, url.netloc, url.path, "", "")),
+            "server.address": url.hostname,
+            "http.request.body.size": len(request.body) if isinstance(request.body, (bytes, str)) else None,
+        }
+        with tracing.span(f"HTTP {request.method}", attributes, kind=tracing.KIND_CLIENT) as http_span:
+            started = time.perf_counter()
+            try:
+                response = send(self, request, **kwargs)
+            except Exception:
+                _observe_http(time.perf_counter() - started, False)
+                raise
+            _observe_http(time.perf_counter() - started, response.status_code < 400)
+            # Retries of the session's urllib3 Retry policy happen below this call
+            retries = getattr(getattr(response.raw, "retries", None), "history", None)
+            length = response.headers.get("Content-Length")
+            http_span.set_attributes({
+                "http.response.status_code": response.status_code,
+                "http.response.body.size": int(length) if length and length.isdigit() else None,
+                "http.retries": len(retries) if retries is not None else None,
+            })
+            if response.status_code >= 400:
+                http_span.set_error(f"HTTP {response.status_code}")
+        return response
+
+    timed_send._metrics_wrapped = True  # type: ignore[attr-defined]
+    requests.Session.send = timed_send  # type: ignore[method-assign]
+
+
+def _cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _io_bytes() -> tuple[int, int]:
+    """(read, written) bytes of the process so far, files and sockets included; (0, 0) off Linux."""
+    counters = {}
+    with suppress(OSError), open("/proc/self/io", encoding="ascii") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            counters[name] = int(value)
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def project_of(argv: typing.Sequence[str]) -> str | None:
+    argv = list(argv)
+    if "--project" in argv[:-1]:
+        return argv[argv.index("--project") + 1]
+    return None
+
+
+def append_record(record: dict[str, typing.Any], logs_dir: str | None = None) -> None:
+    logs_dir = logs_dir or os.getenv("LOGS_PATH")
+    if not logs_dir:
+        return
+    os.makedirs(logs_dir, exist_ok=True)
+    # One write per line: the worker processes of pipeline.py append concurrently
+    with open(os.path.join(logs_dir, STAGE_METRICS_FILE), "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def measure(stage: str, argv: typing.Sequence[str] = (), logs_dir: str | None = None) -> typing.Iterator[StageMetrics]:
+    """
+    Measure the stage run in the with block and append its record to
+    LOGS_PATH/stage_metrics.jsonl. The record is "failed" when the block raises
+    (SystemExit with a non-zero status included) or when metrics.status is set so.
+    """
+    _instrument_requests()
+    metrics = StageMetrics(stage, project_of(argv))
+    start = datetime.now().astimezone().isoformat(timespec="seconds")
+    started, cpu_started = time.perf_counter(), _cpu_seconds()
+    read_started, written_started = _io_bytes()
+    _active.append(metrics)
+    try:
+        with tracing.span(f"stage {stage}", {"pipeline.stage": stage, "pipeline.project": metrics.project}) as span:
+            try:
+                yield metrics
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    metrics.status = "failed"
+                raise
+            except BaseException:
+                metrics.status = "failed"
+                raise
+            finally:
+                span.set_attributes({f"pipeline.items.{name}": n for name, n in metrics.items.items()})
+                if metrics.status != "ok":
+                    span.set_error(metrics.status)
+    finally:
+        _active.remove(metrics)
+        read, written = _io_bytes()
+        append_record(
+            {
+                "run_id": os.getenv("RUN_ID") or "",
+                "stage": stage,
+                "project": metrics.project,
+                "start": start,
+                "status": metrics.status,
+                "wall_s": round(time.perf_counter() - started, 3),
+                "cpu_s": round(_cpu_seconds() - cpu_started, 3),
+                "max_rss_mb": round(_peak_rss_mb(), 1),
+                "read_bytes": read - read_started,
+                "write_bytes": written - written_started,
+                "items": dict(metrics.items),
+                "http": metrics.http_record(),
+            },
+            logs_dir,
+        )
+
+
+def load_stage_records(logs_dir: str, run_id: str) -> list[dict[str, typing.Any]]:
+    records = []
+    with suppress(FileNotFoundError), open(os.path.join(logs_dir, STAGE_METRICS_FILE), encoding="utf-8") as f:
+        for line in f:
+            with suppress(ValueError):
+                record = json.loads(line)
+                if record.get("run_id") == run_id:
+                    records.append(record)
+    return records
+
+
+def _merge(records: list[dict[str, typing.Any]]) -> dict[str, typing.Any]:
+    """One stage (or the whole run) over several records: sums, peak RSS and pooled HTTP histogram."""
+    items: Counter[str] = Counter()
+    buckets = [0] * (len(HTTP_BUCKETS_S) + 1)
+    for record in records:
+        items.update(record.get("items") or {})
+        for i, n in enumerate((record.get("http") or {}).get("buckets") or []):
+            buckets[i] += n
+    http = [record.get("http") or {} for record in records]
+    return {
+        "wall_s": round(sum(record.get("wall_s", 0) for record in records), 3),
+        "cpu_s": round(sum(record.get("cpu_s", 0) for record in records), 3),
+        "max_rss_mb": max((record.get("max_rss_mb", 0) for record in records), default=0),
+        "read_bytes": sum(record.get("read_bytes", 0) for record in records),
+        "write_bytes": sum(record.get("write_bytes", 0) for record in records),
+        "items": dict(items),
+        "http_requests": sum(h.get("requests", 0) for h in http),
+        "http_errors": sum(h.get("errors", 0) for h in http),
+        "http_seconds": round(sum(h.get("seconds", 0) for h in http), 3),
+        "http_buckets": buckets,
+    }
+
+
+def _histogram_percentile_ms(buckets: list[int], q: float) -> float | None:
+    """Upper bound of the histogram bucket holding the q-th percentile (None without samples or above the last)."""
+    total = sum(buckets)
+    if not total:
+        return None
+    rank, seen = total * q / 100, 0
+    for le, n in zip(HTTP_BUCKETS_S, buckets):
+        seen += n
+        if seen >= rank:
+            return le * 1000
+    return None
+
+
+def stage_summaries(records: list[dict[str, typing.Any]]) -> list[dict[str, typing.Any]]:
+    """One entry per (stage, project), in the order the stages first ran."""
+    groups: dict[tuple[str, str | None], list[dict[str, typing.Any]]] = {}
+    for record in records:
+        groups.setdefault((record["stage"], record.get("project")), []).append(record)
+    summaries = []
+    for (stage, project), group in groups.items():
+        merged = _merge(group)
+        summaries.append({
+            "stage": stage,
+            "project": project,
+            "runs": len(group),
+            "status": "failed" if any(r.get("status") != "ok" for r in group) else "ok",
+            **{key: value for key, value in merged.items() if key != "http_buckets"},
+            "http_p50_ms": _histogram_percentile_ms(merged["http_buckets"], 50),
+            "http_p95_ms": _histogram_percentile_ms(merged["http_buckets"], 95),
+            "http_p99_ms": _histogram_percentile_ms(merged["http_buckets"], 99),
+            "_http_buckets": merged["http_buckets"],
+        })
+    return summaries
+
+
+def run_duration_s(record: dict[str, typing.Any]) -> float | None:
+    try:
+        return (datetime.fromisoformat(record["end"]) - datetime.fromisoformat(record["start"])).total_seconds()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _labels(**labels: typing.Any) -> str:
+    def escape(value: typing.Any) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def render_textfile(record: dict[str, typing.Any], summaries: list[dict[str, typing.Any]]) -> str:
+    """Prometheus text exposition of a run and its stages."""
+    lines: list[str] = []
+
+    def metric(name: str, kind: str, help_text: str, samples: list[tuple[str, typing.Any]]) -> None:
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+        lines.extend(f"{PREFIX}_{name}{labels} {value}" for labels, value in samples)
+
+    end = datetime.fromisoformat(record["end"]).timestamp() if record.get("end") else time.time()
+    metric("last_run_timestamp_seconds", "gauge", "End of the last pipeline run.", [("", end)])
+    duration = run_duration_s(record) or 0
+    metric("last_run_duration_seconds", "gauge", "Duration of the last pipeline run.", [("", duration)])
+    metric(
+        "last_run_success",
+        "gauge",
+        "1 when the last run completed or was skipped, 0 when it failed.",
+        [
+            (
+                _labels(status=record.get("status", ""), reason=record.get("reason", "")),
+                int(record.get("status") != "failed"),
+            )
+        ],
+    )
+    metric(
+        "last_run_downloaded_files",
+        "gauge",
+        "Files downloaded by the fetcher.",
+        [("", record.get("downloaded_files") or 0)],
+    )
+
+    def stage_labels(summary: dict[str, typing.Any], **extra: typing.Any) -> str:
+        return _labels(stage=summary["stage"], project=summary["project"] or "", **extra)
+
+    for name, key, help_text, scale in (
+        ("stage_wall_seconds", "wall_s", "Wall time of the stage.", 1),
+        ("stage_cpu_seconds", "cpu_s", "CPU time of the stage, waited-for children included.", 1),
+        ("stage_max_rss_bytes", "max_rss_mb", "Peak resident memory of the process running the stage.", 1024 * 1024),
+        ("stage_read_bytes", "read_bytes", "Bytes read by the stage (files and sockets).", 1),
+        ("stage_written_bytes", "write_bytes", "Bytes written by the stage (files and sockets).", 1),
+        ("stage_http_errors", "http_errors", "HTTP requests of the stage that failed or got a 4xx/5xx.", 1),
+    ):
+        metric(name, "gauge", help_text, [(stage_labels(s), round(s[key] * scale, 3)) for s in summaries])
+    metric(
+        "stage_success",
+        "gauge",
+        "1 when every run of the stage succeeded.",
+        [(stage_labels(s), int(s["status"] == "ok")) for s in summaries],
+    )
+    metric(
+        "stage_items",
+        "gauge",
+        "Items processed by the stage, by kind.",
+        [(stage_labels(s, item=item), n) for s in summaries for item, n in sorted(s["items"].items())],
+    )
+
+    name = "stage_http_request_duration_seconds"
+    lines.append(f"# HELP {PREFIX}_{name} Latency of the HTTP requests of the stage.")
+    lines.append(f"# TYPE {PREFIX}_{name} histogram")
+    for s in summaries:
+        cumulative = 0
+        for le, n in zip([*HTTP_BUCKETS_S, "+Inf"], s["_http_buckets"]):
+            cumulative += n
+            lines.append(f"{PREFIX}_{name}_bucket{stage_labels(s, le=le)} {cumulative}")
+        lines.append(f"{PREFIX}_{name}_sum{stage_labels(s)} {s['http_seconds']}")
+        lines.append(f"{PREFIX}_{name}_count{stage_labels(s)} {s['http_requests']}")
+    return "\n".join(lines) + "\n"
+
+
+def textfile_path(logs_dir: str) -> str:
+    return os.getenv("METRICS_TEXTFILE") or os.path.join(logs_dir, TEXTFILE_NAME)
+
+
+def write_textfile(path: str, text: str) -> None:
+    # Atomic: node_exporter may read it at any time
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def finalize_run(record: dict[str, typing.Any], logs_dir: str) -> dict[str, typing.Any]:
+    """The run record with its per-stage metrics and totals; also refreshes the Prometheus textfile."""
+    records = load_stage_records(logs_dir, record.get("run_id", ""))
+    summaries = stage_summaries(records)
+    totals = _merge(records)
+    record = {
+        **record,
+        "duration_s": run_duration_s(record),
+        "totals": {
+            "cpu_s": totals["cpu_s"],
+            "max_rss_mb": totals["max_rss_mb"],
+            "read_bytes": totals["read_bytes"],
+            "write_bytes": totals["write_bytes"],
+            "items": totals["items"],
+            "http_requests": totals["http_requests"],
+            "http_errors": totals["http_errors"],
+            "http_p95_ms": _histogram_percentile_ms(totals["http_buckets"], 95),
+        },
+        "stages": [{key: value for key, value in s.items() if not key.startswith("_")} for s in summaries],
+    }
+    tracing.export_run(record)
+    try:
+        write_textfile(textfile_path(logs_dir), render_textfile(record, summaries))
+    except OSError as e:
+        print(f"Warning: could not write the metrics textfile: {e}", file=sys.stderr)
+    return record
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Stage metrics for launcher.sh (see pipeline.py for the in-process runner)."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run a stage's main() with its arguments and record its metrics.")
+    run_parser.add_argument("stage", help="Stage module name, e.g. csv_generator.")
+    run_parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments of the stage.")
+    commands.add_parser(
+        "finalize", help="Read a runs.jsonl record on stdin, print it with the run's stage metrics, write the textfile."
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> typing.Any:
+    args = parse_args(argv)
+    load_dotenv()
+    if args.command == "finalize":
+        logs_dir = os.getenv("LOGS_PATH")
+        if not logs_dir:
+            raise SystemExit("Missing env var: LOGS_PATH")
+        print(json.dumps(finalize_run(json.loads(sys.stdin.read()), logs_dir)))
+        return 0
+
+    # profiling.py uses this module
+    from qfieldcloud_fetcher import profiling
+
+    module = importlib.import_module(f"qfieldcloud_fetcher.{args.stage}")
+    with measure(args.stage, args.args) as metrics, profiling.profile(args.stage, args.args):
+        status = module.main(args.args)
+        if status not in (None, 0):
+            metrics.status = "failed"
+    # Exits like `python3 <stage>.py` would
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Streaming picture pipeline: stage_to_nextcloud_raw, pictures_renamer,
+pictures_resizer and pictures_metadata_editor, one picture at a time.
+
+Run as separate stages, each of them walks the whole tree and hands over a full
+directory (renamed_pictures, renamed_compressed_pictures) to the next one, so the
+first picture reaches NextCloud only once every picture has been compressed.
+Here each picture of in/pictures is staged raw and renamed, compressed, then
+tagged and published on its own, by threads linked through bounded queues:
+at most --max-in-flight pictures wait between two steps.
+
+The same per-picture functions as the stages are used, so picture_map.json,
+pictures_stage_log.json and processed_ok.json are written as before and
+pictures_finalizer works unchanged. Pictures that cannot be published yet (no
+CSV row) and already published ones deferred by --changes-only stay in
+renamed_compressed_pictures, like with the separate stages; leftovers of
+earlier runs are picked up first.
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+import traceback
+import typing
+from collections import Counter
+from pathlib import Path
+
+import requests
+from dotenv import load_dotenv
+
+from qfieldcloud_fetcher import (
+    catalog,
+    fs_utils,
+    metrics,
+    pictures_metadata_editor,
+    pictures_renamer,
+    pictures_resizer,
+    stage_to_nextcloud_raw,
+)
+
+PICTURE_EXTS = (".jpg", ".jpeg")
+
+
+class Picture(typing.NamedTuple):
+    project: str
+    layer: str
+    path: str
+    # DCIM name of a renamed picture (None: looked up in picture_map.json)
+    original: str | None = None
+
+
+class StreamStats:
+    """Counters shared by the stream threads."""
+
+    def __init__(self) -> None:
+        self.counts: Counter[str] = Counter()
+        self.started = time.monotonic()
+        self.first_published_s: float | None = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] += 1
+            if name == "published" and self.first_published_s is None:
+                self.first_published_s = time.monotonic() - self.started
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Stage, rename, compress, tag and publish pictures one at a time (streaming picture stages)."
+    )
+    parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
+    parser.add_argument(
+        "--changes-only",
+        action="store_true",
+        help="Only publish pictures of samples inserted or updated since the last run (see change_capture.py).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=min(8, os.cpu_count() or 1),
+        help="Threads compressing and threads tagging pictures (default: CPU count, at most 8).",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=None,
+        help="Pictures waiting between two steps (default: twice --workers).",
+    )
+    return parser.parse_args(argv)
+
+
+def iter_pictures(root: str, project: str | None = None) -> typing.Iterator[Picture]:
+    """Pictures of <root>/<project>/<layer>/."""
+    for entry in catalog.files(root, project):
+        if not entry.name.startswith(".") and entry.name.lower().endswith(PICTURE_EXTS):
+            yield Picture(entry.project, entry.layer, entry.path)
+
+
+def _worker(
+    step: typing.Callable[[Picture], Picture | None],
+    inbox: "queue.Queue[Picture | None]",
+    outbox: "queue.Queue[Picture | None] | None",
+    stats: StreamStats,
+) -> None:
+    # None is the end-of-stream marker, one per worker
+    while (picture := inbox.get()) is not None:
+        try:
+            result = step(picture)
+        except Exception:
+            print(f"Error processing {picture.path}:")
+            traceback.print_exc()
+            stats.add("errors")
+            continue
+        if result is not None and outbox is not None:
+            outbox.put(result)
+
+
+def run_stream(
+    data_path: str,
+    nextcloud: str,
+    publisher: pictures_metadata_editor.PicturePublisher,
+    project: str | None = None,
+    workers: int = 4,
+    max_in_flight: int = 8,
+) -> StreamStats:
+    in_jpg_path = os.path.join(data_path, "in", "pictures")
+    renamed_path = os.path.join(data_path, "renamed_pictures")
+    compressed_path = os.path.join(data_path, "renamed_compressed_pictures")
+    raw_root = os.path.join(nextcloud, "pictures_raw")
+    manifest_path = os.path.join(data_path, "pending_remote_deletes.json")  # from fetcher
+    stage_log_path = os.path.join(data_path, "pictures_stage_log.json")
+    mapping_path = os.path.join(data_path, "picture_map.json")
+
+    stage_target = Path(raw_root) / project if project else Path(raw_root)
+    fs_utils.require_directory_access(stage_target, "stage pictures into the Nextcloud raw folder")
+
+    manifest = stage_to_nextcloud_raw.load_json(manifest_path, [])
+    local_to_remote = {os.path.abspath(e.get("local_path", "")): e for e in manifest if e.get("local_path")}
+    stage_log = stage_to_nextcloud_raw.load_json(stage_log_path, {})
+    staged: dict[str, dict] = {}
+    stats = StreamStats()
+
+    def stage_and_rename(picture: Picture) -> Picture | None:
+        status, rel = stage_to_nextcloud_raw.stage_picture(
+            Path(picture.path).resolve(), raw_root, local_to_remote, stage_log
+        )
+        if status == "error":
+            # Left in in/pictures: the finalizer needs the raw copy
+            stats.add("errors")
+            return None
+        staged[rel] = stage_log[rel]
+        root, filename = os.path.split(picture.path)
+        renamed = pictures_renamer.rename_picture(
+            root, filename, picture.project, picture.layer, renamed_path, mapping_path
+        )
+        if renamed is None:
+            stats.add("errors")
+            return None
+        stats.add("renamed")
+        return picture._replace(path=renamed, original=filename)
+
+    def compress(picture: Picture) -> Picture | None:
+        root, filename = os.path.split(picture.path)
+        compressed = pictures_resizer.compress_image(root, filename, picture.layer, picture.project, compressed_path)
+        if compressed is None:
+            stats.add("errors")
+            return None
+        stats.add("compressed")
+        return picture._replace(path=compressed)
+
+    def publish(picture: Picture) -> None:
+        stats.add(publisher.publish(picture.path, picture.project, picture.layer, picture.original))
+
+    # Listed before any thread moves pictures around
+    leftovers_compressed = list(iter_pictures(compressed_path, project))
+    leftovers_renamed = list(iter_pictures(renamed_path, project))
+    incoming = list(iter_pictures(in_jpg_path, project))
+    print(
+        f"Picture stream: incoming={len(incoming)}, leftovers renamed={len(leftovers_renamed)}, "
+        f"compressed={len(leftovers_compressed)}, workers={workers}, max_in_flight={max_in_flight}"
+    )
+
+    to_rename: queue.Queue[Picture | None] = queue.Queue(maxsize=max_in_flight)
+    to_compress: queue.Queue[Picture | None] = queue.Queue(maxsize=max_in_flight)
+    to_publish: queue.Queue[Picture | None] = queue.Queue(maxsize=max_in_flight)
+    # Renaming stays on one thread: unique names are picked by checking the target folder
+    steps = [
+        (to_rename, stage_and_rename, to_compress, 1),
+        (to_compress, compress, to_publish, workers),
+        (to_publish, publish, None, workers),
+    ]
+    threads = [
+        [
+            threading.Thread(target=_worker, args=(step, inbox, outbox, stats), name=f"{step.__name__}-{i}")
+            for i in range(count)
+        ]
+        for inbox, step, outbox, count in steps
+    ]
+    for step_threads in threads:
+        for thread in step_threads:
+            thread.start()
+
+    try:
+        for picture in leftovers_compressed:
+            to_publish.put(picture)
+        for picture in leftovers_renamed:
+            to_compress.put(picture)
+        for picture in incoming:
+            to_rename.put(picture)
+    finally:
+        # Close the steps in order, so that each one drains into the next before it ends
+        for (inbox, _step, _outbox, count), step_threads in zip(steps, threads):
+            for _ in range(count):
+                inbox.put(None)
+            for thread in step_threads:
+                thread.join()
+        # Only the entries of this run's scope: other projects may be staged in parallel
+        fs_utils.update_json(stage_log_path, staged)
+    return stats
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    if args.project:
+        print(f"Filtering to project: {args.project}")
+
+    load_dotenv()
+    data_path = os.getenv("DATA_PATH")
+    nextcloud = os.getenv("NEXTCLOUD_FOLDER")
+    if not data_path or not nextcloud:
+        raise SystemExit("Missing DATA_PATH or NEXTCLOUD_FOLDER in environment")
+
+    workers = max(1, args.workers)
+    publisher = pictures_metadata_editor.PicturePublisher(
+        data_path,
+        nextcloud,
+        pictures_metadata_editor.sample_id_pattern(requests.Session()),
+        changes_only=args.changes_only,
+        mapping=pictures_metadata_editor.load_json(os.path.join(data_path, "picture_map.json"), {}),
+    )
+    stats = run_stream(data_path, nextcloud, publisher, args.project, workers, args.max_in_flight or 2 * workers)
+
+    counts = stats.counts
+    metrics.count("pictures", counts["published"])
+    print(
+        f"Picture stream complete: renamed={counts['renamed']}, compressed={counts['compressed']}, "
+        f"published={counts['published']}, deferred_unchanged={counts['deferred']}, "
+        f"skipped={counts['skipped']}, errors={counts['errors']}"
+    )
+    if stats.first_published_s is not None:
+        print(f"First picture published after {stats.first_published_s:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
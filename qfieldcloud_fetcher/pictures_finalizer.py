@@ -6,6 +6,8 @@ from datetime import datetime
 from dotenv import load_dotenv
 from qfieldcloud_sdk import sdk  # type: ignore[import-untyped]
 
+from qfieldcloud_fetcher import metrics
+
 def load_json(path, default):
     try:
         with open(path, 'r', encoding='utf-8') as f:
@@ -21,7 +23,7 @@ def save_json_atomic(obj, path):
         json.dump(obj, f, indent=2, sort_keys=True)
     tmp.replace(p)
 
-def parse_args() -> argparse.Namespace:
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Finalize remote deletes and raw cleanup.")
     parser.add_argument("--project", default=None, help="Only process a single project by name.")
     parser.add_argument(
@@ -34,11 +36,11 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Delete remote pictures even if processed_ok/raw checks are not satisfied. Implies --enable-remote-delete.",
     )
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
-def main():
-    args = parse_args()
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
     if args.project:
         print(f"Filtering to project: {args.project}")
 
@@ -126,6 +128,8 @@ def main():
             keep.append(e); kept += 1
 
     save_json_atomic(keep, manifest_path)
+    metrics.count("remote_deleted", deleted_remote)
+    metrics.count("raw_removed", removed_raw)
     print(f"Finalize: remote_deleted={deleted_remote}, raw_removed={removed_raw}, still_pending={kept}")
     ts_path = os.path.join(data_path, ".last_finalize")
     with open(ts_path, "w", encoding="utf-8") as f:
@@ -1,18 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
 import shlex
 import os
 import re
 import shutil
 import subprocess
 import json
+from dataclasses import dataclass, field
 from datetime import datetime
 
+import pandas as pd
 import requests
 from dotenv import load_dotenv
 
+from qfieldcloud_fetcher import catalog, change_capture, fs_utils, metrics, table_io, tracing
+
 # ---------------------------
 # Small JSON helpers
 # ---------------------------
@@ -23,36 +26,51 @@ def load_json(path, default):
     except FileNotFoundError:
         return default
 
-def save_json_atomic(obj, path):
-    tmp = path + ".tmp"
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(obj, f, indent=2, sort_keys=True)
-    os.replace(tmp, path)
-
-def parse_args() -> argparse.Namespace:
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Update picture metadata and stage to NextCloud.")
     parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
     parser.add_argument("--progress-every", type=int, default=100, help="Print progress every N files.")
-    return parser.parse_args()
+    parser.add_argument(
+        "--changes-only",
+        action="store_true",
+        help="Only process pictures of samples inserted or updated since the last run (see change_capture.py).",
+    )
+    return parser.parse_args(argv)
 
 
-def find_matching_row(project_csv_dir: str, unique_id: str) -> tuple[dict[str, str] | None, str | None]:
+# sample_id -> (row, table path) per formatted project folder, built once per process
+_sample_indexes: dict[str, dict[str, tuple[dict[str, str], str]]] = {}
+
+
+def load_sample_index(project_csv_dir: str) -> dict[str, tuple[dict[str, str], str]]:
+    """Index every row of a project's formatted tables by sample_id (first occurrence wins)."""
+    index: dict[str, tuple[dict[str, str], str]] = {}
     if not os.path.isdir(project_csv_dir):
-        return None, None
+        return index
 
     for entry in sorted(os.listdir(project_csv_dir)):
-        if not entry.endswith(".csv"):
+        if not table_io.is_table_file(entry):
             continue
 
         csv_path = os.path.join(project_csv_dir, entry)
-        with open(csv_path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if "sample_id" in row and row["sample_id"] and row["sample_id"] == unique_id:
-                    return row, csv_path
+        try:
+            rows = list(table_io.read_rows(csv_path, schema="field_data"))
+        except pd.errors.EmptyDataError:
+            continue
+        for row in rows:
+            sample_id = row.get("sample_id")
+            if sample_id and sample_id not in index:
+                index[sample_id] = (row, csv_path)
+    return index
 
-    return None, None
+
+def find_matching_row(project_csv_dir: str, unique_id: str) -> tuple[dict[str, str] | None, str | None]:
+    if project_csv_dir not in _sample_indexes:
+        _sample_indexes[project_csv_dir] = load_sample_index(project_csv_dir)
+    match = _sample_indexes[project_csv_dir].get(unique_id)
+    if match is None:
+        return None, None
+    return match
 
 
 def build_exiftool_command(
@@ -94,8 +112,238 @@ def is_thumbnail_ifd1_error(result: subprocess.CompletedProcess[str]) -> bool:
     return "Error reading ThumbnailImage data in IFD1" in output
 
 
-def main() -> None:
-    args = parse_args()
+def run_exiftool(
+    command: list[str], env: dict[str, str], file: str, retry: bool = False
+) -> subprocess.CompletedProcess[str]:
+    with tracing.span("exiftool", {"file.name": file, "exiftool.retry": retry}) as span:
+        result = subprocess.run(command, capture_output=True, text=True, env=env)
+        span.set_attribute("process.exit.code", result.returncode)
+        if result.returncode != 0:
+            span.set_error(f"exit status {result.returncode}")
+    return result
+
+
+def sample_id_pattern(session: requests.Session) -> str:
+    """Regex of the sample ids in picture names, built from the project codes in Directus."""
+    # Request to directus to obtain projects codes
+    collection_url = "https://emi-collection.unifr.ch/directus/items/Projects"
+    column = "project_id"
+    params = {"sort[]": f"{column}"}
+    response = session.get(collection_url, params=params, timeout=30)
+    data = response.json()["data"]
+    project_names = [item[column] for item in data]
+
+    # Aggregate patterns and also include observation pattern (kept as in your original)
+    return "(" + "|".join(project_names) + ")_[0-9]{6}|[0-9]{14}|obs_[0-9]6,20}_[0-9]{6,20}"
+
+
+def exiftool_env() -> tuple[str, dict[str, str]]:
+    """Path of the vendored ExifTool and the environment to run it with."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    exif_bin = os.path.join(here, "exiftool", "exiftool")  # absolute path to vendored script/binary
+    env = os.environ.copy()
+
+    # If vendored Perl script with lib/ exists, make sure Perl can find modules
+    vend_lib = os.path.join(here, "exiftool", "lib")
+    if os.path.isdir(vend_lib):
+        env["PERL5LIB"] = vend_lib + (os.pathsep + env["PERL5LIB"] if "PERL5LIB" in env else "")
+    return exif_bin, env
+
+
+@dataclass
+class PicturePublisher:
+    """Tags pictures with their formatted CSV row and moves them to NextCloud."""
+
+    data_path: str
+    nextcloud: str
+    pattern: str
+    changes_only: bool = False
+    # picture_map.json, produced by pictures_renamer.py
+    mapping: dict = field(default_factory=dict)
+    # Per project change sets (None: no change set, process everything)
+    change_sets: dict[str, change_capture.ChangeSet | None] = field(default_factory=dict)
+    # processed_ok.json, loaded on first use by --changes-only
+    processed_ok: dict | None = None
+
+    def original_name(self, project: str, layer: str, file: str) -> str:
+        """DCIM name of a renamed picture, from the mapping."""
+        # Try direct key (unlikely with our schema)
+        m = self.mapping.get(f"{project}/{layer}/{file}")
+        if isinstance(m, dict) and m.get("original"):
+            return str(m["original"])
+        # Search by value 'renamed' == current file
+        for v in self.mapping.values():
+            if (
+                isinstance(v, dict)
+                and v.get("project") == project
+                and v.get("layer") == layer
+                and v.get("renamed") == file
+                and v.get("original")
+            ):
+                return str(v["original"])
+        return file  # fallback
+
+    def already_published(self, project: str, layer: str, file: str, original: str | None = None) -> bool:
+        """Whether processed_ok.json records this picture and its NextCloud copy is still there."""
+        if self.processed_ok is None:
+            self.processed_ok = load_json(os.path.join(self.data_path, "processed_ok.json"), {})
+        entry = self.processed_ok.get(f"{project}/{layer}/{original or self.original_name(project, layer, file)}")
+        return isinstance(entry, dict) and os.path.exists(str(entry.get("final_path") or ""))
+
+    @tracing.traced("publish picture", result="picture.status")
+    def publish(self, picture_path: str, project: str, layer: str, original: str | None = None) -> str:
+        """
+        Tag one picture and move it to NextCloud, recording it in processed_ok.json.
+        Returns "published", "deferred" (sample unchanged and picture already published,
+        see --changes-only) or "skipped".
+        """
+        file = os.path.basename(picture_path)
+        tracing.current().set_attributes({"file.path": picture_path, "pipeline.project": project})
+        out_csv_path = f"{self.data_path}/formatted_csv"
+        inat_jpg_path = f"{self.data_path}/inat_pictures"
+        nextcloud_path = f"{self.nextcloud}/pictures"
+        processed_ok_path = os.path.join(self.data_path, "processed_ok.json")
+
+        # Extract unique id with pattern
+        match = re.search(self.pattern, file)
+        if match:
+            unique_id = match.group()
+        else:
+            print(f"No unique identifier detected in {file}, skipping.")
+            return "skipped"
+
+        if self.changes_only:
+            if project not in self.change_sets:
+                self.change_sets[project] = change_capture.load_changes(self.data_path, project)
+            changes = self.change_sets[project]
+            # A picture waiting here is a change of its own unless it was already published:
+            # new pictures and leftovers of failed runs go through even when their row did not change
+            if (
+                changes is not None
+                and not changes.includes(unique_id)
+                and self.already_published(project, layer, file, original)
+            ):
+                return "deferred"
+
+        unique_prefixed = "emi_external_id:" + unique_id
+
+        project_csv_dir = os.path.join(out_csv_path, project)
+        row, csv_filename = find_matching_row(project_csv_dir, unique_id)
+        if row is None or csv_filename is None:
+            print(f"No corresponding CSV row found for {picture_path} (sample_id={unique_id})")
+            return "skipped"
+
+        date = row.get("date", "")
+        if date == "":
+            date = datetime.now().strftime("%Y%m%d%H%M%S")
+
+        formatted_date = datetime.strptime(date, "%Y%m%d%H%M%S")
+        collector = row.get("collector_fullname", "")
+        collector_prefix = "emi_collector:" + collector
+        inat_upload = row.get("inat_upload", "")
+        is_wild = row.get("is_wild", "")
+        orcid = row.get("collector_orcid", "")
+        orcid_prefix = "emi_collector_orcid:" + orcid
+        inat = row.get("collector_inat", "")
+        inat_prefix = "emi_collector_inat:" + inat
+        lon = row.get("longitude", "")
+        lat = row.get("latitude", "")
+
+        # --- ExifTool call (debug-friendly, same arguments you used) ---
+        exif_bin, env = exiftool_env()
+        command = build_exiftool_command(
+            exif_bin,
+            unique_prefixed,
+            collector_prefix,
+            orcid_prefix,
+            inat_prefix,
+            lat,
+            lon,
+            formatted_date,
+            picture_path,
+        )
+
+        # Run and show full diagnostics on failure
+        result = run_exiftool(command, env, file)
+        if result.returncode != 0 and is_thumbnail_ifd1_error(result):
+            retry_command = build_exiftool_command(
+                exif_bin,
+                unique_prefixed,
+                collector_prefix,
+                orcid_prefix,
+                inat_prefix,
+                lat,
+                lon,
+                formatted_date,
+                picture_path,
+                drop_ifd1_thumbnail=True,
+            )
+            print(f"Retrying ExifTool for {file} without corrupt IFD1 thumbnail")
+            result = run_exiftool(retry_command, env, file, retry=True)
+            command = retry_command
+
+        if result.returncode != 0:
+            print(f"ExifTool FAILED for {file} (exit={result.returncode})")
+            print("COMMAND:", format_command_for_log(command))
+            if result.stdout.strip():
+                print("STDOUT:", result.stdout.strip())
+            if result.stderr.strip():
+                print("STDERR:", result.stderr.strip())
+            # Don’t crash the pipeline; just skip this file
+            return "skipped"
+
+        print(f"Metadata for {file} successfully edited")
+
+        # Prepare iNaturalist import folder
+        if inat_upload == "1":
+            # Add if sample is wild or not in folder path
+            folder = os.path.join(inat_jpg_path, unique_id)
+            inat_folder = os.path.join(inat_jpg_path, "wild", unique_id) if is_wild == "1" else folder
+            # Move file to new folder
+            os.makedirs(inat_folder, exist_ok=True)
+            try:
+                shutil.copy2(picture_path, os.path.join(inat_folder, file))
+                print(f"{file} copied to iNaturalist import folder")
+            except Exception as e:
+                print(f"Error copying {file} to iNaturalist folder: {e}")
+        else:
+            print(f"Skipping copying {file} to iNaturalist folder, upload set to false")
+
+        # Add files to NextCloud
+        nextcloud_jpg_path = os.path.join(str(nextcloud_path), project, layer)
+        os.makedirs(nextcloud_jpg_path, exist_ok=True)
+        dest_path = os.path.join(nextcloud_jpg_path, file)
+        try:
+            shutil.move(picture_path, dest_path)
+            catalog.forget(picture_path)
+            print(f"{file} added to NextCloud")
+        except Exception as e:
+            print(f"Error moving {file} to NextCloud: {e}")
+            return "skipped"
+
+        # ---------------------------
+        # Mark processed OK (link renamed -> original DCIM name)
+        # ---------------------------
+        original = original or self.original_name(project, layer, file)
+        proc_key = f"{project}/{layer}/{original}"
+        entry = {
+            "project": project,
+            "layer": layer,
+            "original": original,
+            "final_name": file,
+            "final_path": dest_path,
+            "ok_at": datetime.utcnow().isoformat() + "Z",
+        }
+        try:
+            # Merged under a lock: other projects may be processed in parallel
+            fs_utils.update_json(processed_ok_path, {proc_key: entry})
+        except Exception as e:
+            print(f"Warning: could not update processed_ok.json: {e}")
+        return "published"
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
     if args.project:
         print(f"Filtering to project: {args.project}")
 
@@ -112,204 +360,35 @@ def main() -> None:
 
     # Construct folders paths
     in_jpg_path = f"{data_path}/renamed_compressed_pictures"
-    out_csv_path = f"{data_path}/formatted_csv"
-    inat_jpg_path = f"{data_path}/inat_pictures"
-    nextcloud_path = f"{nextcloud}/pictures"
 
     # Extra logs/inputs
     mapping_path = os.path.join(data_path, "picture_map.json")   # produced by pictures_renamer.py
-    processed_ok_path = os.path.join(data_path, "processed_ok.json")
 
-    # Request to directus to obtain projects codes
-    collection_url = "https://emi-collection.unifr.ch/directus/items/Projects"
-    column = "project_id"
-    params = {"sort[]": f"{column}"}
-    session = requests.Session()
-    response = session.get(collection_url, params=params, timeout=30)
-    data = response.json()["data"]
-    project_names = [item[column] for item in data]
-
-    # Aggregate patterns and also include observation pattern (kept as in your original)
-    pattern = "(" + "|".join(project_names) + ")_[0-9]{6}|[0-9]{14}|obs_[0-9]6,20}_[0-9]{6,20}"
-
-    # Preload mapping/processed logs
-    mapping = load_json(mapping_path, {})
-    processed_ok = load_json(processed_ok_path, {})
+    publisher = PicturePublisher(
+        data_path,
+        nextcloud,
+        sample_id_pattern(requests.Session()),
+        changes_only=args.changes_only,
+        mapping=load_json(mapping_path, {}),
+    )
+    deferred = 0
 
     processed = 0
     # Loop over pictures
-    for root, _dirs, files in os.walk(in_jpg_path):
-        for file in files:
-            if file.lower().endswith(".jpg"):
-                # Get layer
-                layer = os.path.basename(root)
-                # Get project
-                project = os.path.basename(os.path.dirname(root))
-                if args.project and project != args.project:
-                    continue
-
-                processed += 1
-                if args.progress_every > 0 and processed % args.progress_every == 0:
-                    print(f"Metadata progress: processed={processed}")
-
-                # Get picture path
-                picture_path = os.path.join(root, file)
-
-                # Extract unique id with pattern
-                match = re.search(pattern, file)
-                if match:
-                    unique_id = match.group()
-                else:
-                    print(f"No unique identifier detected in {file}, skipping.")
-                    continue
-
-                unique_prefixed = "emi_external_id:" + unique_id
-
-                project_csv_dir = os.path.join(out_csv_path, project)
-                row, csv_filename = find_matching_row(project_csv_dir, unique_id)
-                if row is None or csv_filename is None:
-                    print(f"No corresponding CSV row found for {picture_path} (sample_id={unique_id})")
-                    continue
-
-                date = row.get("date", "")
-                if date == "":
-                    date = datetime.now().strftime("%Y%m%d%H%M%S")
-
-                formatted_date = datetime.strptime(date, "%Y%m%d%H%M%S")
-                collector = row.get("collector_fullname", "")
-                collector_prefix = "emi_collector:" + collector
-                inat_upload = row.get("inat_upload", "")
-                is_wild = row.get("is_wild", "")
-                # (kept, though unused)
-                is_wild_prefix = {"emi_is_wild:": is_wild}
-                orcid = row.get("collector_orcid", "")
-                orcid_prefix = "emi_collector_orcid:" + orcid
-                inat = row.get("collector_inat", "")
-                inat_prefix = "emi_collector_inat:" + inat
-                lon = row.get("longitude", "")
-                lat = row.get("latitude", "")
-
-                # --- ExifTool call (debug-friendly, same arguments you used) ---
-                here = os.path.dirname(os.path.abspath(__file__))
-                exif_bin = os.path.join(here, "exiftool", "exiftool")  # absolute path to vendored script/binary
-                env = os.environ.copy()
-
-                # If vendored Perl script with lib/ exists, make sure Perl can find modules
-                vend_lib = os.path.join(here, "exiftool", "lib")
-                if os.path.isdir(vend_lib):
-                    env["PERL5LIB"] = vend_lib + (os.pathsep + env["PERL5LIB"] if "PERL5LIB" in env else "")
-
-                command = build_exiftool_command(
-                    exif_bin,
-                    unique_prefixed,
-                    collector_prefix,
-                    orcid_prefix,
-                    inat_prefix,
-                    lat,
-                    lon,
-                    formatted_date,
-                    picture_path,
-                )
-
-                # Run and show full diagnostics on failure
-                result = subprocess.run(command, capture_output=True, text=True, env=env)
-                if result.returncode != 0 and is_thumbnail_ifd1_error(result):
-                    retry_command = build_exiftool_command(
-                        exif_bin,
-                        unique_prefixed,
-                        collector_prefix,
-                        orcid_prefix,
-                        inat_prefix,
-                        lat,
-                        lon,
-                        formatted_date,
-                        picture_path,
-                        drop_ifd1_thumbnail=True,
-                    )
-                    print(f"Retrying ExifTool for {file} without corrupt IFD1 thumbnail")
-                    result = subprocess.run(retry_command, capture_output=True, text=True, env=env)
-                    command = retry_command
-
-                if result.returncode != 0:
-                    print(f"ExifTool FAILED for {file} (exit={result.returncode})")
-                    print("COMMAND:", format_command_for_log(command))
-                    if result.stdout.strip():
-                        print("STDOUT:", result.stdout.strip())
-                    if result.stderr.strip():
-                        print("STDERR:", result.stderr.strip())
-                    # Don’t crash the pipeline; just skip this file
-                    continue
-
-                print(f"Metadata for {file} successfully edited")
-
-                # Prepare iNaturalist import folder
-                if inat_upload == "1":
-                    # Add if sample is wild or not in folder path
-                    folder = os.path.join(inat_jpg_path, unique_id)
-                    inat_folder = os.path.join(inat_jpg_path, "wild", unique_id) if is_wild == "1" else folder
-                    # Move file to new folder
-                    os.makedirs(inat_folder, exist_ok=True)
-                    try:
-                        shutil.copy2(picture_path, os.path.join(inat_folder, file))
-                        print(f"{file} copied to iNaturalist import folder")
-                    except Exception as e:
-                        print(f"Error copying {file} to iNaturalist folder: {e}")
-                else:
-                    print(f"Skipping copying {file} to iNaturalist folder, upload set to false")
-
-                # Add files to NextCloud
-                nextcloud_jpg_path = os.path.join(str(nextcloud_path), project, layer)
-                os.makedirs(nextcloud_jpg_path, exist_ok=True)
-                dest_path = os.path.join(nextcloud_jpg_path, file)
-                try:
-                    shutil.move(picture_path, dest_path)
-                    print(f"{file} added to NextCloud")
-                except Exception as e:
-                    print(f"Error moving {file} to NextCloud: {e}")
-                    continue
-
-                # ---------------------------
-                # Mark processed OK (link renamed -> original DCIM name)
-                # ---------------------------
-                # Find original filename from mapping (produced by pictures_renamer.py)
-                original = None
-                # Try direct key (unlikely with our schema)
-                direct_key = f"{project}/{layer}/{file}"
-                m = mapping.get(direct_key)
-                if isinstance(m, dict) and m.get("original"):
-                    original = m["original"]
-                else:
-                    # Search by value 'renamed' == current file
-                    for k, v in mapping.items():
-                        if (
-                            isinstance(v, dict)
-                            and v.get("project") == project
-                            and v.get("layer") == layer
-                            and v.get("renamed") == file
-                        ):
-                            original = v.get("original")
-                            break
-                if not original:
-                    original = file  # fallback
-
-                proc_key = f"{project}/{layer}/{original}"
-                processed_ok[proc_key] = {
-                    "project": project,
-                    "layer": layer,
-                    "original": original,
-                    "final_name": file,
-                    "final_path": dest_path,
-                    "ok_at": datetime.utcnow().isoformat() + "Z",
-                }
-                try:
-                    save_json_atomic(processed_ok, processed_ok_path)
-                except Exception as e:
-                    print(f"Warning: could not update processed_ok.json: {e}")
-
-            else:
-                print(f"Skipping {file}, not a picture.")
-
-    print(f"Metadata processing complete: processed={processed}")
+    for picture in catalog.files(in_jpg_path, args.project):
+        if picture.name.lower().endswith(".jpg"):
+            processed += 1
+            if args.progress_every > 0 and processed % args.progress_every == 0:
+                print(f"Metadata progress: processed={processed}")
+
+            if publisher.publish(picture.path, picture.project, picture.layer) == "deferred":
+                deferred += 1
+
+        else:
+            print(f"Skipping {picture.name}, not a picture.")
+
+    metrics.count("pictures", processed)
+    print(f"Metadata processing complete: processed={processed}, deferred_unchanged={deferred}")
 
 
 if __name__ == "__main__":
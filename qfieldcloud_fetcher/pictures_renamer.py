@@ -4,25 +4,10 @@ import argparse
 import os
 import re
 import shutil
-import json
-from pathlib import Path
 
 from dotenv import load_dotenv
 
-def _load_json(path, default):
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return default
-
-def _save_json_atomic(obj, path):
-    p = Path(path)
-    p.parent.mkdir(parents=True, exist_ok=True)
-    tmp = p.with_suffix(p.suffix + ".tmp")
-    with open(tmp, 'w', encoding='utf-8') as f:
-        json.dump(obj, f, indent=2, sort_keys=True)
-    tmp.replace(p)
+from qfieldcloud_fetcher import catalog, fs_utils, metrics, tracing
 
 def _sanitize_basename(name: str) -> str:
     # replace spaces with underscores, keep underscores/digits/letters
@@ -42,14 +27,83 @@ def _unique_filename(dirpath: str, filename: str) -> str:
         i += 1
     return candidate
 
-def parse_args() -> argparse.Namespace:
+@tracing.traced("rename picture", result="file.destination")
+def rename_picture(
+    root: str, filename: str, project: str, layer: str, out_jpg_path: str, mapping_path: str
+) -> str | None:
+    """
+    Sanitize a picture's name and move it to <out_jpg_path>/<project>/<layer>/,
+    recording the original name in picture_map.json. Returns the new path, or None.
+    """
+    tracing.current().set_attributes({"file.path": os.path.join(root, filename), "pipeline.project": project})
+    base, ext = os.path.splitext(filename)
+
+    # Build sanitized new filename
+    sanitized = _sanitize_basename(base) + ext.lower()
+
+    src_path = os.path.join(root, filename)
+
+    # First, rename in place (in the staging 'in' tree) to the sanitized name
+    # If the sanitized name is identical, this is a no-op
+    src_sanitized_path = os.path.join(root, sanitized)
+    try:
+        if filename != sanitized:
+            # If sanitized name already exists in source dir, make it unique *in source dir*
+            if os.path.exists(src_sanitized_path):
+                sanitized = _unique_filename(root, sanitized)
+                src_sanitized_path = os.path.join(root, sanitized)
+            os.rename(src_path, src_sanitized_path)
+        else:
+            src_sanitized_path = src_path
+    except Exception as e:
+        print(f"Error renaming in place {src_path} -> {src_sanitized_path}: {e}")
+        return None
+
+    # Prepare destination folder: <out_jpg_path>/<project>/<layer>
+    processed_folder = os.path.join(out_jpg_path, project, layer)
+    os.makedirs(processed_folder, exist_ok=True)
+
+    # Ensure destination name is unique in the processed folder
+    new_filename = _unique_filename(processed_folder, os.path.basename(src_sanitized_path))
+    dest_path = os.path.join(processed_folder, new_filename)
+
+    try:
+        shutil.move(src_sanitized_path, dest_path)
+        catalog.moved(src_path, dest_path)
+        print(f"File {new_filename} processed successfully")
+
+        # --- Update the mapping only after a successful move ---
+        original_filename = filename  # original name as fetched from DCIM
+        key = f"{project}/{layer}/{original_filename}"
+        entry = {
+            "project": project,
+            "layer": layer,
+            "original": original_filename,
+            "renamed": new_filename,
+            "renamed_rel": f"{project}/{layer}/{new_filename}",
+        }
+        # Merged under a lock: other projects may be renamed in parallel
+        fs_utils.update_json(mapping_path, {key: entry})
+    except Exception as e:
+        print(f"Error moving file {src_sanitized_path} -> {dest_path}: {e}")
+        # Try to put it back to original name (best-effort)
+        try:
+            if src_sanitized_path != src_path and os.path.exists(src_sanitized_path):
+                os.rename(src_sanitized_path, src_path)
+        except Exception:
+            pass
+        return None
+    return dest_path
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Rename and normalize picture filenames.")
     parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
-def main() -> None:
-    args = parse_args()
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
     if args.project:
         print(f"Filtering to project: {args.project}")
 
@@ -64,85 +118,23 @@ def main() -> None:
     out_jpg_path = os.path.join(data_path, "renamed_pictures")
     mapping_path = os.path.join(data_path, "picture_map.json")
 
-    # Preload mapping once (we'll update and save incrementally)
-    mapping = _load_json(mapping_path, {})
-
     VALID_EXTS = {".jpg", ".jpeg"}
     processed = 0
 
-    for root, _dirs, files in os.walk(in_jpg_path):
-        # Determine layer & project from folder structure
-        layer = os.path.basename(root)
-        project = os.path.basename(os.path.dirname(root))
-        if args.project and project != args.project:
+    # Project & layer come from the folder structure
+    for picture in catalog.files(in_jpg_path, args.project):
+        # skip hidden/system files
+        if picture.name.startswith("."):
             continue
 
-        # Skip the top-level if it's the project container (no files directly there)
-        for filename in files:
-            # skip hidden/system files
-            if filename.startswith("."):
-                continue
-
-            base, ext = os.path.splitext(filename)
-            ext_lower = ext.lower()
-            if ext_lower not in VALID_EXTS:
-                continue  # only process JPG/JPEG
-
-            # Build sanitized new filename
-            sanitized = _sanitize_basename(base) + ext_lower
-
-            src_path = os.path.join(root, filename)
-
-            # First, rename in place (in the staging 'in' tree) to the sanitized name
-            # If the sanitized name is identical, this is a no-op
-            src_sanitized_path = os.path.join(root, sanitized)
-            try:
-                if filename != sanitized:
-                    # If sanitized name already exists in source dir, make it unique *in source dir*
-                    if os.path.exists(src_sanitized_path):
-                        sanitized = _unique_filename(root, sanitized)
-                        src_sanitized_path = os.path.join(root, sanitized)
-                    os.rename(src_path, src_sanitized_path)
-                else:
-                    src_sanitized_path = src_path
-            except Exception as e:
-                print(f"Error renaming in place {src_path} -> {src_sanitized_path}: {e}")
-                continue
-
-            # Prepare destination folder: DATA_PATH/renamed_pictures/<project>/<layer>
-            processed_folder = os.path.join(out_jpg_path, project, layer)
-            os.makedirs(processed_folder, exist_ok=True)
-
-            # Ensure destination name is unique in the processed folder
-            new_filename = _unique_filename(processed_folder, os.path.basename(src_sanitized_path))
-            dest_path = os.path.join(processed_folder, new_filename)
-
-            try:
-                shutil.move(src_sanitized_path, dest_path)
-                processed += 1
-                print(f"File {new_filename} processed successfully")
-
-                # --- Update the mapping only after a successful move ---
-                original_filename = filename  # original name as fetched from DCIM
-                key = f"{project}/{layer}/{original_filename}"
-                mapping[key] = {
-                    "project": project,
-                    "layer": layer,
-                    "original": original_filename,
-                    "renamed": new_filename,
-                    "renamed_rel": f"{project}/{layer}/{new_filename}",
-                }
-                _save_json_atomic(mapping, mapping_path)
-
-            except Exception as e:
-                print(f"Error moving file {src_sanitized_path} -> {dest_path}: {e}")
-                # Try to put it back to original name (best-effort)
-                try:
-                    if src_sanitized_path != src_path and os.path.exists(src_sanitized_path):
-                        os.rename(src_sanitized_path, src_path)
-                except Exception:
-                    pass
+        if os.path.splitext(picture.name)[1].lower() not in VALID_EXTS:
+            continue  # only process JPG/JPEG
+
+        root = os.path.dirname(picture.path)
+        if rename_picture(root, picture.name, picture.project, picture.layer, out_jpg_path, mapping_path):
+            processed += 1
 
+    metrics.count("pictures", processed)
     print(f"Rename complete: processed={processed}")
 
 
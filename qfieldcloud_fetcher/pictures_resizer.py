@@ -9,6 +9,8 @@ from typing import Optional
 from dotenv import load_dotenv
 from PIL import Image, ImageOps, UnidentifiedImageError
 
+from qfieldcloud_fetcher import catalog, metrics, tracing
+
 # Try to enable HEIF/HEIC support transparently
 try:
     from pillow_heif import register_heif_opener  # type: ignore
@@ -50,9 +52,11 @@ def _save_jpeg_to_tmp(img: Image.Image, tmp_dir: str, base_name: str, quality: i
     return tmp_path
 
 
-def compress_image(root: str, filename: str, layer: str, project: str) -> None:
+@tracing.traced("compress picture", result="file.destination")
+def compress_image(root: str, filename: str, layer: str, project: str, out_root: str | None = None) -> str | None:
+    """Move or compress a picture into <out_root>/<project>/<layer>/. Returns the new path, or None."""
     filepath = os.path.join(root, filename)
-    processed_folder = os.path.join(out_jpg_path, project, layer)
+    processed_folder = os.path.join(out_root or out_jpg_path, project, layer)
     os.makedirs(processed_folder, exist_ok=True)
 
     # If already small enough, just move as-is
@@ -60,24 +64,26 @@ def compress_image(root: str, filename: str, layer: str, project: str) -> None:
         current_size = os.path.getsize(filepath)
     except FileNotFoundError:
         print(f"⚠️ Missing file, skipping: {filepath}")
-        return
+        return None
+    tracing.current().set_attributes({"file.path": filepath, "file.size": current_size, "pipeline.project": project})
 
     if current_size <= MAX_SIZE:
         # Move file to new folder
         dst = os.path.join(processed_folder, filename)
         shutil.move(filepath, dst)
+        catalog.moved(filepath, dst)
         print(f"{filepath} is already small enough.")
-        return
+        return dst
 
     # Open the image (handle unreadable images gracefully)
     try:
         img = Image.open(filepath)
     except UnidentifiedImageError:
         print(f"⚠️ Skipping (unreadable image; consider installing pillow-heif for HEIF/HEIC): {filepath}")
-        return
+        return None
     except Exception as e:
         print(f"⚠️ Skipping (error opening): {filepath} — {e}")
-        return
+        return None
 
     print(f"Compressing {filepath}...")
 
@@ -105,57 +111,55 @@ def compress_image(root: str, filename: str, layer: str, project: str) -> None:
         # If for some reason saving failed
         if not best_tmp_path or not os.path.exists(best_tmp_path):
             print(f"⚠️ Failed to compress (no output written): {filepath}")
-            return
+            return None
 
         # Decide destination filename: keep .jpg extension
         dest_path = os.path.join(processed_folder, os.path.splitext(filename)[0] + ".jpg")
 
         # Move the best temp file into place
         os.replace(best_tmp_path, dest_path)
+        catalog.record(dest_path)
 
     # Only after successful write do we remove the original from input tree
     try:
         os.remove(filepath)
+        catalog.forget(filepath)
     except Exception:
         # Not critical; continue
         pass
 
     final_size = os.path.getsize(dest_path)
+    tracing.current().set_attribute("file.compressed_size", final_size)
     if final_size <= MAX_SIZE:
         print(f"{dest_path} compressed successfully.")
     else:
         # This can happen for extremely large images; still moved the best attempt
         print(f"⚠️ {dest_path} could not reach ≤ {MAX_SIZE} bytes; kept best effort ({final_size} bytes).")
+    return dest_path
 
 
-def parse_args() -> argparse.Namespace:
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Compress renamed pictures for downstream use.")
     parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
     parser.add_argument("--progress-every", type=int, default=100, help="Print progress every N files.")
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
-def main() -> None:
-    args = parse_args()
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
     if args.project:
         print(f"Filtering to project: {args.project}")
 
     processed = 0
-    for root, _dirs, files in os.walk(in_jpg_path):
-        # Get layer
-        layer = os.path.basename(root)
-        # Get project
-        project = os.path.basename(os.path.dirname(root))
-        if args.project and project != args.project:
-            continue
-        for filename in files:
-            # Your pipeline only targets JPG-named files; HEIF wrongly named as .jpg will still be handled
-            if filename.lower().endswith(".jpg"):
-                compress_image(root, filename, layer, project)
-                processed += 1
-                if args.progress_every > 0 and processed % args.progress_every == 0:
-                    print(f"Compression progress: processed={processed}")
-
+    for picture in catalog.files(in_jpg_path, args.project):
+        # Your pipeline only targets JPG-named files; HEIF wrongly named as .jpg will still be handled
+        if picture.name.lower().endswith(".jpg"):
+            compress_image(os.path.dirname(picture.path), picture.name, picture.layer, picture.project)
+            processed += 1
+            if args.progress_every > 0 and processed % args.progress_every == 0:
+                print(f"Compression progress: processed={processed}")
+
+    metrics.count("pictures", processed)
     print(f"Compression complete: processed={processed}")
 
 
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""
+Run the whole pipeline of launcher.sh in a single Python process.
+
+launcher.sh starts a new `poetry run python3` per stage, so every stage pays the
+interpreter start-up, re-imports pandas/pyproj/requests, reloads .env and logs
+into Directus again. Here the stage modules are imported once and their main()
+is called with the same arguments the launcher would pass. The options come from
+the same environment variables. Directus tokens are shared through directus_auth.
+
+The launcher's bookkeeping is kept:
+
+- LOGS_PATH/pipeline_<RUN_ID>.log (and pipeline_latest.log) gets the whole run;
+- LOGS_PATH/<stage>.log gets each stage's output;
+- one line per run is appended to LOGS_PATH/runs.jsonl, with the metrics of
+  every stage (see metrics.py);
+- the pipeline stops after the fetcher when DATA_PATH/.qfc_changed is missing.
+
+A stage fails when it raises or exits with a non-zero status; the run stops there.
+Set PIPELINE_IN_PROCESS=1 to make launcher.sh hand over to this module.
+
+With --workers N (or PIPELINE_WORKERS), the projects are processed concurrently
+on N worker processes, each with its own logs in LOGS_PATH/projects/<project>/
+and its own status lines in runs.jsonl. Every project runs CSV_CHAIN and then
+PICTURE_CHAIN. DIRECTUS_STAGES run once, in the main process, as soon as every
+project's CSV chain is done, so a slow picture chain holds up nobody. The
+finalizer and the change-set commit run last, only when everything succeeded.
+State files shared between projects are merged under a lock (fs_utils.update_json).
+
+With --overlap (or PIPELINE_OVERLAP), the fetcher itself runs in a worker process
+and publishes a "fetched" event in DATA_PATH/fetched/ as soon as a project is
+downloaded. That project's chains start right away, while the fetcher keeps
+downloading the next ones. The Directus stages then also wait for the fetcher.
+
+With PICTURE_STREAM=1, picture_stream.py replaces the four picture stages, in
+every mode.
+
+With --profile STAGES (or PIPELINE_PROFILE), the selected stages run under
+cProfile and tracemalloc (see profiling.py). With PIPELINE_TRACING=1, the run
+is traced to LOGS_PATH/traces/<RUN_ID>.jsonl (see tracing.py).
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import traceback
+import typing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from contextlib import ExitStack, redirect_stderr, redirect_stdout, suppress
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from qfieldcloud_fetcher import metrics, profiling, tracing
+
+# Loads environment variables
+load_dotenv()
+
+# Access the environment variables
+data_path = os.getenv("DATA_PATH")
+logs_path = os.getenv("LOGS_PATH")
+
+LOG_SIZE_LIMIT_MB = 100
+LOG_MAX_AGE_DAYS = 14
+# With --overlap, how often the main process looks for new "fetched" events
+EVENT_POLL_S = 1.0
+
+SEQUENTIAL_STAGES = (
+    "change_capture",
+    "stage_to_nextcloud_raw",
+    "csv_generator",
+    "csv_formatter",
+    "fields_creator",
+    "db_updater",
+    "directus_link_maker",
+    "pictures_renamer",
+    "pictures_resizer",
+    "pictures_metadata_editor",
+    "pictures_finalizer",
+)
+# With --workers, these chains run per project in worker processes
+CSV_CHAIN = ("change_capture", "csv_generator", "csv_formatter")
+PICTURE_CHAIN = ("stage_to_nextcloud_raw", "pictures_renamer", "pictures_resizer", "pictures_metadata_editor")
+# and these once all CSV chains are done (db_updater checks sample_ids across projects)
+DIRECTUS_STAGES = ("fields_creator", "db_updater", "directus_link_maker")
+# With PICTURE_STREAM, picture_stream.py takes over from the PICTURE_CHAIN stages
+STREAM_CHAIN = ("picture_stream",)
+
+
+class StageFailed(Exception):
+    def __init__(self, stage: str):
+        # The stage is the only argument so that the exception survives pickling
+        super().__init__(stage)
+        self.stage = stage
+
+    def __str__(self) -> str:
+        return f"{self.stage} failed"
+
+
+class Tee:
+    """Text stream writing to several streams at once."""
+
+    def __init__(self, *streams: typing.TextIO):
+        self.streams = streams
+
+    def write(self, text: str) -> int:
+        for stream in self.streams:
+            stream.write(text)
+        return len(text)
+
+    def flush(self) -> None:
+        for stream in self.streams:
+            stream.flush()
+
+    def isatty(self) -> bool:
+        return False
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run fetcher and every downstream stage in one process (same environment as launcher.sh)."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("PIPELINE_WORKERS") or 1),
+        help="Run the per-project CSV and picture chains of several projects concurrently on N worker "
+        "processes (default: PIPELINE_WORKERS or 1, sequential).",
+    )
+    parser.add_argument(
+        "--overlap",
+        action="store_true",
+        default=env_flag("PIPELINE_OVERLAP"),
+        help="Start each project's chains as soon as the fetcher has downloaded it, while it fetches the next "
+        "ones (default: PIPELINE_OVERLAP). The fetcher then runs non-interactively.",
+    )
+    parser.add_argument(
+        "--profile",
+        default=os.getenv("PIPELINE_PROFILE") or "",
+        metavar="STAGES",
+        help="Run these stages (comma-separated, or 'all') under cProfile and tracemalloc; reports go to "
+        "LOGS_PATH/profile_<RUN_ID>_<stage>.* (default: PIPELINE_PROFILE).",
+    )
+    return parser.parse_args(argv)
+
+
+def iso_ts() -> str:
+    return datetime.now().astimezone().isoformat(timespec="seconds")
+
+
+def env_flag(name: str) -> bool:
+    return os.getenv(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def fetcher_args() -> list[str]:
+    mode = os.getenv("FETCHER_DEFAULT_MODE") or "interactive"
+    if mode not in ("interactive", "dry-run"):
+        print(f"Warning: unknown FETCHER_DEFAULT_MODE='{mode}', defaulting to interactive")
+        mode = "interactive"
+    args = [f"--{mode}"]
+    if env_flag("FETCHER_DELTAS"):
+        args.append("--deltas")
+    return args
+
+
+def events_dir() -> str:
+    return os.path.join(str(data_path), "fetched")
+
+
+def overlap_fetcher_args() -> list[str]:
+    # The fetcher runs in a worker process, which has no stdin for the interactive menu
+    return [arg for arg in fetcher_args() if arg != "--interactive"] + ["--events-dir", events_dir()]
+
+
+def stage_options(project: str | None = None) -> dict[str, list[str]]:
+    """argv of every downstream stage, from the launcher.sh environment variables."""
+    project = project or os.getenv("PIPELINE_PROJECT") or ""
+    project_args = ["--project", project] if project else []
+    csv_stage_args = ["--force"] if env_flag("FORCE_CSV_STAGES") else []
+    changes_only_args = ["--changes-only"] if env_flag("PIPELINE_CHANGES_ONLY") else []
+    db_updater_args = ["--allow-existing-sample-id-overwrite"] if env_flag("ALLOW_EXISTING_SAMPLE_ID_OVERWRITE") else []
+    finalizer_args = ["--enable-remote-delete"] if env_flag("ENABLE_REMOTE_DELETE") else []
+    if env_flag("FORCE_REMOTE_DELETE"):
+        finalizer_args.append("--force-remote-delete")
+    return {
+        "change_capture": project_args,
+        "stage_to_nextcloud_raw": project_args,
+        "csv_generator": project_args + csv_stage_args,
+        "csv_formatter": project_args + csv_stage_args + changes_only_args,
+        "fields_creator": project_args + csv_stage_args,
+        "db_updater": project_args + db_updater_args + csv_stage_args + changes_only_args,
+        "directus_link_maker": project_args,
+        "pictures_renamer": project_args,
+        "pictures_resizer": project_args,
+        "pictures_metadata_editor": project_args + changes_only_args,
+        "picture_stream": project_args + changes_only_args,
+        "pictures_finalizer": project_args + finalizer_args,
+    }
+
+
+def chain_stages(stages: typing.Iterable[str], project: str | None = None) -> list[tuple[str, list[str]]]:
+    options = stage_options(project)
+    return [(stage, options[stage]) for stage in stages]
+
+
+def picture_chain() -> tuple[str, ...]:
+    return STREAM_CHAIN if env_flag("PICTURE_STREAM") else PICTURE_CHAIN
+
+
+def sequential_stages() -> tuple[str, ...]:
+    if picture_chain() == PICTURE_CHAIN:
+        return SEQUENTIAL_STAGES
+    stages = tuple(stage for stage in SEQUENTIAL_STAGES if stage not in PICTURE_CHAIN)
+    return stages[:-1] + STREAM_CHAIN + stages[-1:]
+
+
+def downstream_stages() -> list[tuple[str, list[str]]]:
+    """(stage, argv) of every stage after the fetcher, in launcher.sh order."""
+    stages = chain_stages(sequential_stages())
+    return [*stages, ("change_capture", [*stages[0][1], "--commit"])]
+
+
+def run_stage(stage: str, argv: list[str], logs_dir: str) -> None:
+    """Call a stage's main(argv), teeing its output to LOGS_PATH/<stage>.log. Raises StageFailed."""
+    logfile = os.path.join(logs_dir, f"{stage}.log")
+    print(f"--- {iso_ts()} :: running {' '.join([f'{stage}.py', *argv])} ---")
+    with open(logfile, "a", encoding="utf-8", buffering=1) as log:
+        out, err = Tee(sys.stdout, log), Tee(sys.stderr, log)
+        with redirect_stdout(out), redirect_stderr(err):
+            with metrics.measure(stage, argv) as stage_metrics, profiling.profile(stage, argv):
+                try:
+                    module = importlib.import_module(f"qfieldcloud_fetcher.{stage}")
+                    status = module.main(argv)
+                except SystemExit as e:
+                    status = e.code
+                except Exception:
+                    traceback.print_exc()
+                    status = 1
+                if status not in (None, 0):
+                    stage_metrics.status = "failed"
+            if isinstance(status, str):
+                # What the interpreter prints for SystemExit("message")
+                print(status, file=sys.stderr)
+    if status not in (None, 0):
+        print(f"!!! {stage} failed — see {logfile}")
+        raise StageFailed(stage)
+    print(f"--- {iso_ts()} :: finished {stage}.py ---")
+
+
+def read_fetch_summary() -> dict[str, typing.Any]:
+    try:
+        with open(os.path.join(str(data_path), "last_fetch_summary.json"), encoding="utf-8") as f:
+            summary: dict[str, typing.Any] = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    print(
+        f"Fetcher summary: projects_selected='{','.join(summary.get('projects_selected') or [])}', "
+        f"downloaded_files={summary.get('downloaded_files') or 0}, "
+        f"had_changes={str(bool(summary.get('had_changes'))).lower()}"
+    )
+    return summary
+
+
+def fetch_changed() -> bool:
+    return os.path.exists(os.path.join(str(data_path), ".qfc_changed"))
+
+
+def record_status(
+    run_id: str, start: str, status: str, reason: str, summary: dict[str, typing.Any], logs_dir: str
+) -> None:
+    """Append the run to runs.jsonl, with the same fields as launcher.sh and the metrics of its stages."""
+    record = {
+        "run_id": run_id,
+        "start": start,
+        "end": iso_ts(),
+        "status": status,
+        "reason": reason,
+        "projects_selected": ",".join(summary.get("projects_selected") or []),
+        "downloaded_files": summary.get("downloaded_files") or 0,
+        "had_changes": bool(summary.get("had_changes")),
+    }
+    record = metrics.finalize_run(record, logs_dir)
+    with open(os.path.join(logs_dir, "runs.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def prune_logs(logs_dir: str) -> None:
+    total = 0
+    for root, _dirs, files in os.walk(logs_dir):
+        for name in files:
+            with suppress(OSError):
+                total += os.path.getsize(os.path.join(root, name))
+    size_mb = total // (1024 * 1024)
+    if size_mb <= LOG_SIZE_LIMIT_MB:
+        return
+    print(f"Logs folder {size_mb} MB > {LOG_SIZE_LIMIT_MB} MB — pruning older logs")
+    cutoff = datetime.now().timestamp() - LOG_MAX_AGE_DAYS * 86400
+    # Run logs (and profiles) of the main process and, with --workers, of every project (keeps runs.jsonl)
+    for root, _dirs, files in os.walk(logs_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            run_log = name.startswith("pipeline_") and name.endswith(".log")
+            if not (run_log or name.startswith("profile_")) or os.path.islink(path):
+                continue
+            if os.path.getmtime(path) < cutoff:
+                print(path)
+                os.remove(path)
+
+
+def selected_projects() -> list[str]:
+    """Project folders of the fetched GPKGs and pictures (PIPELINE_PROJECT narrows it to one)."""
+    only = os.getenv("PIPELINE_PROJECT") or None
+    projects: set[str] = set()
+    for root in (os.path.join(str(data_path), "in", "gpkg"), os.path.join(str(data_path), "in", "pictures")):
+        if os.path.isdir(root):
+            with os.scandir(root) as entries:
+                projects.update(entry.name for entry in entries if entry.is_dir())
+    return sorted(project for project in projects if only is None or project == only)
+
+
+def fetched_projects() -> list[str]:
+    """Projects the fetcher has published a "fetched" event for (PIPELINE_PROJECT narrows it to one)."""
+    only = os.getenv("PIPELINE_PROJECT") or None
+    if not os.path.isdir(events_dir()):
+        return []
+    with os.scandir(events_dir()) as entries:
+        projects = [entry.name.removesuffix(".json") for entry in entries if entry.name.endswith(".json")]
+    return sorted(project for project in projects if only is None or project == only)
+
+
+def run_fetcher(argv: list[str], logs_dir: str) -> str | None:
+    """Worker process of --overlap: run the fetcher. Returns the failure reason, or None."""
+    try:
+        run_stage("fetcher", argv, logs_dir)
+    except StageFailed as e:
+        return f"script_failed:{e.stage}"
+    return None
+
+
+def run_chain(project: str, stages: list[tuple[str, list[str]]], logs_dir: str, run_id: str) -> dict[str, str]:
+    """
+    Worker process: run one chain of stages for one project. Its output goes to
+    LOGS_PATH/projects/<project>/ only. Returns the status line for runs.jsonl.
+    """
+    project_logs = os.path.join(logs_dir, "projects", project)
+    os.makedirs(project_logs, exist_ok=True)
+    result = {"project": project, "start": iso_ts(), "status": "ok", "reason": "completed"}
+    log_path = os.path.join(project_logs, f"pipeline_{run_id}.log")
+    attributes = {"pipeline.project": project, "pipeline.stages": [stage for stage, _argv in stages]}
+    with open(log_path, "a", encoding="utf-8", buffering=1) as log, tracing.span("project chain", attributes) as span:
+        with redirect_stdout(Tee(log)), redirect_stderr(Tee(log)):
+            try:
+                for stage, argv in stages:
+                    run_stage(stage, argv, project_logs)
+            except StageFailed as e:
+                result.update(status="failed", reason=f"script_failed:{e.stage}")
+            except Exception:
+                traceback.print_exc()
+                result.update(status="failed", reason="error")
+        if result["status"] != "ok":
+            span.set_error(result["reason"])
+    result["end"] = iso_ts()
+    return result
+
+
+def record_chain(run_id: str, chain: str, result: dict[str, str], logs_dir: str) -> None:
+    with open(os.path.join(logs_dir, "runs.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps({"run_id": run_id, "chain": chain, **result}) + "\n")
+
+
+def run_parallel(run_id: str, logs_dir: str, workers: int, fetch_argv: list[str] | None = None) -> str | None:
+    """
+    Per-project chains on worker processes. The Directus stages run in this process
+    once every CSV chain is done; a project's picture chain starts as soon as its own
+    CSV chain is done and does not wait for them. Returns the failure reason, or None.
+
+    With fetch_argv, the fetcher runs alongside on its own process and each project
+    is picked up from its "fetched" event; the Directus stages also wait for the fetcher.
+    """
+    failure: str | None = None
+    submitted: set[str] = set()
+    directus_done = False
+    with ExitStack() as stack:
+        pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+        running: dict[Future, tuple[str, str]] = {}
+
+        def submit(project: str, chain: str, stages: tuple[str, ...]) -> None:
+            future = pool.submit(run_chain, project, chain_stages(stages, project), logs_dir, run_id)
+            running[future] = (project, chain)
+
+        fetch: Future | None = None
+        if fetch_argv is None:
+            projects = selected_projects()
+            print(f"Parallel mode: {len(projects)} project(s) on {workers} worker(s)")
+            for project in projects:
+                submitted.add(project)
+                submit(project, "csv", CSV_CHAIN)
+        else:
+            print(f"Overlap mode: projects start as soon as they are fetched, on {workers} worker(s)")
+            fetch = stack.enter_context(ProcessPoolExecutor(max_workers=1)).submit(run_fetcher, fetch_argv, logs_dir)
+
+        while True:
+            if fetch is not None:
+                # Checked first: once the fetcher is done, every event it published is on disk
+                fetch_done = fetch.done()
+                for project in fetched_projects():
+                    if project not in submitted:
+                        print(f"[{project}] fetched")
+                        submitted.add(project)
+                        submit(project, "csv", CSV_CHAIN)
+                if fetch_done:
+                    failure = failure or fetch.result()
+                    fetch = None
+
+            csv_running = any(chain == "csv" for _project, chain in running.values())
+            if fetch is None and submitted and not csv_running and not directus_done and failure is None:
+                directus_done = True
+                try:
+                    for stage, argv in chain_stages(DIRECTUS_STAGES):
+                        run_stage(stage, argv, logs_dir)
+                except StageFailed as e:
+                    failure = f"script_failed:{e.stage}"
+            if fetch is None and not running:
+                return failure
+
+            waiting = [*running, fetch] if fetch is not None else list(running)
+            timeout = EVENT_POLL_S if fetch is not None else None
+            done, _pending = wait(waiting, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future not in running:
+                    continue
+                project, chain = running.pop(future)
+                result = future.result()
+                record_chain(run_id, chain, result, logs_dir)
+                print(f"[{project}] {chain} chain {result['status']} ({result['reason']})")
+                if result["status"] != "ok":
+                    failure = failure or f"project_failed:{project}:{result['reason']}"
+                elif chain == "csv":
+                    submit(project, "pictures", picture_chain())
+
+
+def run(run_id: str, logs_dir: str, workers: int = 1, overlap: bool = False) -> int:
+    start = iso_ts()
+    summary: dict[str, typing.Any] = {}
+    print(f"=== {start} :: pipeline start (RUN_ID={run_id}) ===")
+    print(f"DATA_PATH: {data_path}")
+    print(f"LOGS_PATH: {logs_dir}")
+    prune_logs(logs_dir)
+
+    try:
+        if not overlap:
+            run_stage("fetcher", fetcher_args(), logs_dir)
+            summary = read_fetch_summary()
+            if not fetch_changed():
+                print("No QFieldCloud changes — stopping pipeline.")
+                record_status(run_id, start, "skipped", "no_changes", summary, logs_dir)
+                return 0
+
+        if workers > 1 or overlap:
+            failure = run_parallel(run_id, logs_dir, workers, overlap_fetcher_args() if overlap else None)
+            if overlap:
+                summary = read_fetch_summary()
+            if failure:
+                record_status(run_id, start, "failed", failure, summary, logs_dir)
+                return 1
+            if overlap and not fetch_changed():
+                print("No QFieldCloud changes — stopping pipeline.")
+                record_status(run_id, start, "skipped", "no_changes", summary, logs_dir)
+                return 0
+            stages = chain_stages(["pictures_finalizer"])
+            stages.append(("change_capture", stage_options()["change_capture"] + ["--commit"]))
+        else:
+            stages = downstream_stages()
+        for stage, argv in stages:
+            run_stage(stage, argv, logs_dir)
+    except StageFailed as e:
+        record_status(run_id, start, "failed", f"script_failed:{e.stage}", summary, logs_dir)
+        return 1
+    except BaseException:
+        print(f"!! {iso_ts()} pipeline failed")
+        record_status(run_id, start, "failed", "unexpected_exit", summary, logs_dir)
+        raise
+
+    record_status(run_id, start, "ok", "completed", summary, logs_dir)
+    print(f"=== {iso_ts()} :: pipeline completed successfully (RUN_ID={run_id}) ===")
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    if not data_path or not logs_path:
+        raise SystemExit("Missing env vars: DATA_PATH, LOGS_PATH")
+    os.makedirs(data_path, exist_ok=True)
+    os.makedirs(logs_path, exist_ok=True)
+
+    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    # Stages share their directory scans within a run (see catalog.py)
+    os.environ["RUN_ID"] = run_id
+    # Read by profiling.py, in this process and in the workers
+    os.environ["PIPELINE_PROFILE"] = args.profile
+    pipeline_log = os.path.join(logs_path, f"pipeline_{run_id}.log")
+    latest = os.path.join(logs_path, "pipeline_latest.log")
+    with suppress(FileNotFoundError):
+        os.remove(latest)
+    with suppress(OSError):
+        os.symlink(os.path.basename(pipeline_log), latest)
+
+    with open(pipeline_log, "a", encoding="utf-8", buffering=1) as log:
+        out, err = Tee(sys.stdout, log), Tee(sys.stderr, log)
+        with redirect_stdout(out), redirect_stderr(err):
+            return run(run_id, logs_path, args.workers, args.overlap)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Profiling switch for the stages.
+
+PIPELINE_PROFILE=fetcher,db_updater (or `pipeline.py --profile fetcher,db_updater`,
+or `launcher.sh --profile ...`; "all" selects every stage) runs the main() of
+the selected stages under cProfile and tracemalloc. The reports go next to the
+pipeline log, in LOGS_PATH, named after the run and the stage:
+
+- profile_<RUN_ID>_<stage>[_<project>].pstats, for `python -m pstats` or snakeviz;
+- profile_<RUN_ID>_<stage>[_<project>].txt, the top functions by cumulative time
+  and the top allocations still held when the stage ended.
+
+cProfile only follows the thread that calls main(): the worker threads and
+processes of a stage (picture_stream, csv_generator --workers) show up as time
+spent waiting for them. tracemalloc covers every thread of the process.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import tracemalloc
+import typing
+from contextlib import contextmanager
+from datetime import datetime
+
+from qfieldcloud_fetcher import metrics
+
+TOP_N = 30
+# Frames kept per allocation: enough to see which stage code asked for it
+TRACE_FRAMES = 10
+
+
+def selected(stage: str, spec: str | None = None) -> bool:
+    """Whether the stage is in PIPELINE_PROFILE (or spec), a comma-separated list of stages or "all"."""
+    spec = os.getenv("PIPELINE_PROFILE", "") if spec is None else spec
+    names = {name.strip() for name in spec.split(",") if name.strip()}
+    return stage in names or "all" in names
+
+
+def report_base(logs_dir: str, stage: str, project: str | None = None) -> str:
+    """LOGS_PATH/profile_<RUN_ID>_<stage>[_<project>], without extension."""
+    run_id = os.getenv("RUN_ID") or datetime.now().strftime("%Y%m%d-%H%M%S")
+    name = f"profile_{run_id}_{stage}"
+    if project:
+        name += "_" + re.sub(r"[^\w.-]+", "_", project)
+    return os.path.join(logs_dir, name)
+
+
+def _allocation_report(snapshot: tracemalloc.Snapshot, peak: int) -> str:
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ))
+    stats = snapshot.statistics("traceback")
+    lines = [
+        f"== Top {TOP_N} allocations still held at the end "
+        f"(traced: {sum(stat.size for stat in stats) / 1e6:.1f} MB, peak: {peak / 1e6:.1f} MB)"
+    ]
+    for i, stat in enumerate(stats[:TOP_N], 1):
+        lines.append(f"#{i}: {stat.size / 1e3:.1f} kB in {stat.count} block(s)")
+        # Innermost frame last, like a traceback
+        lines.extend(f"    {line}" for line in stat.traceback.format(most_recent_first=False))
+    return "\n".join(lines) + "\n"
+
+
+def write_reports(
+    base: str,
+    stage: str,
+    argv: typing.Sequence[str],
+    profiler: cProfile.Profile,
+    snapshot: tracemalloc.Snapshot,
+    peak: int,
+) -> None:
+    os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+    profiler.dump_stats(f"{base}.pstats")
+    functions = io.StringIO()
+    pstats.Stats(profiler, stream=functions).sort_stats("cumulative").print_stats(TOP_N)
+    with open(f"{base}.txt", "w", encoding="utf-8") as f:
+        f.write(f"Profile of {' '.join([f'{stage}.py', *argv])} (RUN_ID={os.getenv('RUN_ID') or '-'})\n\n")
+        f.write(f"== Top {TOP_N} functions by cumulative time\n")
+        f.write(functions.getvalue())
+        f.write("\n")
+        f.write(_allocation_report(snapshot, peak))
+
+
+@contextmanager
+def profile(
+    stage: str, argv: typing.Sequence[str] = (), logs_dir: str | None = None
+) -> typing.Iterator[cProfile.Profile | None]:
+    """Profile the with block when the stage is selected; yields the profiler, or None when it is not."""
+    logs_dir = logs_dir or os.getenv("LOGS_PATH")
+    if not logs_dir or not selected(stage):
+        yield None
+        return
+
+    base = report_base(logs_dir, stage, metrics.project_of(argv))
+    # Left running when something else (python -X tracemalloc) started it
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(TRACE_FRAMES)
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+        write_reports(base, stage, argv, profiler, snapshot, peak)
+        print(f"Profile of {stage}: {base}.pstats, {base}.txt")
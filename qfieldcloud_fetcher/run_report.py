@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Performance trends and regressions from the run history.
+
+Reads LOGS_PATH/runs.jsonl and, when present, the per-stage records of
+LOGS_PATH/stage_metrics.jsonl (see metrics.py). For every successful run it
+derives, per stage and per project:
+
+- wall_s, the time spent in the stage (lower is better);
+- <item>/s for every item the stage counts (pictures/s, rows/s...) and MB/s of
+  bytes read and written (higher is better; only when the stage ran at least
+  --min-seconds, shorter runs are noise);
+- duration_s of the whole run (stage "run").
+
+Each value is compared to the median of the same metric over the previous
+--window runs (the rolling baseline, once --min-history runs are known). A value
+more than --threshold worse than its baseline is a regression. wall_s and
+duration_s only count as one when the amount of work (items counted, or bytes
+when the stage counts none) is within --threshold of the baseline's: a stage that
+processed twice the pictures is expected to take twice as long. The report lists
+the regressions of the last --runs runs and the trend of every metric, as text
+on stdout and, with --html, as an HTML page. --fail-on-regression exits with 1
+when the latest run regressed, for cron or CI alerting.
+"""
+
+import argparse
+import html
+import json
+import os
+import statistics
+import sys
+import typing
+from collections import defaultdict
+from contextlib import suppress
+
+from dotenv import load_dotenv
+
+from qfieldcloud_fetcher import metrics
+
+SPARK = "▁▂▃▄▅▆▇█"
+# Metrics where a smaller value is the better one; every other metric is a throughput
+LOWER_IS_BETTER = ("wall_s", "duration_s")
+
+
+class Series(typing.NamedTuple):
+    stage: str
+    project: str | None
+    metric: str
+
+
+class Point(typing.NamedTuple):
+    run_id: str
+    value: float
+    work: float = 0  # items (or bytes) processed, 0 when unknown
+
+
+class Finding(typing.NamedTuple):
+    series: Series
+    run_id: str
+    value: float
+    baseline: float
+    change: float  # relative to the baseline, e.g. -0.4 for 40% less
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Report throughput trends per stage and project, and runs slower than their rolling baseline."
+    )
+    parser.add_argument(
+        "--logs-path", default=os.getenv("LOGS_PATH"), help="Folder of runs.jsonl (default: LOGS_PATH)."
+    )
+    parser.add_argument("--window", type=int, default=10, help="Runs in the rolling baseline (default: 10).")
+    parser.add_argument(
+        "--min-history", type=int, default=3, help="Runs needed before a metric gets a baseline (default: 3)."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Relative change against the baseline that counts as a regression (default: 0.25, i.e. 25%%).",
+    )
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=1.0,
+        help="Shortest stage run whose throughput is taken into account (default: 1.0).",
+    )
+    parser.add_argument("--runs", type=int, default=10, help="Latest runs checked for regressions (default: 10).")
+    parser.add_argument("--html", default=None, help="Also write the report as an HTML page to this path.")
+    parser.add_argument(
+        "--fail-on-regression", action="store_true", help="Exit with status 1 when the latest run regressed."
+    )
+    return parser.parse_args(argv)
+
+
+def _read_jsonl(path: str) -> list[dict[str, typing.Any]]:
+    records = []
+    with suppress(FileNotFoundError), open(path, encoding="utf-8") as f:
+        for line in f:
+            with suppress(ValueError):
+                records.append(json.loads(line))
+    return records
+
+
+def load_history(logs_dir: str) -> tuple[list[dict[str, typing.Any]], dict[str, list[dict[str, typing.Any]]]]:
+    """Run records in runs.jsonl order (chain lines left out), and the stage summaries of every run."""
+    runs = [r for r in _read_jsonl(os.path.join(logs_dir, "runs.jsonl")) if "chain" not in r and r.get("run_id")]
+    records: dict[str, list[dict[str, typing.Any]]] = defaultdict(list)
+    for record in _read_jsonl(os.path.join(logs_dir, metrics.STAGE_METRICS_FILE)):
+        if record.get("stage") and record.get("run_id"):
+            records[record["run_id"]].append(record)
+    # stage_metrics.jsonl is the most detailed; older runs may only have "stages" in their run record
+    stages = {
+        run["run_id"]: metrics.stage_summaries(records[run["run_id"]])
+        if run["run_id"] in records
+        else run.get("stages") or []
+        for run in runs
+    }
+    return runs, stages
+
+
+def amount_of_work(summary: dict[str, typing.Any]) -> float:
+    """Items a stage processed, or the bytes it read and wrote when it counts no items."""
+    items = sum(n for n in (summary.get("items") or {}).values() if n)
+    return items or (summary.get("read_bytes") or 0) + (summary.get("write_bytes") or 0)
+
+
+def run_values(
+    run: dict[str, typing.Any], summaries: list[dict[str, typing.Any]], min_seconds: float
+) -> dict[Series, Point]:
+    values: dict[Series, Point] = {}
+    run_id = run["run_id"]
+    summaries = [summary for summary in summaries if summary.get("status", "ok") == "ok"]
+    duration = run.get("duration_s") or metrics.run_duration_s(run)
+    if duration:
+        values[Series("run", None, "duration_s")] = Point(run_id, duration, sum(map(amount_of_work, summaries)))
+    for summary in summaries:
+        stage, project, wall = summary["stage"], summary.get("project"), summary.get("wall_s") or 0
+        values[Series(stage, project, "wall_s")] = Point(run_id, wall, amount_of_work(summary))
+        if wall < min_seconds:
+            continue
+        for item, n in (summary.get("items") or {}).items():
+            if n:
+                values[Series(stage, project, f"{item}/s")] = Point(run_id, n / wall)
+        io_bytes = (summary.get("read_bytes") or 0) + (summary.get("write_bytes") or 0)
+        if io_bytes:
+            values[Series(stage, project, "MB/s")] = Point(run_id, io_bytes / 1e6 / wall)
+    return values
+
+
+def build_series(
+    runs: list[dict[str, typing.Any]], stages: dict[str, list[dict[str, typing.Any]]], min_seconds: float
+) -> dict[Series, list[Point]]:
+    """Every metric over the successful runs, oldest first (skipped and failed runs are not comparable)."""
+    series: dict[Series, list[Point]] = defaultdict(list)
+    for run in runs:
+        if run.get("status") != "ok":
+            continue
+        for key, point in run_values(run, stages.get(run["run_id"], []), min_seconds).items():
+            series[key].append(point)
+    return dict(series)
+
+
+def change_against(value: float, history: list[float]) -> tuple[float, float] | None:
+    """(baseline, relative change) of value against the median of history; None without a usable baseline."""
+    baseline = statistics.median(history)
+    if baseline <= 0:
+        return None
+    return baseline, (value - baseline) / baseline
+
+
+def is_regression(metric: str, change: float, threshold: float) -> bool:
+    return change > threshold if metric in LOWER_IS_BETTER else change < -threshold
+
+
+def same_work(point: Point, history: list[Point], threshold: float) -> bool:
+    """Whether point did about as much work as its baseline (True when either is unknown)."""
+    works = [p.work for p in history if p.work]
+    if not point.work or not works:
+        return True
+    baseline = statistics.median(works)
+    return abs(point.work - baseline) / baseline <= threshold
+
+
+def find_regressions(
+    series: dict[Series, list[Point]], run_ids: set[str], window: int, min_history: int, threshold: float
+) -> list[Finding]:
+    """Values of the given runs that are worse than their rolling baseline by more than threshold."""
+    findings = []
+    for key, points in series.items():
+        for i, point in enumerate(points):
+            history = points[max(0, i - window) : i]
+            if point.run_id not in run_ids or len(history) < max(1, min_history):
+                continue
+            compared = change_against(point.value, [p.value for p in history])
+            if not compared or not is_regression(key.metric, compared[1], threshold):
+                continue
+            # A longer run that did more work is not slower: its throughput tells
+            if key.metric in LOWER_IS_BETTER and not same_work(point, history, threshold):
+                continue
+            findings.append(Finding(key, point.run_id, point.value, *compared))
+    return sorted(findings, key=lambda f: (f.run_id, f.series.stage, f.series.project or "", f.series.metric))
+
+
+def sparkline(values: list[float]) -> str:
+    low, high = min(values), max(values)
+    if high == low:
+        return SPARK[len(SPARK) // 2] * len(values)
+    return "".join(SPARK[round((v - low) / (high - low) * (len(SPARK) - 1))] for v in values)
+
+
+def trends(series: dict[Series, list[Point]], window: int, min_history: int) -> list[dict[str, typing.Any]]:
+    """Latest value of every metric against the median of the runs before it."""
+    rows = []
+    for key in sorted(series, key=lambda k: (k.stage != "run", k.stage, k.project or "", k.metric)):
+        points = series[key]
+        history = [p.value for p in points[-window - 1 : -1]]
+        compared = change_against(points[-1].value, history) if len(history) >= max(1, min_history) else None
+        rows.append({
+            "series": key,
+            "last": points[-1].value,
+            "baseline": compared[0] if compared else None,
+            "change": compared[1] if compared else None,
+            "trend": sparkline([p.value for p in points[-window:]]),
+        })
+    return rows
+
+
+def _fmt(value: float | None) -> str:
+    if value is None:
+        return "-"
+    return f"{value:.0f}" if abs(value) >= 100 else f"{value:.3g}"
+
+
+def _pct(change: float | None) -> str:
+    return "-" if change is None else f"{change:+.0%}"
+
+
+def summary_line(runs: list[dict[str, typing.Any]]) -> str:
+    by_status: dict[str, int] = defaultdict(int)
+    for run in runs:
+        by_status[run.get("status") or "?"] += 1
+    counts = ", ".join(f"{status}={n}" for status, n in sorted(by_status.items()))
+    line = f"Pipeline runs: {len(runs)} ({counts})"
+    if runs:
+        last = runs[-1]
+        duration = last.get("duration_s") or metrics.run_duration_s(last)
+        line += f"; latest {last['run_id']} {last.get('status')} ({last.get('reason') or '-'}) in {_fmt(duration)}s"
+    return line
+
+
+def render_text(
+    runs: list[dict[str, typing.Any]],
+    findings: list[Finding],
+    rows: list[dict[str, typing.Any]],
+    args: argparse.Namespace,
+) -> str:
+    lines = [summary_line(runs), ""]
+    lines.append(
+        f"Regressions in the last {args.runs} run(s) (worse than the median of the previous {args.window} "
+        f"by more than {args.threshold:.0%}): {len(findings) or 'none'}"
+    )
+    for f in findings:
+        lines.append(
+            f"  {f.run_id}  {f.series.stage} [{f.series.project or 'all'}]  {f.series.metric}: "
+            f"{_fmt(f.value)} vs {_fmt(f.baseline)} ({_pct(f.change)})"
+        )
+    lines.append("")
+    header = ("stage", "project", "metric", "last", "baseline", "change", "trend")
+    table = [header] + [
+        (
+            row["series"].stage,
+            row["series"].project or "all",
+            row["series"].metric,
+            _fmt(row["last"]),
+            _fmt(row["baseline"]),
+            _pct(row["change"]),
+            row["trend"],
+        )
+        for row in rows
+    ]
+    widths = [max(len(r[i]) for r in table) for i in range(len(header))]
+    lines.extend("  ".join(cell.ljust(width) for cell, width in zip(r, widths)).rstrip() for r in table)
+    return "\n".join(lines) + "\n"
+
+
+def render_html(
+    runs: list[dict[str, typing.Any]],
+    findings: list[Finding],
+    rows: list[dict[str, typing.Any]],
+    args: argparse.Namespace,
+) -> str:
+    flagged = {(f.series, f.run_id) for f in findings}
+    latest = runs[-1]["run_id"] if runs else None
+
+    def cells(values: typing.Iterable[str], tag: str = "td") -> str:
+        return "".join(f"<{tag}>{html.escape(value)}</{tag}>" for value in values)
+
+    regression_rows = "".join(
+        "<tr>"
+        + cells((
+            f.run_id,
+            f.series.stage,
+            f.series.project or "all",
+            f.series.metric,
+            _fmt(f.value),
+            _fmt(f.baseline),
+            _pct(f.change),
+        ))
+        + "</tr>"
+        for f in findings
+    )
+    trend_rows = "".join(
+        ('<tr class="regressed">' if (row["series"], latest) in flagged else "<tr>")
+        + cells((
+            row["series"].stage,
+            row["series"].project or "all",
+            row["series"].metric,
+            _fmt(row["last"]),
+            _fmt(row["baseline"]),
+            _pct(row["change"]),
+            row["trend"],
+        ))
+        + "</tr>"
+        for row in rows
+    )
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Pipeline performance</title>
+<style>
+body {{ font-family: sans-serif; margin: 1.5em; }}
+table {{ border-collapse: collapse; margin-bottom: 1.5em; }}
+th, td {{ border: 1px solid #ccc; padding: 2px 8px; text-align: left; }}
+tr.regressed td {{ background: #fdd; }}
+</style></head><body>
+<h1>Pipeline performance</h1>
+<p>{html.escape(summary_line(runs))}</p>
+<h2>Regressions</h2>
+<p>Last {args.runs} run(s), against the median of the previous {args.window}; threshold {args.threshold:.0%}.</p>
+<table><tr>{cells(("run", "stage", "project", "metric", "value", "baseline", "change"), "th")}</tr>{regression_rows}</table>
+<h2>Trends</h2>
+<table><tr>{cells(("stage", "project", "metric", "last", "baseline", "change", "trend"), "th")}</tr>{trend_rows}</table>
+</body></html>
+"""
+
+
+def main(argv: list[str] | None = None) -> int:
+    load_dotenv()
+    args = parse_args(argv)
+    if not args.logs_path:
+        raise SystemExit("Missing LOGS_PATH (or --logs-path)")
+
+    runs, stages = load_history(args.logs_path)
+    series = build_series(runs, stages, args.min_seconds)
+    recent = {run["run_id"] for run in runs[-args.runs :]} if args.runs > 0 else set()
+    findings = find_regressions(series, recent, args.window, args.min_history, args.threshold)
+    rows = trends(series, args.window, args.min_history)
+
+    print(render_text(runs, findings, rows, args), end="")
+    if args.html:
+        os.makedirs(os.path.dirname(os.path.abspath(args.html)), exist_ok=True)
+        with open(args.html, "w", encoding="utf-8") as f:
+            f.write(render_html(runs, findings, rows, args))
+        print(f"HTML report: {args.html}")
+
+    if args.fail_on_regression and runs and any(f.run_id == runs[-1]["run_id"] for f in findings):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Per-project input fingerprints shared by the CSV stages.
+
+A project's fingerprint is a hash over the md5 of every GPKG in
+DATA_PATH/in/gpkg/<project>/. Each stage (csv_generator, csv_formatter,
+fields_creator, db_updater) records the fingerprint a project had when the stage
+last finished it successfully, together with the files it produced. On the next
+run the stage skips projects whose fingerprint, options and outputs are still
+the same, so a night where one project changed only reprocesses that project.
+
+Everything lives in DATA_PATH/stage_cache.json. GPKG md5s are memoized there by
+(size, mtime) so the stages do not hash the same files four times.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+from qfieldcloud_fetcher import fs_utils
+
+CACHE_FILENAME = "stage_cache.json"
+
+
+def utcnow_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def file_md5(path: str, chunk_size: int = 4 * 1024 * 1024) -> str:
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(chunk_size)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+
+def load_cache(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            cache: dict = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return cache
+
+
+def save_cache(cache: dict, path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+class StageCache:
+    """
+    Fingerprint bookkeeping for one stage. Typical use:
+
+        cache = StageCache("csv_formatter", data_path, params={"format": "csv"}, enabled=not args.force)
+        if cache.is_fresh(project):
+            ...skip...
+        ...process, then on success...
+        cache.record(project, outputs)
+        cache.save()
+    """
+
+    def __init__(self, stage: str, data_path: str | None, params: dict | None = None, enabled: bool = True) -> None:
+        self.stage = stage
+        self.path = os.path.join(data_path or ".", CACHE_FILENAME)
+        self.gpkg_root = os.path.join(data_path or ".", "in", "gpkg")
+        self.params = params or {}
+        self.enabled = enabled
+        self.data = load_cache(self.path)
+        self.skipped: list[str] = []
+        self._fingerprints: dict[str, str | None] = {}
+        self._recorded: set[str] = set()
+
+    @property
+    def entries(self) -> dict:
+        entries: dict = self.data.setdefault("stages", {}).setdefault(self.stage, {})
+        return entries
+
+    def gpkg_md5(self, path: str) -> str:
+        st = os.stat(path)
+        sources = self.data.setdefault("sources", {})
+        known = sources.get(path)
+        if known and known.get("size") == st.st_size and known.get("mtime_ns") == st.st_mtime_ns:
+            return str(known["md5"])
+        md5 = file_md5(path)
+        sources[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "md5": md5}
+        return md5
+
+    def fingerprint(self, project: str) -> str | None:
+        """Hash of the project's GPKG names and md5s, or None when it has no GPKG folder."""
+        if project not in self._fingerprints:
+            gpkg_dir = os.path.join(self.gpkg_root, project)
+            if not os.path.isdir(gpkg_dir):
+                self._fingerprints[project] = None
+            else:
+                h = hashlib.sha256()
+                for name in sorted(os.listdir(gpkg_dir)):
+                    path = os.path.join(gpkg_dir, name)
+                    if name.endswith(".gpkg") and os.path.isfile(path):
+                        h.update(f"{name}:{self.gpkg_md5(path)}\n".encode())
+                self._fingerprints[project] = h.hexdigest()
+        return self._fingerprints[project]
+
+    def is_fresh(self, project: str) -> bool:
+        """
+        True when this stage already finished the project for the same inputs and
+        options and its recorded outputs still exist. Fresh projects are counted as skipped.
+        """
+        if not self.enabled:
+            return False
+        fingerprint = self.fingerprint(project)
+        entry = self.entries.get(project)
+        if fingerprint is None or not entry:
+            return False
+        if entry.get("fingerprint") != fingerprint or entry.get("params", {}) != self.params:
+            return False
+        if not all(os.path.exists(path) for path in entry.get("outputs", [])):
+            return False
+        self.skipped.append(project)
+        return True
+
+    def record(self, project: str, outputs: list[str] | None = None) -> None:
+        """Remember a successful run; projects without a GPKG folder are not cached."""
+        fingerprint = self.fingerprint(project)
+        if fingerprint is None:
+            return
+        self.entries[project] = {
+            "fingerprint": fingerprint,
+            "params": self.params,
+            "outputs": sorted(outputs or []),
+            "completed_at": utcnow_iso(),
+        }
+        self._recorded.add(project)
+
+    def save(self) -> None:
+        # Other stages, or this stage for other projects in parallel, may have written the
+        # file since we loaded it; only the projects recorded here are ours
+        with fs_utils.locked(self.path):
+            current = load_cache(self.path)
+            current.setdefault("sources", {}).update(self.data.get("sources", {}))
+            stage_entries = current.setdefault("stages", {}).setdefault(self.stage, {})
+            stage_entries.update({project: self.entries[project] for project in self._recorded})
+            self.data = current
+            save_cache(current, self.path)
@@ -8,6 +8,7 @@ from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
 
+from qfieldcloud_fetcher import catalog, fs_utils, metrics, tracing
 from qfieldcloud_fetcher.fs_utils import require_directory_access
 
 def md5sum(path, chunk=4*1024*1024):
@@ -27,23 +28,66 @@ def load_json(path, default):
     except FileNotFoundError:
         return default
 
-def save_json_atomic(obj, path):
-    p = Path(path)
-    p.parent.mkdir(parents=True, exist_ok=True)
-    tmp = p.with_suffix(p.suffix + ".tmp")
-    with open(tmp, 'w', encoding='utf-8') as f:
-        json.dump(obj, f, indent=2, sort_keys=True)
-    tmp.replace(p)
+@tracing.traced("stage raw picture")
+def stage_picture(file: Path, raw_root: str, local_to_remote: dict, stage_log: dict) -> tuple[str, str]:
+    """
+    Copy one picture to <raw_root>/<project>/<layer>/ and record it in stage_log.
+    Returns ("copied" | "skipped" | "error", its stage log key).
+    """
+    try:
+        layer = file.parent.name
+        project = file.parent.parent.name
+    except Exception:
+        layer, project = "unknown", "unknown"
+
+    rel = f"{project}/{layer}/{file.name}"
+    dest = Path(raw_root)/project/layer/file.name
+    tracing.current().set_attributes({"file.path": str(file), "pipeline.project": project})
+    dest.parent.mkdir(parents=True, exist_ok=True)
+
+    # skip if same size exists; still record
+    if dest.exists() and dest.stat().st_size == file.stat().st_size:
+        entry = stage_log.get(rel) or {}
+        entry.update({
+            "project": project, "layer": layer,
+            "local_path": str(file), "raw_path": str(dest),
+            "raw_md5": entry.get("raw_md5") or md5sum(dest),
+            "staged_at": entry.get("staged_at") or datetime.utcnow().isoformat()+"Z",
+            "remote_name": local_to_remote.get(str(file), {}).get("remote_name"),
+            "project_id": local_to_remote.get(str(file), {}).get("project_id"),
+        })
+        stage_log[rel] = entry
+        tracing.current().set_attribute("picture.status", "skipped")
+        return "skipped", rel
 
-def parse_args() -> argparse.Namespace:
+    try:
+        shutil.copy2(str(file), str(dest))
+        if md5sum(file) != md5sum(dest):
+            raise IOError("MD5 mismatch")
+        stage_log[rel] = {
+            "project": project, "layer": layer,
+            "local_path": str(file), "raw_path": str(dest),
+            "raw_md5": md5sum(dest),
+            "staged_at": datetime.utcnow().isoformat()+"Z",
+            "remote_name": local_to_remote.get(str(file), {}).get("remote_name"),
+            "project_id": local_to_remote.get(str(file), {}).get("project_id"),
+        }
+        tracing.current().set_attributes({"picture.status": "copied", "file.size": dest.stat().st_size})
+        return "copied", rel
+    except Exception as e:
+        print(f"Error copying {file} -> {dest}: {e}")
+        tracing.current().set_error(f"copy failed: {e}")
+        return "error", rel
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Stage pictures to NextCloud raw folder.")
     parser.add_argument("--project", default=None, help="Only process a single project folder by name.")
     parser.add_argument("--progress-every", type=int, default=100, help="Print progress every N files.")
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
-def main():
-    args = parse_args()
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
     if args.project:
         print(f"Filtering to project: {args.project}")
 
@@ -68,56 +112,29 @@ def main():
     local_to_remote = {os.path.abspath(e.get("local_path","")): e for e in manifest if e.get("local_path")}
 
     copied = skipped = errors = processed = 0
-    for file in Path(in_jpg_path).rglob("*.jpg"):
-        file = file.resolve()
-        try:
-            layer = file.parent.name
-            project = file.parent.parent.name
-        except Exception:
-            layer, project = "unknown", "unknown"
-        if args.project and project != args.project:
+    staged: set[str] = set()
+    for picture in catalog.files(in_jpg_path, args.project):
+        if not picture.name.endswith(".jpg"):
             continue
+        file = Path(picture.path).resolve()
 
-        rel = f"{project}/{layer}/{file.name}"
-        dest = Path(raw_root)/project/layer/file.name
-        dest.parent.mkdir(parents=True, exist_ok=True)
         processed += 1
         if args.progress_every > 0 and processed % args.progress_every == 0:
             print(f"Staging progress: processed={processed}, copied={copied}, skipped={skipped}, errors={errors}")
 
-        # skip if same size exists; still record
-        if dest.exists() and dest.stat().st_size == file.stat().st_size:
-            skipped += 1
-            entry = stage_log.get(rel) or {}
-            entry.update({
-                "project": project, "layer": layer,
-                "local_path": str(file), "raw_path": str(dest),
-                "raw_md5": entry.get("raw_md5") or md5sum(dest),
-                "staged_at": entry.get("staged_at") or datetime.utcnow().isoformat()+"Z",
-                "remote_name": local_to_remote.get(str(file), {}).get("remote_name"),
-                "project_id": local_to_remote.get(str(file), {}).get("project_id"),
-            })
-            stage_log[rel] = entry
+        status, rel = stage_picture(file, raw_root, local_to_remote, stage_log)
+        if status == "error":
+            errors += 1
             continue
-
-        try:
-            shutil.copy2(str(file), str(dest))
-            if md5sum(file) != md5sum(dest):
-                raise IOError("MD5 mismatch")
+        if status == "copied":
             copied += 1
-            stage_log[rel] = {
-                "project": project, "layer": layer,
-                "local_path": str(file), "raw_path": str(dest),
-                "raw_md5": md5sum(dest),
-                "staged_at": datetime.utcnow().isoformat()+"Z",
-                "remote_name": local_to_remote.get(str(file), {}).get("remote_name"),
-                "project_id": local_to_remote.get(str(file), {}).get("project_id"),
-            }
-        except Exception as e:
-            print(f"Error copying {file} -> {dest}: {e}")
-            errors += 1
+        else:
+            skipped += 1
+        staged.add(rel)
 
-    save_json_atomic(stage_log, stage_log_path)
+    # Only the entries of this run's scope: other projects may be staged in parallel
+    fs_utils.update_json(stage_log_path, {rel: stage_log[rel] for rel in staged})
+    metrics.count("pictures", copied)
     print(f"Staging complete: copied={copied}, skipped={skipped}, errors={errors}")
     print(f"Raw stage log: {stage_log_path}")
 
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Shared loader/writer for the intermediate tables in raw_csv/ and formatted_csv/.
+
+The stages used to hand each other CSVs, so every hop re-parsed text and
+re-inferred dtypes (e.g. collector_orcid turning into a float). The intermediate
+format can now be Parquet, which keeps the dtypes of the GPKG columns; CSV stays
+the default and is always what gets published to NextCloud.
+
+Readers do not need to know the format: files are recognised by extension and
+both formats are memory-mapped when read. Readers pass a schema name so the
+known Field_Data columns get the same explicit dtypes in every stage, and full
+reads are cached per (path, mtime, size) within the process.
+"""
+
+import datetime
+import importlib.util
+import os
+import typing
+from collections import OrderedDict
+from collections.abc import Iterator
+
+from qfieldcloud_fetcher import catalog, fs_utils
+
+if typing.TYPE_CHECKING:
+    import pandas as pd
+
+FORMATS = ("csv", "parquet")
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet"}
+
+# Used when a stage is not given --format explicitly
+FORMAT_ENV = "INTERMEDIATE_FORMAT"
+
+# Column kinds of the known Field_Data columns. Identifiers are pinned to text so
+# e.g. collector_orcid never turns into a float; flags and dates are nullable integers.
+TEXT_COLUMNS = ("sample_id", "collector_fullname", "collector_orcid", "collector_inat", "qfield_project", "geometry")
+FLAG_COLUMNS = ("is_wild", "inat_upload", "no_name_on_list")
+COORDINATE_COLUMNS = ("x_coord", "y_coord", "latitude", "longitude")
+
+SCHEMAS: dict[str, dict[str, str]] = {
+    # raw_csv: straight from the GPKG, only the text columns are safe to pin
+    "raw": {**dict.fromkeys(TEXT_COLUMNS, "text"), "date": "text"},
+    # formatted_csv: what csv_formatter writes and Directus receives
+    "field_data": {
+        **dict.fromkeys(TEXT_COLUMNS, "text"),
+        **dict.fromkeys(FLAG_COLUMNS, "integer"),
+        **dict.fromkeys(COORDINATE_COLUMNS, "float"),
+        "date": "integer",
+    },
+}
+
+# Parsed frames kept per process, keyed by (path, schema)
+CACHE_SIZE = 16
+_cache: "OrderedDict[tuple[str, str | None], tuple[int, int, pd.DataFrame]]" = OrderedDict()
+
+
+def default_format() -> str:
+    fmt = (os.getenv(FORMAT_ENV) or "csv").lower()
+    if fmt not in FORMATS:
+        raise SystemExit(f"Unknown {FORMAT_ENV}={fmt!r}, expected one of: {', '.join(FORMATS)}")
+    return fmt
+
+
+def require_format(fmt: str) -> None:
+    """Fail early when Parquet is requested but pyarrow is missing."""
+    if fmt == "parquet" and not arrow_available():
+        raise SystemExit("The parquet intermediate format requires pyarrow (pip install pyarrow)")
+
+
+def is_table_file(filename: str) -> bool:
+    return filename.endswith(tuple(EXTENSIONS.values()))
+
+
+def table_stem(filename: str) -> str:
+    """File name without the table extension (e.g. 'obs_EPSG:4326')."""
+    return os.path.splitext(filename)[0] if is_table_file(filename) else filename
+
+
+def table_path(directory: str, stem: str, fmt: str) -> str:
+    return os.path.join(directory, stem + EXTENSIONS[fmt])
+
+
+def iter_tables(base_path: str, project: str | None = None) -> Iterator[tuple[str, str, str]]:
+    """Yield (project, filename, path) for every table under base_path/<project>/."""
+    if catalog.indexed(base_path):
+        for entry in catalog.files(base_path, project):
+            if is_table_file(entry.name):
+                yield entry.project, entry.name, entry.path
+        return
+    for root, _dirs, files in os.walk(base_path):
+        folder = os.path.basename(root)
+        if project and folder != project:
+            continue
+        for filename in sorted(files):
+            if is_table_file(filename):
+                yield folder, filename, os.path.join(root, filename)
+
+
+def arrow_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def kind_dtype(kind: str) -> str:
+    if kind == "text":
+        return "string[pyarrow]" if arrow_available() else "string"
+    return {"integer": "Int64", "float": "float64"}[kind]
+
+
+def apply_schema(df: "pd.DataFrame", schema: dict[str, str], path: str = "") -> "pd.DataFrame":
+    """Cast the known columns to their schema dtype, keeping the inferred one if a value does not fit."""
+    import pandas as pd
+
+    for column, kind in schema.items():
+        if column not in df.columns:
+            continue
+        dtype = pd.api.types.pandas_dtype(kind_dtype(kind))
+        if str(df[column].dtype) == str(dtype):
+            continue
+        try:
+            if kind == "text":
+                df[column] = df[column].astype(dtype)
+            else:
+                values = df[column]
+                if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+                    values = pd.to_numeric(values.astype(object).where(values.notna(), None))
+                df[column] = values.astype(dtype)
+        except (TypeError, ValueError) as e:
+            print(f"Warning: keeping inferred dtype {df[column].dtype} for {path}:{column} ({e})")
+    return df
+
+
+def is_parsed_temporal(series: "pd.Series") -> bool:
+    import pandas as pd
+
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return True
+    if series.dtype != object:
+        return False
+    first = series.dropna().head(1).tolist()
+    return bool(first) and isinstance(first[0], (datetime.date, datetime.time))
+
+
+def _read_csv(path: str, nrows: int | None, columns: list[str] | None, schema: dict[str, str]) -> "pd.DataFrame":
+    import pandas as pd
+
+    if os.path.getsize(path) == 0:
+        raise pd.errors.EmptyDataError(f"No columns to parse from file {path}")
+    # Text columns are pinned at parse time, numbers are cast afterwards so one bad value
+    # cannot fail the whole read
+    text_columns = [column for column, kind in schema.items() if kind == "text"]
+    if nrows is not None or not arrow_available():
+        dtype = {column: kind_dtype("text") for column in text_columns}
+        # round_trip parses floats exactly, like the Arrow reader and the chunked reader
+        return pd.read_csv(
+            path, nrows=nrows, usecols=columns, dtype=dtype, memory_map=True, float_precision="round_trip"
+        )
+
+    import pyarrow as pa  # type: ignore[import-untyped]
+    import pyarrow.csv as pa_csv  # type: ignore[import-untyped]
+
+    # pandas' engine="pyarrow" applies dtype= after inference ("20240501100000.0"), so
+    # call the Arrow CSV reader directly to give the pinned columns their type while parsing
+    convert_options = pa_csv.ConvertOptions(
+        column_types=dict.fromkeys(text_columns, pa.string()),
+        strings_can_be_null=True,
+        include_columns=columns or [],
+    )
+    try:
+        df: pd.DataFrame = pa_csv.read_csv(path, convert_options=convert_options).to_pandas()
+    except pa.ArrowInvalid as e:
+        raise pd.errors.ParserError(f"Error tokenizing {path}: {e}") from e
+
+    # Arrow parses ISO dates/timestamps, the C engine keeps them as text: re-read those
+    # columns as text so every stage sees the same values
+    parsed = [column for column in df.columns if is_parsed_temporal(df[column])]
+    if parsed:
+        text = pd.read_csv(path, usecols=parsed, dtype=dict.fromkeys(parsed, object))
+        for column in parsed:
+            df[column] = text[column]
+    return df
+
+
+def read_table(
+    path: str,
+    nrows: int | None = None,
+    columns: list[str] | None = None,
+    schema: str | None = None,
+) -> "pd.DataFrame":
+    """
+    Load a CSV or Parquet table into a DataFrame, with the dtypes of `schema`
+    ("raw" or "field_data") applied to the known columns. Raises pandas'
+    EmptyDataError for empty CSVs, like pd.read_csv.
+
+    Full reads are cached for the process and returned as shallow copies:
+    assigning columns is fine, modifying values in place is not.
+    """
+    cache_key = (os.path.abspath(path), schema)
+    cacheable = nrows is None and columns is None
+    if cacheable:
+        st = os.stat(path)
+        cached = _cache.get(cache_key)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            _cache.move_to_end(cache_key)
+            return cached[2].copy(deep=False)
+
+    columns_schema = SCHEMAS[schema] if schema else {}
+    if path.endswith(EXTENSIONS["parquet"]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq  # type: ignore[import-untyped]
+
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        if nrows is None:
+            table = parquet_file.read(columns=columns)
+        else:
+            # Only decode the first batch for sampling
+            batch = next(parquet_file.iter_batches(batch_size=max(nrows, 1), columns=columns), None)
+            if batch is None:
+                table = parquet_file.read(columns=columns)
+            else:
+                table = pa.Table.from_batches([batch]).slice(0, nrows)
+        df = table.to_pandas()
+    else:
+        df = _read_csv(path, nrows, columns, columns_schema)
+    df = apply_schema(df, columns_schema, path)
+
+    if cacheable:
+        _cache[cache_key] = (st.st_mtime_ns, st.st_size, df)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+        return df.copy(deep=False)
+    return df
+
+
+# Marker for columns read as object whose "True"/"False" text must become booleans again
+BOOL_WITH_NULLS = "bool_with_nulls"
+
+
+def merge_chunk_dtypes(dtypes: set[str], has_nulls: bool) -> str:
+    """
+    The dtype the C parser infers for a whole column, given the dtypes it inferred
+    for each chunk ("null" for chunks where the column is empty).
+    """
+    kinds = dtypes - {"null"}
+    nulls = has_nulls or "null" in dtypes
+    if not kinds:
+        return "float64"
+    if kinds == {"bool"}:
+        # The C parser keeps True/False as booleans in an object column when there are gaps
+        return BOOL_WITH_NULLS if nulls else "bool"
+    if kinds == {"int64"}:
+        return "float64" if nulls else "int64"
+    if kinds <= {"int64", "float64"}:
+        return "float64"
+    return "object"
+
+
+def parse_bool(text: str) -> bool:
+    return text.strip().lower() == "true"
+
+
+def scan_csv_dtypes(path: str, chunksize: int, pinned: dict[str, str]) -> dict[str, str]:
+    """First pass of the chunked reader: the dtype a full read would give each column."""
+    import pandas as pd
+
+    seen: dict[str, set[str]] = {}
+    nulls: dict[str, bool] = {}
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype=pinned, memory_map=True, float_precision="round_trip"):
+        for column in chunk.columns:
+            if column in pinned:
+                continue
+            values = chunk[column]
+            empty = values.isna().all()
+            seen.setdefault(column, set()).add("null" if empty and len(values) else str(values.dtype))
+            nulls[column] = nulls.get(column, False) or bool(values.isna().any())
+    return {column: merge_chunk_dtypes(dtypes, nulls[column]) for column, dtypes in seen.items()}
+
+
+def iter_table_chunks(path: str, chunksize: int, schema: str | None = None) -> Iterator["pd.DataFrame"]:
+    """
+    Read a table in chunks of `chunksize` rows with constant memory. CSV columns are
+    scanned first so every chunk gets the dtype a full read_table would give the column.
+    Always yields at least one (possibly empty) chunk.
+    """
+    import pandas as pd
+
+    columns_schema = SCHEMAS[schema] if schema else {}
+    if path.endswith(EXTENSIONS["parquet"]):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        yielded = False
+        for batch in parquet_file.iter_batches(batch_size=chunksize):
+            yielded = True
+            yield apply_schema(batch.to_pandas(), columns_schema, path)
+        if not yielded:
+            yield apply_schema(parquet_file.schema_arrow.empty_table().to_pandas(), columns_schema, path)
+        return
+
+    if os.path.getsize(path) == 0:
+        raise pd.errors.EmptyDataError(f"No columns to parse from file {path}")
+    pinned = {column: kind_dtype(kind) for column, kind in columns_schema.items() if kind == "text"}
+    dtype = {**scan_csv_dtypes(path, chunksize, pinned), **pinned}
+    booleans = [column for column, column_dtype in dtype.items() if column_dtype == BOOL_WITH_NULLS]
+    dtype.update(dict.fromkeys(booleans, "object"))
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype=dtype, memory_map=True, float_precision="round_trip"):
+        for column in booleans:
+            chunk[column] = chunk[column].map(parse_bool, na_action="ignore")
+        yield apply_schema(chunk, columns_schema, path)
+
+
+class TableAppender:
+    """
+    Write a table chunk by chunk. Output goes to a temporary file that replaces
+    the target on close, and is discarded if the block raises. With skip_unchanged,
+    an identical existing target is kept as is (see `changed`).
+    """
+
+    def __init__(self, directory: str, stem: str, fmt: str, skip_unchanged: bool = False) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.path = table_path(directory, stem, fmt)
+        self.tmp_path = self.path + ".tmp"
+        self.fmt = fmt
+        self.skip_unchanged = skip_unchanged
+        self.changed = True
+        self.rows = 0
+        self._file: typing.IO[str] | None = None
+        self._writer: typing.Any = None
+        self._schema: typing.Any = None
+
+    def append(self, df: "pd.DataFrame") -> None:
+        if self.fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            df = wkt_geometries(df)
+            if self._writer is None:
+                schema = pa.Schema.from_pandas(df, preserve_index=False)
+                # A column empty in the first chunk has no type yet; later chunks hold text
+                for i, field in enumerate(schema):
+                    if pa.types.is_null(field.type):
+                        schema = schema.set(i, field.with_type(pa.string()))
+                self._schema = schema
+                self._writer = pq.ParquetWriter(self.tmp_path, schema)
+            self._writer.write_table(pa.Table.from_pandas(df, schema=self._schema, preserve_index=False))
+        else:
+            if self._file is None:
+                # Kept open across append() calls, close() or abort() closes it
+                self._file = open(self.tmp_path, "w", newline="", encoding="utf-8")  # noqa: SIM115
+                df.to_csv(self._file, index=False)
+            else:
+                df.to_csv(self._file, index=False, header=False)
+        self.rows += len(df)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+        if self.skip_unchanged:
+            self.changed = fs_utils.replace_if_changed(self.tmp_path, self.path)
+        else:
+            os.replace(self.tmp_path, self.path)
+        catalog.record(self.path)
+
+    def abort(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self) -> "TableAppender":
+        return self
+
+    def __exit__(self, exc_type: typing.Any, exc: typing.Any, tb: typing.Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_table(df: "pd.DataFrame", directory: str, stem: str, fmt: str) -> str:
+    """
+    Write df to <directory>/<stem>.<ext> and return the path. Geometries are stored as WKT.
+    The file is replaced atomically, so hardlinks published from it never see a partial write.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = table_path(directory, stem, fmt)
+    tmp_path = path + ".tmp"
+    if fmt == "parquet":
+        df = wkt_geometries(df)
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    catalog.record(path)
+    return path
+
+
+def wkt_geometries(df: "pd.DataFrame") -> "pd.DataFrame":
+    """Replace geometry columns by their WKT text, as to_csv would write them."""
+    import pandas as pd
+
+    geometry_columns = [column for column in df.columns if str(df[column].dtype) == "geometry"]
+    if not geometry_columns:
+        return df
+    import shapely  # type: ignore[import-untyped]
+
+    df = pd.DataFrame(df).copy()
+    for column in geometry_columns:
+        # rounding_precision=-1 keeps full precision, same as str(geometry)
+        df[column] = shapely.to_wkt(df[column].to_numpy(), rounding_precision=-1)
+    return df
+
+
+def format_value(value: typing.Any) -> str:
+    """Format a cell the way DataFrame.to_csv does."""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "" if value != value else repr(value)
+    try:
+        import pandas as pd
+
+        if value is pd.NA or value is pd.NaT:
+            return ""
+    except ImportError:
+        pass
+    return str(value)
+
+
+def read_rows(path: str, schema: str | None = None) -> Iterator[dict[str, str]]:
+    """
+    Iterate a table as {column: text} rows, formatted the way to_csv writes the
+    typed table (so a csv.DictReader over the CSV version returns the same strings).
+    """
+    df = read_table(path, schema=schema)
+    columns = [str(column) for column in df.columns]
+    for values in df.astype(object).itertuples(index=False, name=None):
+        yield {column: format_value(value) for column, value in zip(columns, values)}
@@ -0,0 +1,310 @@
+"""
+Tracing spans for the pipeline, exported as OTLP/JSON to a local file.
+
+With PIPELINE_TRACING=1, the stages record spans: one per stage (metrics.measure),
+per project chain, per downloaded file, per HTTP request (QFieldCloud, Directus),
+per Directus batch and its retries, per picture staged, renamed, compressed and
+published, and per ExifTool call. Attributes carry bytes, statuses and attempts.
+
+Every process of a run shares one trace, derived from RUN_ID, so the stages
+started by launcher.sh or pipeline.py (and its workers) land in a single tree
+under the run's root span, which metrics.finalize_run() writes at the end.
+
+Spans are written to LOGS_PATH/traces/<RUN_ID>.jsonl, one
+ExportTraceServiceRequest per line in the OTLP/JSON encoding, the format of the
+OpenTelemetry Collector's file exporter: the file can be replayed into a
+collector (otlpjsonfile receiver) or read as is, no collector is required.
+
+Spans opened in a thread without a parent hang under the outermost open span of
+the process (the stage), so the worker threads of a stage stay in its tree.
+"""
+
+import atexit
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+import typing
+from contextlib import contextmanager
+from datetime import datetime
+
+from qfieldcloud_fetcher import fs_utils
+
+SERVICE_NAME = "qfieldcloud-pipeline"
+SCOPE_NAME = "qfieldcloud_fetcher.tracing"
+# Finished spans kept in memory before they are appended to the file
+FLUSH_EVERY = 512
+KIND_INTERNAL, KIND_CLIENT = 1, 3
+STATUS_OK, STATUS_ERROR = 1, 2
+
+_current: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("current_span", default=None)
+_lock = threading.Lock()
+_finished: list["Span"] = []
+# Outermost open span of the process: parent of the spans of threads that have none
+_process_span: "Span | None" = None
+_process_trace_id: tuple[int, str] | None = None
+
+
+def enabled() -> bool:
+    return os.getenv("PIPELINE_TRACING", "").strip().lower() in ("1", "true", "yes", "on") and bool(
+        os.getenv("LOGS_PATH")
+    )
+
+
+def _digest(text: str, length: int) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:length]
+
+
+def current_trace_id() -> str:
+    """Of the run (RUN_ID), or of the process when it is unset."""
+    global _process_trace_id
+    run_id = os.getenv("RUN_ID")
+    if run_id:
+        return _digest(f"trace:{run_id}", 32)
+    if _process_trace_id is None or _process_trace_id[0] != os.getpid():
+        _process_trace_id = (os.getpid(), os.urandom(16).hex())
+    return _process_trace_id[1]
+
+
+def root_span_id() -> str | None:
+    run_id = os.getenv("RUN_ID")
+    return _digest(f"root:{run_id}", 16) if run_id else None
+
+
+def traces_path() -> str:
+    name = os.getenv("RUN_ID") or f"process-{os.getpid()}"
+    return os.path.join(str(os.getenv("LOGS_PATH")), "traces", f"{name}.jsonl")
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        parent: "Span | None",
+        attributes: typing.Mapping[str, typing.Any] | None = None,
+        *,
+        kind: int = KIND_INTERNAL,
+    ):
+        self.name = name
+        self.kind = kind
+        self.trace_id: str = parent.trace_id if parent else current_trace_id()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else root_span_id()
+        self.pid = os.getpid()
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+        self.attributes: dict[str, typing.Any] = {}
+        self.events: list[tuple[int, str, dict[str, typing.Any]]] = []
+        self.status = STATUS_OK
+        self.status_message = ""
+        self.set_attributes(attributes or {})
+
+    def set_attribute(self, key: str, value: typing.Any) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, attributes: typing.Mapping[str, typing.Any]) -> None:
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def add_event(self, name: str, **attributes: typing.Any) -> None:
+        """E.g. a retry, with the attempt and the error."""
+        self.events.append((time.time_ns(), name, {k: v for k, v in attributes.items() if v is not None}))
+
+    def set_error(self, message: str) -> None:
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    def to_otlp(self) -> dict[str, typing.Any]:
+        span: dict[str, typing.Any] = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": _attributes(self.attributes),
+            "status": {"code": self.status, **({"message": self.status_message} if self.status_message else {})},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.events:
+            span["events"] = [
+                {"timeUnixNano": str(ts), "name": name, "attributes": _attributes(attributes)}
+                for ts, name, attributes in self.events
+            ]
+        return span
+
+
+def _value(value: typing.Any) -> dict[str, typing.Any]:
+    # OTLP/JSON AnyValue; 64-bit integers are strings in the protobuf JSON mapping
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def _attributes(attributes: dict[str, typing.Any]) -> list[dict[str, typing.Any]]:
+    return [{"key": key, "value": _value(value)} for key, value in attributes.items()]
+
+
+def export_request(spans: list[Span]) -> dict[str, typing.Any]:
+    resource = {"service.name": SERVICE_NAME, "process.pid": os.getpid(), "pipeline.run_id": os.getenv("RUN_ID")}
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": _attributes({k: v for k, v in resource.items() if v is not None})},
+                "scopeSpans": [{"scope": {"name": SCOPE_NAME}, "spans": [span.to_otlp() for span in spans]}],
+            }
+        ]
+    }
+
+
+def flush() -> None:
+    """Append the finished spans of this process to the traces file."""
+    with _lock:
+        spans = [span for span in _finished if span.pid == os.getpid()]
+        _finished.clear()
+    if not spans or not os.getenv("LOGS_PATH"):
+        return
+    path = traces_path()
+    line = json.dumps(export_request(spans)) + "\n"
+    # Stages of several processes append to the same file
+    with fs_utils.locked(path), open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+atexit.register(flush)
+
+
+def _parent() -> Span | None:
+    span = _current.get()
+    if span is not None and span.pid == os.getpid():
+        return span
+    if _process_span is not None and _process_span.pid == os.getpid():
+        return _process_span
+    return None
+
+
+class _NoSpan:
+    """What span() yields when tracing is off: takes attributes and drops them."""
+
+    def set_attribute(self, key: str, value: typing.Any) -> None:
+        pass
+
+    def set_attributes(self, attributes: typing.Mapping[str, typing.Any]) -> None:
+        pass
+
+    def add_event(self, name: str, **attributes: typing.Any) -> None:
+        pass
+
+    def set_error(self, message: str) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+@contextmanager
+def span(
+    name: str, attributes: typing.Mapping[str, typing.Any] | None = None, *, kind: int = KIND_INTERNAL
+) -> typing.Iterator[Span | _NoSpan]:
+    """
+    A child of the current span (or of the run's root span), recorded when tracing is on.
+    Attribute keys are OpenTelemetry names, e.g. {"file.size": 42}.
+    """
+    global _process_span
+    if not enabled():
+        yield NO_SPAN
+        return
+    parent = _parent()
+    new = Span(name, parent, attributes, kind=kind)
+    outermost = parent is None
+    if outermost:
+        _process_span = new
+    token = _current.set(new)
+    try:
+        yield new
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            new.set_error(f"exit status {e.code}")
+        raise
+    except BaseException as e:
+        new.set_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        new.end_ns = time.time_ns()
+        _current.reset(token)
+        with _lock:
+            _finished.append(new)
+            full = len(_finished) >= FLUSH_EVERY
+        if outermost:
+            _process_span = None
+        if outermost or full:
+            flush()
+
+
+def traced(
+    name: str, result: str | None = None, attributes: typing.Mapping[str, typing.Any] | None = None
+) -> typing.Callable:
+    """
+    Decorator: run the function in a span, with its return value as the `result`
+    attribute when given. The function can add to the span through current().
+    """
+
+    def decorate(fn: typing.Callable) -> typing.Callable:
+        @functools.wraps(fn)
+        def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            with span(name, attributes) as new:
+                value = fn(*args, **kwargs)
+                if result and isinstance(value, (str, int, float, bool)):
+                    new.set_attribute(result, value)
+                return value
+
+        return wrapper
+
+    return decorate
+
+
+def current() -> Span | _NoSpan:
+    """The span of the running code, to add attributes or events to (a no-op when tracing is off)."""
+    return (_parent() if enabled() else None) or NO_SPAN
+
+
+def _ns(timestamp: str) -> int | None:
+    try:
+        return int(datetime.fromisoformat(timestamp).timestamp() * 1e9)
+    except (TypeError, ValueError):
+        return None
+
+
+def export_run(record: dict[str, typing.Any]) -> None:
+    """The run's root span, from its runs.jsonl record (every stage span hangs under it)."""
+    if not enabled() or not record.get("run_id"):
+        return
+    root = Span("pipeline run", None, {"pipeline.run_id": record["run_id"]})
+    # The ids the stage spans of the run point to
+    root.trace_id = _digest(f"trace:{record['run_id']}", 32)
+    root.span_id = _digest(f"root:{record['run_id']}", 16)
+    root.parent_id = None
+    root.start_ns = _ns(record.get("start", "")) or root.start_ns
+    root.end_ns = _ns(record.get("end", "")) or time.time_ns()
+    root.set_attributes({
+        "pipeline.status": record.get("status"),
+        "pipeline.reason": record.get("reason"),
+        "pipeline.projects_selected": record.get("projects_selected"),
+        "pipeline.downloaded_files": record.get("downloaded_files"),
+    })
+    if record.get("status") == "failed":
+        root.set_error(str(record.get("reason") or "failed"))
+    with _lock:
+        _finished.append(root)
+    flush()
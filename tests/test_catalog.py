@@ -0,0 +1,63 @@
+import os
+
+import pandas as pd
+import pytest
+
+from qfieldcloud_fetcher import catalog, table_io
+
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_PATH", str(tmp_path))
+    monkeypatch.setenv("RUN_ID", "r1")
+    for rel in ("in/pictures/pA/obs/IMG_1.jpg", "in/pictures/pB/obs/IMG_2.jpg", "formatted_csv/pA/obs_EPSG:4326.csv"):
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text("x")
+    return tmp_path
+
+
+def names(entries):
+    return [(e.project, e.layer, e.name) for e in entries]
+
+
+def test_a_tree_is_scanned_once_per_run_and_follows_the_stages(data, monkeypatch):
+    pictures = str(data / "in" / "pictures")
+    assert names(catalog.files(pictures)) == [("pA", "obs", "IMG_1.jpg"), ("pB", "obs", "IMG_2.jpg")]
+    assert catalog.files(pictures, "pA")[0].size == 1
+
+    # Written behind the catalog's back: not seen again within the run...
+    (data / "in" / "pictures" / "pA" / "obs" / "IMG_3.jpg").write_text("xyz")
+    assert len(catalog.files(pictures, "pA")) == 1
+    # ...unless the writer reports it
+    catalog.record(str(data / "in" / "pictures" / "pA" / "obs" / "IMG_3.jpg"))
+    assert names(catalog.files(pictures, "pA")) == [("pA", "obs", "IMG_1.jpg"), ("pA", "obs", "IMG_3.jpg")]
+
+    renamed = data / "renamed_pictures" / "pA" / "obs"
+    renamed.mkdir(parents=True)
+    os.rename(data / "in" / "pictures" / "pA" / "obs" / "IMG_1.jpg", renamed / "IMG_1.jpg")
+    catalog.moved(str(data / "in" / "pictures" / "pA" / "obs" / "IMG_1.jpg"), str(renamed / "IMG_1.jpg"))
+    assert names(catalog.files(pictures, "pA")) == [("pA", "obs", "IMG_3.jpg")]
+    assert catalog.files(str(data / "renamed_pictures"))[0].path == str(renamed / "IMG_1.jpg")
+
+    catalog.forget(str(data / "in" / "pictures" / "pB"))
+    assert names(catalog.files(pictures)) == [("pA", "obs", "IMG_3.jpg")]
+
+    # A new run reads the disk again
+    monkeypatch.setenv("RUN_ID", "r2")
+    assert names(catalog.files(pictures)) == [("pA", "obs", "IMG_3.jpg"), ("pB", "obs", "IMG_2.jpg")]
+
+
+def test_table_trees_and_unindexed_paths(data, tmp_path_factory):
+    formatted = str(data / "formatted_csv")
+    assert list(table_io.iter_tables(formatted)) == [
+        ("pA", "obs_EPSG:4326.csv", str(data / "formatted_csv" / "pA" / "obs_EPSG:4326.csv"))
+    ]
+    path = table_io.write_table(pd.DataFrame({"a": [1]}), os.path.join(formatted, "pB"), "t", "csv")
+    assert [project for project, _name, _path in table_io.iter_tables(formatted)] == ["pA", "pB"]
+    assert [p for _project, _name, p in table_io.iter_tables(os.path.join(formatted, "pB"))] == [path]
+
+    elsewhere = tmp_path_factory.mktemp("elsewhere")
+    (elsewhere / "pC" / "obs").mkdir(parents=True)
+    (elsewhere / "pC" / "obs" / "IMG_4.jpg").write_text("x")
+    assert not catalog.indexed(str(elsewhere))
+    assert names(catalog.files(str(elsewhere))) == [("pC", "obs", "IMG_4.jpg")]
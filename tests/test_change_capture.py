@@ -0,0 +1,33 @@
+from qfieldcloud_fetcher.change_capture import ChangeSet, diff_snapshots, table_key
+
+
+def test_diff_snapshots_reports_row_changes():
+    previous = {
+        "observations": {"sample_id:a": "h1", "sample_id:b": "h2", "fid:3": "h3"},
+        "species": {"fid:1": "s1"},
+    }
+    current = {
+        "observations": {"sample_id:a": "h1", "sample_id:b": "h2b", "sample_id:c": "h4", "fid:3": "h3b"},
+        "species": {"fid:1": "s1"},
+        "multi_extra": {"sample_id:d": "h5"},
+    }
+
+    changes = ChangeSet.from_json(diff_snapshots("p1", previous, current).to_json())
+
+    assert not changes.full
+    assert changes.tables == {
+        "multi_extra": {"inserted": ["sample_id:d"], "updated": [], "deleted": []},
+        "observations": {"inserted": ["sample_id:c"], "updated": ["fid:3", "sample_id:b"], "deleted": []},
+    }
+    assert changes.inserted == {"c", "d"} and changes.updated == {"b"}
+    assert changes.unkeyed_tables == {"observations"}
+    assert changes.includes("b") and not changes.includes("a")
+    assert changes.includes("obs_4695_7438", table_key("observations_EPSG:4326.csv"))
+    assert not changes.includes("obs_4695_7438", "species")
+    assert not changes.table_changed("species")
+
+
+def test_first_snapshot_is_a_full_run():
+    changes = diff_snapshots("p1", None, {"observations": {"sample_id:a": "h1"}})
+    assert changes.full
+    assert changes.includes("anything") and changes.table_changed("species")
@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip("pyproj")
+pytest.importorskip("shapely")
+
+from qfieldcloud_fetcher import csv_formatter
+
+
+def write_raw(path, rows):
+    lines = ["sample_id,x_coord,y_coord,is_wild,geometry"]
+    for sample_id, x, y, is_wild in rows:
+        lines.append(f"{sample_id},{x},{y},{is_wild},POINT ({x} {y})")
+    path.write_text("\n".join(lines) + "\n")
+
+
+def test_plan_batches_groups_files_by_crs():
+    tables = [
+        ("p1", "a_EPSG:2056.csv", "/raw/p1/a_EPSG:2056.csv"),
+        ("p1", "b_EPSG:4326.csv", "/raw/p1/b_EPSG:4326.csv"),
+        ("p2", "c_EPSG:2056.parquet", "/raw/p2/c_EPSG:2056.parquet"),
+        ("p2", "d_EPSG:2056.csv", "/raw/p2/d_EPSG:2056.csv"),
+    ]
+
+    batches = csv_formatter.plan_batches(tables, batch_size=2)
+
+    assert batches == [
+        ("EPSG:2056", [("/raw/p1/a_EPSG:2056.csv", "p1"), ("/raw/p2/c_EPSG:2056.parquet", "p2")]),
+        ("EPSG:2056", [("/raw/p2/d_EPSG:2056.csv", "p2")]),
+        ("EPSG:4326", [("/raw/p1/b_EPSG:4326.csv", "p1")]),
+    ]
+
+
+def test_batched_conversion_matches_single_files(tmp_path, monkeypatch):
+    raw = tmp_path / "raw" / "p1"
+    raw.mkdir(parents=True)
+    write_raw(
+        raw / "obs_EPSG:2056.csv", [("dbgi_000001", 2600000.5, 1200000.0, "True"), ("", 2600001.25, 1200001.0, "")]
+    )
+    write_raw(raw / "plants_EPSG:2056.csv", [("dbgi_000002", 2600100.0, 1200100.0, "False")])
+    items = [(str(raw / "obs_EPSG:2056.csv"), "p1"), (str(raw / "plants_EPSG:2056.csv"), "p1")]
+
+    outputs = {}
+    for mode, batches in (("single", [[item] for item in items]), ("batched", [items])):
+        monkeypatch.setattr(csv_formatter, "out_csv_path", str(tmp_path / mode / "formatted"))
+        monkeypatch.setattr(csv_formatter, "nextcloud_path", str(tmp_path / mode / "nextcloud"))
+        for batch in batches:
+            csv_formatter.convert_batch(batch, "EPSG:2056")
+        outputs[mode] = {
+            name: (tmp_path / mode / "nextcloud" / "p1" / name).read_text()
+            for name in ("obs_EPSG:4326.csv", "plants_EPSG:4326.csv")
+        }
+
+    assert outputs["batched"] == outputs["single"]
+    header, first, second = outputs["batched"]["obs_EPSG:4326.csv"].splitlines()
+    assert header == "sample_id,x_coord,y_coord,is_wild,geometry,latitude,longitude"
+    assert first.startswith("dbgi_000001,2600000.5,1200000.0,1,POINT (46.95")
+    assert second.startswith("obs_")
+    assert ",0,POINT (" in second
+
+
+def test_chunked_conversion_matches_full_files(tmp_path, monkeypatch):
+    raw = tmp_path / "raw" / "p1"
+    raw.mkdir(parents=True)
+    # count only turns float in the last chunk, is_wild has gaps and obs_ ids are generated per chunk
+    (raw / "obs_EPSG:2056.csv").write_text(
+        "sample_id,x_coord,y_coord,count,is_wild,flag\n"
+        "dbgi_000001,2600000.5,1200000.0,1,True,True\n"
+        ",2600001.25,1200001.0,2,,False\n"
+        "dbgi_000003,2600002.0,1200002.0,,False,\n"
+    )
+    path = str(raw / "obs_EPSG:2056.csv")
+
+    outputs = {}
+    for mode, chunk_size in (("full", 0), ("chunked", 1)):
+        monkeypatch.setattr(csv_formatter, "out_csv_path", str(tmp_path / mode / "formatted"))
+        monkeypatch.setattr(csv_formatter, "nextcloud_path", str(tmp_path / mode / "nextcloud"))
+        csv_formatter.convert_batch([(path, "p1")], "EPSG:2056", chunk_size=chunk_size)
+        outputs[mode] = (tmp_path / mode / "nextcloud" / "p1" / "obs_EPSG:4326.csv").read_text()
+
+    assert outputs["chunked"] == outputs["full"]
+    assert outputs["chunked"].splitlines()[1].startswith("dbgi_000001,2600000.5,1200000.0,1.0,1,True,")
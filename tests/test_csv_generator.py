@@ -0,0 +1,72 @@
+import json
+import os
+
+import pytest
+
+from qfieldcloud_fetcher import catalog, csv_generator
+
+
+def write_gpkg(path, name="value"):
+    gpd = pytest.importorskip("geopandas")
+    shapely = pytest.importorskip("shapely")
+
+    gpd.GeoDataFrame(
+        {name: [1, 2]}, geometry=[shapely.Point(2600000, 1200000), shapely.Point(2600001, 1200001)], crs="EPSG:2056"
+    ).to_file(path, layer=os.path.splitext(os.path.basename(path))[0], driver="GPKG")
+    gpd.GeoDataFrame({"name": ["p1"]}, geometry=[shapely.LineString([(0, 0), (1, 1)])], crs="EPSG:4326").to_file(
+        path, layer="tracks", driver="GPKG"
+    )
+
+
+@pytest.mark.parametrize("engine", ["geopandas", "arrow"])
+def test_every_layer_is_written_with_its_crs(tmp_path, engine):
+    gpkg_path = str(tmp_path / "sites.gpkg")
+    write_gpkg(gpkg_path)
+
+    results = csv_generator.convert_gpkg(gpkg_path, str(tmp_path / "out"), engine)
+
+    # The first layer keeps the historical <gpkg>_<crs> name
+    assert [(os.path.basename(path), rows) for path, rows, _ in results] == [
+        ("sites_EPSG:2056.csv", 2),
+        ("sites_tracks_EPSG:4326.csv", 1),
+    ]
+
+
+def test_sqlite_engine_records_its_csvs_in_the_catalog(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_PATH", str(tmp_path))
+    monkeypatch.setenv("RUN_ID", "r1")
+    gpkg_path = str(tmp_path / "in" / "gpkg" / "p1" / "sites.gpkg")
+    os.makedirs(os.path.dirname(gpkg_path))
+    write_gpkg(gpkg_path)
+    raw_csv = tmp_path / "raw_csv"
+    (raw_csv / "p1").mkdir(parents=True)
+    # raw_csv is scanned earlier in the run, then the project is emptied like in main()
+    assert catalog.files(str(raw_csv)) == []
+    catalog.forget(str(raw_csv / "p1"))
+
+    csv_generator.convert_gpkg(gpkg_path, str(raw_csv / "p1"), "sqlite")
+
+    assert [entry.name for entry in catalog.files(str(raw_csv), "p1")] == [
+        "sites_EPSG:2056.csv",
+        "sites_tracks_EPSG:4326.csv",
+    ]
+
+
+def test_jobs_convert_every_gpkg_and_record_the_projects(tmp_path, monkeypatch):
+    for project, name in (("p1", "sites"), ("p2", "plots")):
+        (tmp_path / "in" / "gpkg" / project).mkdir(parents=True)
+        write_gpkg(str(tmp_path / "in" / "gpkg" / project / f"{name}.gpkg"))
+    monkeypatch.setattr(csv_generator, "data_path", str(tmp_path))
+    monkeypatch.setattr(csv_generator, "in_gpkg_path", str(tmp_path / "in" / "gpkg"))
+    monkeypatch.setattr(csv_generator, "in_csv_path", str(tmp_path / "raw_csv"))
+
+    csv_generator.main(["--jobs", "2", "--format", "csv"])
+
+    assert sorted(os.listdir(tmp_path / "raw_csv" / "p1")) == ["sites_EPSG:2056.csv", "sites_tracks_EPSG:4326.csv"]
+    assert sorted(os.listdir(tmp_path / "raw_csv" / "p2")) == ["plots_EPSG:2056.csv", "plots_tracks_EPSG:4326.csv"]
+    entries = json.loads((tmp_path / "stage_cache.json").read_text())["stages"]["csv_generator"]
+    assert [os.path.basename(path) for path in entries["p2"]["outputs"]] == [
+        "plots_EPSG:2056.csv",
+        "plots_tracks_EPSG:4326.csv",
+    ]
+    assert set(entries) == {"p1", "p2"}
@@ -0,0 +1,187 @@
+import json
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+from qfieldcloud_fetcher import delta_ingest, gpkg_reader
+
+
+def make_gpkg(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT, srs_id INTEGER PRIMARY KEY, organization TEXT,
+            organization_coordsys_id INTEGER, definition TEXT, description TEXT);
+        CREATE TABLE gpkg_contents (table_name TEXT PRIMARY KEY, data_type TEXT, identifier TEXT);
+        CREATE TABLE gpkg_geometry_columns (table_name TEXT, column_name TEXT, geometry_type_name TEXT,
+            srs_id INTEGER, z INTEGER, m INTEGER);
+        INSERT INTO gpkg_spatial_ref_sys VALUES ('CH1903+', 2056, 'EPSG', 2056, '', '');
+        INSERT INTO gpkg_contents VALUES ('observations', 'features', 'observations');
+        INSERT INTO gpkg_geometry_columns VALUES ('observations', 'geom', 'POINT', 2056, 0, 0);
+        CREATE TABLE observations (fid INTEGER PRIMARY KEY, geom POINT, sample_id TEXT, count INTEGER, checked BOOLEAN);
+        """
+    )
+    conn.executemany(
+        "INSERT INTO observations VALUES (?, ?, ?, ?, ?)",
+        [
+            (1, gpkg_reader.encode_point((2600000.0, 1200000.0), 2056), "a", 1, 0),
+            (2, gpkg_reader.encode_point((2600001.0, 1200001.0), 2056), "b", 2, 0),
+        ],
+    )
+    conn.executescript(
+        """
+        CREATE TABLE extent (fid INTEGER PRIMARY KEY, minx REAL);
+        -- Stand-in for the R-tree triggers, which call the same SpatiaLite functions
+        CREATE TRIGGER observations_extent AFTER INSERT ON observations
+        WHEN NOT ST_IsEmpty(NEW.geom) BEGIN INSERT INTO extent VALUES (NEW.fid, ST_MinX(NEW.geom)); END;
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def delta(delta_id, created_at, content, status="STATUS_APPLIED"):
+    return {"id": delta_id, "created_at": created_at, "status": status, "content": content}
+
+
+def serve(pages):
+    """Mock of GET /api/v1/deltas/<project_id>/, paginated over `pages`."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            page = int(self.path.rsplit("page=", 1)[1]) if "page=" in self.path else 0
+            if not self.path.startswith("/api/v1/deltas/p1/"):
+                self.send_response(404)
+                self.end_headers()
+                return
+            payload = {"results": pages[page], "next": None}
+            if page + 1 < len(pages):
+                payload["next"] = f"http://127.0.0.1:{self.server.server_port}/api/v1/deltas/p1/?page={page + 1}"
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/api/v1/"
+
+
+@pytest.fixture
+def project(tmp_path):
+    make_gpkg(tmp_path / "observations.gpkg")
+    return tmp_path
+
+
+def test_ingest_project_applies_new_deltas(project):
+    layer = "observations_6b8f2c1e_0d1f_4f5e_9a2b_3c4d5e6f7a8b"
+    pages = [
+        [
+            delta("d0", "2026-01-01T00:00:00Z", {"method": "patch", "sourceLayerId": layer, "sourcePk": 1}),
+            delta(
+                "d1",
+                "2026-01-02T00:00:00Z",
+                {
+                    "method": "create",
+                    "sourceLayerId": layer,
+                    "sourcePk": 3,
+                    "new": {"attributes": {"sample_id": "c", "count": 5, "checked": True}, "geometry": "Point (1 2)"},
+                },
+            ),
+        ],
+        [
+            delta(
+                "d2",
+                "2026-01-03T00:00:00Z",
+                {
+                    "method": "patch",
+                    "sourceLayerId": layer,
+                    "sourcePk": 1,
+                    "old": {"attributes": {"count": 1}},
+                    "new": {"attributes": {"count": 7}, "geometry": "POINT Z (3 4 5)"},
+                },
+            ),
+            delta("d3", "2026-01-04T00:00:00Z", {"method": "delete", "sourceLayerId": layer, "sourcePk": 2}),
+            delta("d4", "2026-01-05T00:00:00Z", {"method": "delete", "sourceLayerId": layer, "sourcePk": 1}, "pending"),
+        ],
+    ]
+    server, api_base = serve(pages)
+    try:
+        watermark, counts = delta_ingest.ingest_project(
+            requests.Session(),
+            api_base,
+            "p1",
+            str(project),
+            {"created_at": "2026-01-01T00:00:00Z", "ids": ["d0"]},
+            "Token t",
+        )
+    finally:
+        server.shutdown()
+
+    assert counts == {"created": 1, "patched": 1, "deleted": 1}
+    assert watermark == {"created_at": "2026-01-04T00:00:00Z", "ids": ["d3"], "unsettled": ["d4"]}
+    conn = sqlite3.connect(project / "observations.gpkg")
+    rows = conn.execute("SELECT fid, geom, sample_id, count, checked FROM observations ORDER BY fid").fetchall()
+    assert [(fid, gpkg_reader.decode_point(geom), *rest) for fid, geom, *rest in rows] == [
+        (1, (3.0, 4.0, 5.0), "a", 7, 0),
+        (3, (1.0, 2.0), "c", 5, 1),
+    ]
+    assert conn.execute("SELECT minx FROM extent WHERE fid = 3").fetchone() == (1.0,)
+    conn.close()
+    assert sorted(p.name for p in project.iterdir()) == ["observations.gpkg"]
+
+
+def test_inconsistent_delta_leaves_the_gpkg_untouched(project):
+    before = (project / "observations.gpkg").read_bytes()
+    deltas = [
+        delta(
+            "d1",
+            "2026-01-02T00:00:00Z",
+            {"method": "delete", "sourceLayerId": "observations_x", "sourcePk": 2},
+        ),
+        delta(
+            "d2",
+            "2026-01-03T00:00:00Z",
+            {"method": "patch", "sourceLayerId": "observations_x", "sourcePk": 1, "old": {"attributes": {"count": 9}}},
+        ),
+    ]
+    with pytest.raises(delta_ingest.DeltaError, match="old value"):
+        delta_ingest.apply_deltas(str(project), deltas)
+    with pytest.raises(delta_ingest.DeltaError, match="not a point"):
+        delta_ingest.apply_deltas(
+            str(project),
+            [
+                delta(
+                    "d3",
+                    "",
+                    {
+                        "method": "patch",
+                        "sourceLayerId": "observations_x",
+                        "sourcePk": 1,
+                        "new": {"geometry": "LineString (0 0, 1 1)"},
+                    },
+                )
+            ],
+        )
+    assert (project / "observations.gpkg").read_bytes() == before
+    assert sorted(p.name for p in project.iterdir()) == ["observations.gpkg"]
+
+
+def test_missing_endpoint_or_new_deltas_falls_back(project):
+    server, api_base = serve([[]])
+    try:
+        with pytest.raises(delta_ingest.DeltaError, match="HTTP 404"):
+            delta_ingest.ingest_project(requests.Session(), api_base, "other", str(project), {"ids": []}, "Token t")
+        with pytest.raises(delta_ingest.DeltaError, match="no new applied delta"):
+            delta_ingest.ingest_project(requests.Session(), api_base, "p1", str(project), {"ids": []}, "Token t")
+    finally:
+        server.shutdown()
+    with pytest.raises(delta_ingest.DeltaError, match="no watermark"):
+        delta_ingest.ingest_project(requests.Session(), api_base, "p1", str(project), None, "Token t")
@@ -0,0 +1,122 @@
+import threading
+from types import SimpleNamespace
+
+from qfieldcloud_fetcher import directus_link_maker
+from qfieldcloud_fetcher.directus_link_maker import (
+    AdaptiveBatcher,
+    LinkStats,
+    build_targets,
+    build_updates,
+    iter_dried_pages,
+    run_pipelined,
+)
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        self.text = "ok"
+        self._data = data
+
+    def json(self):
+        return {"data": self._data}
+
+
+class FakeSession:
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append(dict(params))
+        after = params.get("filter[id][_gt]", 0)
+        page = [r for r in self.rows if r["id"] > after][: params["limit"]]
+        return FakeResponse(page)
+
+
+def test_iter_dried_pages_uses_keyset_pagination():
+    session = FakeSession([{"id": i} for i in range(1, 6)])
+
+    pages = list(iter_dried_pages(session, "https://directus/items/Dried_Samples_Data", page_size=2))
+
+    assert [[r["id"] for r in p] for p in pages] == [[1, 2], [3, 4], [5]]
+    assert [c.get("filter[id][_gt]") for c in session.calls] == [None, 2, 4]
+    assert all(c["sort"] == "id" for c in session.calls)
+
+
+def test_build_targets_and_updates():
+    rows = [
+        {"id": 1, "sample_container": {"container_id": "dbgi_000001"}},
+        {"id": 2, "sample_container": {"container_id": "obs_4680_712"}},
+        {"id": 3, "sample_container": None},
+        {"id": 4, "sample_container": {"container_id": "dbgi_000002"}},
+    ]
+
+    targets, skipped_obs = build_targets(rows)
+    updates, unmatched = build_updates(targets, {"dbgi_000001": 10})
+
+    assert targets == [(1, "dbgi_000001"), (4, "dbgi_000002")]
+    assert skipped_obs == 1
+    assert updates == [{"id": 1, "field_data": 10}]
+    assert unmatched == 1
+
+
+class FakeDirectus:
+    """Thread-safe stand-in for Dried_Samples_Data/Field_Data endpoints."""
+
+    def __init__(self, dried, fields, fail_first_patch=False):
+        self.dried = dried
+        self.fields = fields
+        self.patched = {}
+        self.fail_first_patch = fail_first_patch
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, timeout=None):
+        if url.endswith("Field_Data"):
+            codes = params["filter[sample_id][_in]"].split(",")
+            return FakeResponse([{"id": self.fields[c], "sample_id": c} for c in codes if c in self.fields])
+        after = params.get("filter[id][_gt]", 0)
+        page = [
+            {"id": i, "sample_container": {"container_id": code}} for i, code in sorted(self.dried.items()) if i > after
+        ]
+        return FakeResponse(page[: params["limit"]])
+
+    def patch(self, url, json=None, timeout=None):
+        with self.lock:
+            if self.fail_first_patch:
+                self.fail_first_patch = False
+                return FakeResponse({}, status_code=500)
+            for row in json:
+                self.patched[row["id"]] = row["field_data"]
+        return FakeResponse({})
+
+
+def test_run_pipelined_links_every_match_and_retries_failed_batch(monkeypatch):
+    monkeypatch.setattr(directus_link_maker.time, "sleep", lambda _s: None)
+    dried = {i: f"dbgi_{i:06d}" for i in range(1, 26)}
+    dried[7] = "obs_4680_712"
+    fields = {code: 1000 + i for i, code in dried.items() if i % 5 and i != 7}
+    session = FakeDirectus(dried, fields, fail_first_patch=True)
+    args = SimpleNamespace(page_size=10, batch_size=4, workers=3, retries=2, dry_run=False)
+    stats = LinkStats()
+
+    run_pipelined(session, "https://d/items/Dried_Samples_Data", "https://d/items/Field_Data", args, stats)
+
+    expected = {i: 1000 + i for i in dried if i % 5 and i != 7}
+    assert session.patched == expected
+    assert stats.applied == len(expected)
+    assert stats.skipped_obs == 1
+    assert stats.unmatched == 5
+    assert stats.failed_batches == 0
+    assert stats.pages == 3
+
+
+def test_adaptive_batcher_caps_lookup_url_length():
+    batcher = AdaptiveBatcher(initial=1000, max_url_len=200)
+
+    batches = batcher.split_codes([f"dbgi_{i:06d}" for i in range(50)], "https://d/items/Field_Data")
+
+    assert sum(len(b) for b in batches) == 50
+    assert all(len(b) < 50 for b in batches)
+    batcher.observe(10.0)
+    assert batcher.size == 500
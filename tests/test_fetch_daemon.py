@@ -0,0 +1,95 @@
+import json
+import urllib.request
+
+from qfieldcloud_fetcher import fetch_daemon
+
+FILES_BASE = "https://qfc/api/v1/files/"
+
+
+class FakeClient:
+    def __init__(self):
+        self.files = {"pA": [{"name": "a.gpkg", "md5sum": "a2"}], "pB": [{"name": "b.gpkg", "md5sum": "b1"}]}
+
+    def list_projects(self):
+        return [{"id": "pA", "name": "alpha"}, {"id": "pB", "name": "beta"}]
+
+    def list_remote_files(self, project_id):
+        return self.files[project_id]
+
+
+class FakeProcess:
+    pid = 4242
+    returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+def write_state(path, md5s):
+    files = {f"{FILES_BASE}{pid}/{name}": {"md5": md5} for (pid, name), md5 in md5s.items()}
+    path.write_text(json.dumps({"last_pull": None, "files": files}))
+
+
+def test_only_changed_projects_are_processed_and_idle_ones_back_off(tmp_path):
+    state = tmp_path / "state.json"
+    write_state(state, {("pA", "a.gpkg"): "a1", ("pB", "b.gpkg"): "b1"})
+    client, runs = FakeClient(), []
+
+    def start_run():
+        runs.append(FakeProcess())
+        return runs[-1]
+
+    watcher = fetch_daemon.Watcher(lambda: client, start_run, str(state), FILES_BASE, min_interval=60, max_interval=300)
+
+    watcher.tick(0)
+    assert watcher.run.projects == ["alpha"]
+    alpha, beta = watcher.projects["pA"], watcher.projects["pB"]
+    assert (alpha.interval, alpha.last_change) == (60, 0)
+    assert (beta.interval, beta.last_change) == (120, None)
+
+    # beta gets an upload while alpha is being processed: it waits for the next run
+    client.files["pB"] = [{"name": "b.gpkg", "md5sum": "b2"}, {"name": "DCIM/obs/1.jpg", "md5sum": "j1"}]
+    watcher.tick(60)
+    watcher.tick(120)
+    assert alpha.interval == 120
+    assert (beta.interval, beta.last_change) == (60, 120)
+    status = watcher.status(120)
+    assert (status["queue_depth"], status["queue"]) == (1, ["beta"])
+    assert status["running"]["projects"] == ["alpha"]
+    assert len(runs) == 1
+
+    # The run fetched alpha: only beta is left for the next one
+    write_state(state, {("pA", "a.gpkg"): "a2", ("pB", "b.gpkg"): "b1"})
+    runs[0].returncode = 0
+    watcher.tick(130)
+    assert watcher.last_run["projects"] == ["alpha"] and watcher.last_run["status"] == "ok"
+    assert watcher.run.projects == ["beta"]
+    assert watcher.status(130)["projects"]["alpha"]["queued"] is False
+
+
+def test_status_endpoint_reports_the_queue(tmp_path):
+    watcher = fetch_daemon.Watcher(FakeClient, FakeProcess, str(tmp_path / "state.json"), FILES_BASE)
+    watcher.tick(0)
+    server = fetch_daemon.serve_status(watcher, 0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/status") as response:
+            status = json.load(response)
+    finally:
+        server.shutdown()
+    # Without a state file, every project is fetched in the first run
+    assert status["running"]["projects"] == ["alpha", "beta"]
+    assert status["projects"]["beta"]["polls"] == 1
+
+
+def test_the_pipeline_output_is_appended_to_its_log(tmp_path, monkeypatch):
+    started = []
+    monkeypatch.setattr(fetch_daemon, "logs_path", str(tmp_path))
+    monkeypatch.setattr(fetch_daemon.subprocess, "Popen", lambda command, **kwargs: started.append(kwargs))
+    log = tmp_path / "fetch_daemon_pipeline.log"
+    log.write_text("previous run\n")
+
+    fetch_daemon.start_pipeline()
+
+    assert started[0]["stdout"].name == str(log)
+    assert started[0]["stderr"] == fetch_daemon.subprocess.STDOUT
+    assert log.read_text().startswith("previous run\n--- ")
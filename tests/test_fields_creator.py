@@ -0,0 +1,67 @@
+from qfieldcloud_fetcher.fields_creator import (
+    add_geometry_validations,
+    diff_fields,
+    sample_column_dtypes,
+    schema_already_synced,
+)
+
+
+def test_diff_fields_reports_missing_and_mismatched_fields():
+    inferred = {"sample_id": "string", "geometry": "geometry.Point", "latitude": "float", "is_wild": "integer"}
+    existing = {"id": "integer", "sample_id": "string", "geometry": "geometry", "latitude": "string"}
+
+    missing, mismatched = diff_fields(inferred, existing)
+
+    assert missing == {"is_wild": "integer"}
+    assert mismatched == {"latitude": ("float", "string")}
+
+
+def test_sample_column_dtypes_matches_full_read(tmp_path):
+    path = tmp_path / "observations_EPSG:4326.csv"
+    lines = ["sample_id,count,late,latitude,altitude"]
+    for i in range(30):
+        count = "" if i == 25 else str(i)
+        late = "x" if i == 28 else ""
+        altitude = "unknown" if i == 29 else f"{400 + i}.5"
+        lines.append(f"dbgi_{i:06d},{count},{late},46.{i},{altitude}")
+    path.write_text("\n".join(lines) + "\n")
+
+    sampled = sample_column_dtypes(str(path), sample_rows=10)
+
+    assert sampled == {
+        "sample_id": "string",
+        "count": "float64",
+        "late": "object",
+        "latitude": "float64",
+        "altitude": "object",
+    }
+
+
+def test_schema_already_synced_accepts_subset_of_synced_fields():
+    state = {"collection": "Field_Data", "fingerprint": "old", "fields": {"sample_id": "string", "latitude": "float"}}
+
+    assert schema_already_synced({"sample_id": "string"}, state)
+    assert not schema_already_synced({"sample_id": "string", "is_wild": "integer"}, state)
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = "" if status_code == 200 else "Forbidden"
+
+
+class FakeSession:
+    """Rejects the batched update and the update of the fields in `rejected`."""
+
+    def __init__(self, rejected):
+        self.rejected = rejected
+
+    def patch(self, url, json, headers):
+        if isinstance(json, list) or url.rsplit("/", 1)[-1] in self.rejected:
+            return FakeResponse(403)
+        return FakeResponse(200)
+
+
+def test_add_geometry_validations_counts_the_failed_fields():
+    assert add_geometry_validations(FakeSession(set()), {}, []) == 0
+    assert add_geometry_validations(FakeSession({"geometry"}), {}, ["geometry", "geometry_2"]) == 1
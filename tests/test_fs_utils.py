@@ -0,0 +1,58 @@
+import errno
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from qfieldcloud_fetcher import fs_utils
+
+
+def test_publish_file_links_then_skips_unchanged(tmp_path):
+    source = tmp_path / "formatted" / "obs_EPSG:4326.csv"
+    source.parent.mkdir()
+    source.write_text("sample_id\na\n")
+    destination = tmp_path / "nextcloud" / "p1" / "obs_EPSG:4326.csv"
+
+    assert fs_utils.publish_file(str(source), str(destination)) == "hardlink"
+    assert destination.read_text() == "sample_id\na\n"
+
+    # Same bytes in a new file: the published copy keeps its inode and mtime
+    source.unlink()
+    source.write_text("sample_id\na\n")
+    before = os.stat(destination)
+    assert fs_utils.publish_file(str(source), str(destination)) == "unchanged"
+    assert os.stat(destination).st_mtime_ns == before.st_mtime_ns
+
+    source.unlink()
+    source.write_text("sample_id\nb\n")
+    assert fs_utils.publish_file(str(source), str(destination)) == "hardlink"
+    assert destination.read_text() == "sample_id\nb\n"
+    assert sorted(os.listdir(destination.parent)) == ["obs_EPSG:4326.csv"]
+
+
+def test_publish_file_copies_across_filesystems(tmp_path, monkeypatch):
+    source = tmp_path / "obs.csv"
+    source.write_text("sample_id\na\n")
+    destination = tmp_path / "out" / "obs.csv"
+
+    def cross_device_link(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, "link", cross_device_link)
+    assert fs_utils.publish_file(str(source), str(destination)) in ("reflink", "copy")
+    assert destination.read_text() == "sample_id\na\n"
+    assert not os.path.samefile(source, destination)
+
+
+def _record(path, worker):
+    for i in range(10):
+        fs_utils.update_json(path, {f"{worker}/{i}": i})
+
+
+def test_update_json_keeps_keys_written_by_other_processes(tmp_path):
+    path = str(tmp_path / "picture_map.json")
+    fs_utils.update_json(path, {"old": 0})
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        list(pool.map(_record, [path] * 4, range(4)))
+
+    with open(path, encoding="utf-8") as f:
+        assert len(json.load(f)) == 41
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from qfieldcloud_fetcher import gpkg_reader
+from qfieldcloud_fetcher.gpkg_reader import format_ordinate
+
+
+def test_format_ordinate_matches_geos_wkt():
+    assert format_ordinate(0.0) == "0"
+    assert format_ordinate(2600000.0) == "2600000"
+    assert format_ordinate(46.2044) == "46.2044"
+    assert format_ordinate(-0.1) == "-0.1"
+    assert format_ordinate(1e-07) == "1e-7"
+    assert format_ordinate(1.2345678901234568e17) == "1.2345678901234568e+17"
+    assert format_ordinate(0.00012345678901234567) == "0.0001234567890123"
+
+
+def write_fixture(tmp_path):
+    gpd = pytest.importorskip("geopandas")
+    pd = pytest.importorskip("pandas")
+    shapely = pytest.importorskip("shapely")
+
+    gpkg_path = str(tmp_path / "observations.gpkg")
+    gpd.GeoDataFrame(
+        {
+            "sample_id": ["a,1", 'b "2"', None],
+            "count": pd.array([3, None, 5], dtype="Int64"),
+            "individuals": [1, 2, 3],
+            "is_wild": [True, False, True],
+            "x_coord": [2600000.5, 2600001.25, None],
+            "date": ["2024-05-01", "2024-05-02", None],
+        },
+        geometry=[
+            shapely.Point(2600000.5, 1200000.123456789),
+            shapely.Point(2600001.25, 1200001, 450.5),
+            None,
+        ],
+        crs="EPSG:2056",
+    ).to_file(gpkg_path, layer="observations", driver="GPKG")
+    gpd.GeoDataFrame({"name": ["p1"]}, geometry=[shapely.LineString([(0, 0), (1, 1)])], crs="EPSG:4326").to_file(
+        gpkg_path, layer="tracks", driver="GPKG"
+    )
+    return gpkg_path
+
+
+def test_sqlite_engine_matches_geopandas(tmp_path):
+    gpkg_path = write_fixture(tmp_path)
+    from qfieldcloud_fetcher.csv_generator import convert_gpkg
+
+    expected = convert_gpkg(gpkg_path, str(tmp_path / "geopandas"), "geopandas")
+    actual = convert_gpkg(gpkg_path, str(tmp_path / "sqlite"), "sqlite")
+
+    assert [os.path.basename(p) for p, _, _ in actual] == [os.path.basename(p) for p, _, _ in expected]
+    for (expected_path, expected_rows, _), (actual_path, actual_rows, _) in zip(expected, actual):
+        assert actual_rows == expected_rows
+        with open(expected_path, "rb") as e, open(actual_path, "rb") as a:
+            assert a.read() == e.read()
+
+
+def test_sqlite_engine_parquet_matches_geopandas(tmp_path):
+    gpkg_path = write_fixture(tmp_path)
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    from qfieldcloud_fetcher.csv_generator import convert_gpkg
+    from qfieldcloud_fetcher.table_io import read_table
+
+    expected = convert_gpkg(gpkg_path, str(tmp_path / "geopandas"), "geopandas", "parquet")
+    actual = convert_gpkg(gpkg_path, str(tmp_path / "sqlite"), "sqlite", "parquet")
+
+    assert [os.path.basename(p) for p, _, _ in actual] == [os.path.basename(p) for p, _, _ in expected]
+    for (expected_path, _, _), (actual_path, _, _) in zip(expected, actual):
+        pd.testing.assert_frame_equal(read_table(actual_path), read_table(expected_path))
+
+
+def test_non_point_layer_is_unsupported(tmp_path):
+    gpd = pytest.importorskip("geopandas")
+    shapely = pytest.importorskip("shapely")
+
+    gpkg_path = str(tmp_path / "tracks.gpkg")
+    gpd.GeoDataFrame({"name": ["p1"]}, geometry=[shapely.LineString([(0, 0), (1, 1)])], crs="EPSG:4326").to_file(
+        gpkg_path, driver="GPKG"
+    )
+
+    conn = gpkg_reader.connect(gpkg_path)
+    try:
+        (layer,) = gpkg_reader.list_layers(conn)
+        assert layer.crs == "EPSG:4326"
+        with pytest.raises(gpkg_reader.UnsupportedLayer):
+            gpkg_reader.write_layer_csv(conn, layer, str(tmp_path / "tracks.csv"))
+    finally:
+        conn.close()
+    assert not os.path.exists(tmp_path / "tracks.csv")
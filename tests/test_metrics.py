@@ -0,0 +1,70 @@
+import json
+
+import pytest
+import requests
+
+from qfieldcloud_fetcher import metrics
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    """Answers every request with the status in its path, without a network."""
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = int(request.url.rsplit("/", 1)[-1])
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def test_stage_records_are_aggregated_into_the_run_record_and_the_textfile(tmp_path, monkeypatch):
+    monkeypatch.setenv("RUN_ID", "r1")
+    monkeypatch.setenv("METRICS_TEXTFILE", str(tmp_path / "textfile" / "pipeline.prom"))
+    session = requests.Session()
+    session.mount("http://", FakeAdapter())
+
+    with metrics.measure("db_updater", ["--project", "pA"], str(tmp_path)):
+        metrics.count("records_created", 2)
+        session.get("http://directus/200")
+        session.get("http://directus/500")
+    with pytest.raises(SystemExit), metrics.measure("db_updater", ["--project", "pA"], str(tmp_path)):
+        metrics.count("records_created", 1)
+        raise SystemExit(1)
+    with metrics.measure("csv_generator", [], str(tmp_path)):
+        pass
+    # Outside measure(): not counted anywhere
+    metrics.count("records_created", 100)
+    session.get("http://directus/200")
+
+    records = [json.loads(line) for line in (tmp_path / "stage_metrics.jsonl").read_text().splitlines()]
+    assert [(r["stage"], r["project"], r["status"]) for r in records] == [
+        ("db_updater", "pA", "ok"),
+        ("db_updater", "pA", "failed"),
+        ("csv_generator", None, "ok"),
+    ]
+    assert records[0]["http"]["requests"] == 2 and records[0]["http"]["errors"] == 1
+    assert records[0]["http"]["p50_ms"] is not None and records[0]["wall_s"] >= 0
+
+    run = metrics.finalize_run(
+        {"run_id": "r1", "start": "2024-05-01T10:00:00+00:00", "end": "2024-05-01T10:02:00+00:00", "status": "failed"},
+        str(tmp_path),
+    )
+    assert run["duration_s"] == 120
+    assert [(s["stage"], s["runs"], s["status"]) for s in run["stages"]] == [
+        ("db_updater", 2, "failed"),
+        ("csv_generator", 1, "ok"),
+    ]
+    assert run["stages"][0]["items"] == {"records_created": 3}
+    assert run["totals"]["http_requests"] == 2 and run["totals"]["http_errors"] == 1
+    json.dumps(run)
+
+    text = (tmp_path / "textfile" / "pipeline.prom").read_text()
+    assert 'qfieldcloud_pipeline_last_run_success{status="failed",reason=""} 0' in text
+    assert 'qfieldcloud_pipeline_stage_items{stage="db_updater",project="pA",item="records_created"} 3' in text
+    assert (
+        'qfieldcloud_pipeline_stage_http_request_duration_seconds_bucket{stage="db_updater",project="pA",le="+Inf"} 2'
+        in text
+    )
+    assert 'qfieldcloud_pipeline_stage_success{stage="csv_generator",project=""} 1' in text
@@ -0,0 +1,68 @@
+import json
+import os
+import shutil
+import threading
+
+from PIL import Image
+
+from qfieldcloud_fetcher import picture_stream
+
+
+class FakePublisher:
+    """Publishes like PicturePublisher, without ExifTool or Directus; "obs_2" has no CSV row yet."""
+
+    def __init__(self, nextcloud):
+        self.nextcloud = nextcloud
+        self.published = []
+        self.lock = threading.Lock()
+
+    def publish(self, picture_path, project, layer, original=None):
+        if "obs_2" in picture_path:
+            return "skipped"
+        dest = os.path.join(self.nextcloud, "pictures", project, layer)
+        os.makedirs(dest, exist_ok=True)
+        shutil.move(picture_path, dest)
+        with self.lock:
+            self.published.append((project, layer, os.path.basename(picture_path), original))
+        return "published"
+
+
+def make_jpg(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new("RGB", (8, 8), "green").save(path, format="JPEG")
+
+
+def test_pictures_flow_through_every_step_and_keep_the_records(tmp_path):
+    data, nextcloud = tmp_path / "data", tmp_path / "nextcloud"
+    for name in ("obs 1.jpg", "obs_2.JPG", "obs-3.jpeg"):
+        make_jpg(data / "in" / "pictures" / "pA" / "observations" / name)
+    make_jpg(data / "in" / "pictures" / "pB" / "observations" / "obs_4.jpg")
+    # Left over by an earlier run of pictures_resizer
+    make_jpg(data / "renamed_compressed_pictures" / "pA" / "observations" / "obs_0.jpg")
+    publisher = FakePublisher(str(nextcloud))
+
+    stats = picture_stream.run_stream(str(data), str(nextcloud), publisher, "pA", workers=2, max_in_flight=1)
+
+    assert dict(stats.counts) == {"renamed": 3, "compressed": 3, "published": 3, "skipped": 1}
+    assert sorted(publisher.published) == [
+        ("pA", "observations", "obs3.jpeg", "obs-3.jpeg"),
+        ("pA", "observations", "obs_0.jpg", None),
+        ("pA", "observations", "obs_1.jpg", "obs 1.jpg"),
+    ]
+    # Raw copies for the finalizer, and the same records as the separate stages
+    assert sorted(os.listdir(nextcloud / "pictures_raw" / "pA" / "observations")) == [
+        "obs 1.jpg",
+        "obs-3.jpeg",
+        "obs_2.JPG",
+    ]
+    mapping = json.loads((data / "picture_map.json").read_text())
+    assert mapping["pA/observations/obs 1.jpg"]["renamed"] == "obs_1.jpg"
+    assert sorted(json.loads((data / "pictures_stage_log.json").read_text())) == [
+        "pA/observations/obs 1.jpg",
+        "pA/observations/obs-3.jpeg",
+        "pA/observations/obs_2.JPG",
+    ]
+    # Not publishable yet: kept where pictures_metadata_editor would look for it
+    assert os.listdir(data / "renamed_compressed_pictures" / "pA" / "observations") == ["obs_2.jpg"]
+    assert os.listdir(data / "in" / "pictures" / "pA" / "observations") == []
+    assert os.listdir(data / "in" / "pictures" / "pB" / "observations") == ["obs_4.jpg"]
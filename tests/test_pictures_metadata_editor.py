@@ -1,7 +1,13 @@
+import json
 import subprocess
 from datetime import datetime
 
-from qfieldcloud_fetcher.pictures_metadata_editor import build_exiftool_command, is_thumbnail_ifd1_error
+from qfieldcloud_fetcher.change_capture import ChangeSet
+from qfieldcloud_fetcher.pictures_metadata_editor import (
+    PicturePublisher,
+    build_exiftool_command,
+    is_thumbnail_ifd1_error,
+)
 
 
 def test_is_thumbnail_ifd1_error_detects_exiftool_stderr():
@@ -32,3 +38,29 @@ def test_build_exiftool_command_can_drop_ifd1_thumbnail():
     assert command[1] == "-IFD1:ThumbnailImage="
     assert "-Subject=emi_collector:Jane Doe" in command
     assert "/tmp/image.jpg" in command
+
+
+def test_changes_only_defers_only_pictures_already_on_nextcloud(tmp_path):
+    picture = tmp_path / "renamed_compressed_pictures" / "pA" / "obs" / "dbgi_000001_1.jpg"
+    picture.parent.mkdir(parents=True)
+    picture.write_bytes(b"jpg")
+    publisher = PicturePublisher(
+        str(tmp_path),
+        str(tmp_path / "nextcloud"),
+        r"dbgi_\d{6}",
+        changes_only=True,
+        change_sets={"pA": ChangeSet("pA")},
+    )
+
+    # Its sample row did not change, but the picture never reached NextCloud: it is not deferred
+    # (and skipped here only because the test has no formatted CSV)
+    assert publisher.publish(str(picture), "pA", "obs") == "skipped"
+
+    published = tmp_path / "nextcloud" / "pictures" / "pA" / "obs" / picture.name
+    published.parent.mkdir(parents=True)
+    published.write_bytes(b"jpg")
+    key = f"pA/obs/{picture.name}"
+    (tmp_path / "processed_ok.json").write_text(json.dumps({key: {"final_path": str(published)}}))
+    publisher.processed_ok = None
+
+    assert publisher.publish(str(picture), "pA", "obs") == "deferred"
@@ -0,0 +1,155 @@
+import importlib
+import json
+import multiprocessing
+import time
+
+import pytest
+
+from qfieldcloud_fetcher import change_capture, fetcher, pipeline
+
+
+def test_downstream_stages_follow_the_launcher_environment(monkeypatch):
+    monkeypatch.setenv("PIPELINE_PROJECT", "jbb")
+    monkeypatch.setenv("PIPELINE_CHANGES_ONLY", "yes")
+    monkeypatch.setenv("FORCE_CSV_STAGES", "0")
+    monkeypatch.setenv("ENABLE_REMOTE_DELETE", "1")
+    monkeypatch.delenv("FORCE_REMOTE_DELETE", raising=False)
+    monkeypatch.delenv("ALLOW_EXISTING_SAMPLE_ID_OVERWRITE", raising=False)
+
+    stages = pipeline.downstream_stages()
+
+    assert [stage for stage, _argv in stages][:3] == ["change_capture", "stage_to_nextcloud_raw", "csv_generator"]
+    assert dict(stages[1:-1])["db_updater"] == ["--project", "jbb", "--changes-only"]
+    assert dict(stages[1:-1])["pictures_finalizer"] == ["--project", "jbb", "--enable-remote-delete"]
+    assert stages[-1] == ("change_capture", ["--project", "jbb", "--commit"])
+
+
+def test_picture_stream_replaces_the_picture_stages(monkeypatch):
+    monkeypatch.setenv("PICTURE_STREAM", "1")
+    monkeypatch.delenv("PIPELINE_PROJECT", raising=False)
+    monkeypatch.setenv("PIPELINE_CHANGES_ONLY", "1")
+
+    stages = [stage for stage, _argv in pipeline.downstream_stages()]
+
+    assert not set(pipeline.PICTURE_CHAIN) & set(stages)
+    assert stages[-3:] == ["picture_stream", "pictures_finalizer", "change_capture"]
+    assert pipeline.picture_chain() == ("picture_stream",)
+    assert pipeline.stage_options()["picture_stream"] == ["--changes-only"]
+
+
+def test_run_stage_tees_output_and_reports_failures(tmp_path, monkeypatch, capsys):
+    calls = []
+
+    def main(argv):
+        calls.append(argv)
+        print("captured 2 projects")
+        if "--commit" in argv:
+            raise SystemExit("nothing to commit")
+
+    monkeypatch.setattr(change_capture, "main", main)
+
+    pipeline.run_stage("change_capture", ["--project", "p1"], str(tmp_path))
+    with pytest.raises(pipeline.StageFailed) as failure:
+        pipeline.run_stage("change_capture", ["--commit"], str(tmp_path))
+
+    assert failure.value.stage == "change_capture"
+    assert calls == [["--project", "p1"], ["--commit"]]
+    log = (tmp_path / "change_capture.log").read_text()
+    assert log.count("captured 2 projects") == 2 and "nothing to commit" in log
+    out = capsys.readouterr().out
+    assert "running change_capture.py --project p1" in out and "!!! change_capture failed" in out
+
+
+# The patched stage mains only reach the workers when they are forked
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="needs fork workers")
+def test_parallel_chains_wait_for_every_csv_chain_before_directus(tmp_path, monkeypatch):
+    for project in ("pA", "pB", "pC"):
+        (tmp_path / "data" / "in" / "gpkg" / project).mkdir(parents=True)
+    monkeypatch.setattr(pipeline, "data_path", str(tmp_path / "data"))
+    monkeypatch.delenv("PIPELINE_PROJECT", raising=False)
+    calls = tmp_path / "calls.txt"
+
+    def fake_main(stage):
+        def main(argv):
+            project = argv[argv.index("--project") + 1] if "--project" in argv else "*"
+            with open(calls, "a") as f:
+                f.write(f"{stage} {project}\n")
+            if stage == "csv_formatter" and project == "pC":
+                raise SystemExit(1)
+
+        return main
+
+    for stage in pipeline.CSV_CHAIN + pipeline.PICTURE_CHAIN + pipeline.DIRECTUS_STAGES:
+        monkeypatch.setattr(importlib.import_module(f"qfieldcloud_fetcher.{stage}"), "main", fake_main(stage))
+    logs = tmp_path / "logs"
+    logs.mkdir()
+
+    # pC fails: no Directus import, and pC gets no picture chain
+    assert pipeline.run_parallel("r1", str(logs), 2) == "project_failed:pC:script_failed:csv_formatter"
+    lines = calls.read_text().splitlines()
+    assert not any(line.startswith(("fields_creator", "db_updater")) for line in lines)
+    assert {line for line in lines if line.startswith("pictures_metadata_editor")} == {
+        "pictures_metadata_editor pA",
+        "pictures_metadata_editor pB",
+    }
+    records = [json.loads(line) for line in (logs / "runs.jsonl").read_text().splitlines()]
+    assert sorted((r["project"], r["chain"], r["status"]) for r in records) == [
+        ("pA", "csv", "ok"),
+        ("pA", "pictures", "ok"),
+        ("pB", "csv", "ok"),
+        ("pB", "pictures", "ok"),
+        ("pC", "csv", "failed"),
+    ]
+    assert "csv_formatter" in (logs / "projects" / "pC" / "pipeline_r1.log").read_text()
+
+    (tmp_path / "data" / "in" / "gpkg" / "pC").rmdir()
+    calls.unlink()
+    assert pipeline.run_parallel("r2", str(logs), 2) is None
+    lines = calls.read_text().splitlines()
+    # Picture chains may still be running meanwhile, so only the order matters
+    directus = [lines.index(f"{stage} *") for stage in pipeline.DIRECTUS_STAGES]
+    assert directus == sorted(directus)
+    assert max(lines.index(f"csv_formatter {p}") for p in ("pA", "pB")) < directus[0]
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="needs fork workers")
+def test_overlap_starts_a_project_while_the_fetcher_is_still_running(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "data_path", str(tmp_path / "data"))
+    monkeypatch.delenv("PIPELINE_PROJECT", raising=False)
+    calls = tmp_path / "calls.txt"
+    calls.touch()
+
+    def fake_main(stage):
+        def main(argv):
+            project = argv[argv.index("--project") + 1] if "--project" in argv else "*"
+            with open(calls, "a") as f:
+                f.write(f"{stage} {project}\n")
+
+        return main
+
+    def fake_fetcher(argv):
+        events = argv[argv.index("--events-dir") + 1]
+        fetcher.clear_events(events)
+        fetcher.publish_fetched(events, "pA", "id-a", 3)
+        # pB is only "downloaded" once pA went through its CSV chain
+        deadline = time.monotonic() + 30
+        while "csv_formatter pA" not in calls.read_text():
+            if time.monotonic() > deadline:
+                raise SystemExit("pA was not processed while fetching")
+            time.sleep(0.05)
+        fetcher.publish_fetched(events, "pB", "id-b", 1)
+        with open(calls, "a") as f:
+            f.write("fetcher done\n")
+
+    for stage in pipeline.CSV_CHAIN + pipeline.PICTURE_CHAIN + pipeline.DIRECTUS_STAGES:
+        monkeypatch.setattr(importlib.import_module(f"qfieldcloud_fetcher.{stage}"), "main", fake_main(stage))
+    monkeypatch.setattr(fetcher, "main", fake_fetcher)
+    logs = tmp_path / "logs"
+    logs.mkdir()
+
+    assert pipeline.run_parallel("r1", str(logs), 2, ["--events-dir", pipeline.events_dir()]) is None
+    lines = calls.read_text().splitlines()
+    assert lines.index("csv_formatter pA") < lines.index("fetcher done") < lines.index("fields_creator *")
+    assert "pictures_metadata_editor pB" in lines
+    assert "csv_formatter pB" in lines[: lines.index("fields_creator *")]
+    assert sorted(p.name for p in (tmp_path / "data" / "fetched").iterdir()) == ["pA.json", "pB.json"]
@@ -0,0 +1,28 @@
+from qfieldcloud_fetcher import profiling
+
+
+def busy_stage():
+    return [bytearray(1024) for _ in range(200)]
+
+
+def test_only_the_selected_stages_are_profiled(tmp_path, monkeypatch):
+    monkeypatch.setenv("RUN_ID", "r1")
+    monkeypatch.setenv("PIPELINE_PROFILE", "db_updater, pictures_resizer")
+    assert profiling.selected("pictures_resizer") and not profiling.selected("fetcher")
+    assert profiling.selected("fetcher", "all")
+
+    with profiling.profile("fetcher", [], str(tmp_path)) as profiler:
+        assert profiler is None
+    with profiling.profile("db_updater", ["--project", "My project"], str(tmp_path)) as profiler:
+        assert profiler is not None
+        kept = busy_stage()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "profile_r1_db_updater_My_project.pstats",
+        "profile_r1_db_updater_My_project.txt",
+    ]
+    report = (tmp_path / "profile_r1_db_updater_My_project.txt").read_text()
+    assert "db_updater.py --project My project" in report
+    assert "busy_stage" in report
+    assert "test_profiling.py" in report.split("allocations still held")[1]
+    assert len(kept) == 200
@@ -0,0 +1,63 @@
+import json
+
+from qfieldcloud_fetcher import run_report
+
+
+def write_history(logs, resizer_seconds, pictures=None):
+    runs, stages = [], []
+    pictures = pictures or [100] * len(resizer_seconds)
+    for i, (seconds, n) in enumerate(zip(resizer_seconds, pictures)):
+        run_id = f"2024050{i + 1}-0300"
+        runs.append({
+            "run_id": run_id,
+            "start": "2024-05-01T03:00:00+00:00",
+            "end": "2024-05-01T03:10:00+00:00",
+            "status": "ok",
+        })
+        # 100 pictures and 50 MB every night unless told otherwise
+        stages.append({
+            "run_id": run_id,
+            "stage": "pictures_resizer",
+            "project": "pA",
+            "status": "ok",
+            "wall_s": seconds,
+            "read_bytes": 300_000 * n,
+            "write_bytes": 200_000 * n,
+            "items": {"pictures": n},
+        })
+    # Chain lines of --workers runs are not runs
+    runs.insert(2, {"run_id": "20240502-0300", "chain": "csv", "project": "pA", "status": "ok"})
+    runs.insert(2, {"run_id": "20240502-1300", "status": "failed", "reason": "script_failed:fetcher"})
+    (logs / "runs.jsonl").write_text("".join(json.dumps(r) + "\n" for r in runs))
+    (logs / "stage_metrics.jsonl").write_text("".join(json.dumps(r) + "\n" for r in stages))
+
+
+def test_a_slower_run_is_flagged_against_the_rolling_baseline(tmp_path, capsys):
+    write_history(tmp_path, [10, 11, 9, 10, 10, 20])
+    html_path = tmp_path / "report" / "index.html"
+
+    status = run_report.main(["--logs-path", str(tmp_path), "--html", str(html_path), "--fail-on-regression"])
+
+    assert status == 1
+    out = capsys.readouterr().out
+    assert "Pipeline runs: 7 (failed=1, ok=6)" in out
+    assert "20240506-0300  pictures_resizer [pA]  pictures/s: 5 vs 10 (-50%)" in out
+    assert "20240506-0300  pictures_resizer [pA]  wall_s: 20 vs 10 (+100%)" in out
+    # The run itself took as long as usual
+    assert "[all]  duration_s" not in out
+    assert "MB/s" in out and 'tr class="regressed"' in html_path.read_text()
+
+
+def test_no_regression_within_the_threshold(tmp_path, capsys):
+    write_history(tmp_path, [10, 11, 9, 10, 10, 12])
+    assert run_report.main(["--logs-path", str(tmp_path), "--fail-on-regression", "--threshold", "0.3"]) == 0
+    assert "by more than 30%): none" in capsys.readouterr().out
+
+
+def test_a_longer_run_with_more_work_is_not_flagged(tmp_path, capsys):
+    write_history(tmp_path, [10, 11, 9, 10, 10, 20], pictures=[100, 100, 100, 100, 100, 200])
+    assert run_report.main(["--logs-path", str(tmp_path), "--fail-on-regression"]) == 0
+    out = capsys.readouterr().out
+    assert "by more than 25%): none" in out
+    # Twice the pictures in twice the time: the throughput did not change
+    assert "pictures/s  10    10        +0%" in out
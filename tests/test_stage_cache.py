@@ -0,0 +1,33 @@
+import os
+
+from qfieldcloud_fetcher.stage_cache import StageCache
+
+
+def test_stage_cache_skips_projects_with_unchanged_gpkgs(tmp_path):
+    for project in ("p1", "p2"):
+        (tmp_path / "in" / "gpkg" / project).mkdir(parents=True)
+        (tmp_path / "in" / "gpkg" / project / "observations.gpkg").write_bytes(project.encode())
+    output = tmp_path / "raw_csv" / "p1" / "observations_EPSG:2056.csv"
+    output.parent.mkdir(parents=True)
+    output.write_text("sample_id\n")
+
+    cache = StageCache("csv_generator", str(tmp_path), {"format": "csv"})
+    assert not cache.is_fresh("p1")
+    cache.record("p1", [str(output)])
+    cache.record("p2")
+    cache.save()
+
+    # A re-download with the same bytes keeps the fingerprint
+    os.utime(tmp_path / "in" / "gpkg" / "p1" / "observations.gpkg", ns=(0, 0))
+    (tmp_path / "in" / "gpkg" / "p2" / "observations.gpkg").write_bytes(b"changed")
+    cache = StageCache("csv_generator", str(tmp_path), {"format": "csv"})
+    assert cache.is_fresh("p1")
+    assert not cache.is_fresh("p2")
+    assert cache.skipped == ["p1"]
+
+    # Other stages, other options and missing outputs do not count as fresh
+    assert not StageCache("csv_formatter", str(tmp_path), {"format": "csv"}).is_fresh("p1")
+    assert not StageCache("csv_generator", str(tmp_path), {"format": "parquet"}).is_fresh("p1")
+    assert not StageCache("csv_generator", str(tmp_path), {"format": "csv"}, enabled=False).is_fresh("p1")
+    output.unlink()
+    assert not StageCache("csv_generator", str(tmp_path), {"format": "csv"}).is_fresh("p1")
@@ -0,0 +1,56 @@
+import pytest
+
+from qfieldcloud_fetcher import table_io
+
+
+def test_parquet_rows_match_csv_rows(tmp_path):
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+
+    df = pd.DataFrame({
+        "sample_id": ["a,1", None],
+        "collector_orcid": ["0000-0002-1825-0097", None],
+        "count": [1.0, None],
+        "is_wild": [1, 0],
+        "flag": [True, False],
+        "latitude": [46.95108277192548, 1e-05],
+    })
+    csv_path = table_io.write_table(df, str(tmp_path), "obs_EPSG:4326", "csv")
+    parquet_path = table_io.write_table(df, str(tmp_path), "obs_EPSG:4326", "parquet")
+
+    assert list(table_io.read_rows(parquet_path)) == list(table_io.read_rows(csv_path))
+    assert [filename for _, filename, _ in table_io.iter_tables(str(tmp_path))] == [
+        "obs_EPSG:4326.csv",
+        "obs_EPSG:4326.parquet",
+    ]
+    assert len(table_io.read_table(parquet_path, nrows=1)) == 1
+
+
+def test_flags_from_text_columns_parse_like_csv():
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyproj")
+    pytest.importorskip("geopandas")
+    from qfieldcloud_fetcher.csv_formatter import to_flag
+
+    text = pd.Series(["True", "False", None, "0", "1", "yes", ""], dtype=object)
+    assert to_flag(text).tolist() == [1, 0, 0, 0, 1, 1, 0]
+    assert to_flag(pd.Series([1.0, None, 0.0])).tolist() == [1, 0, 0]
+
+
+def test_field_data_schema_pins_types_and_caches_reads(tmp_path):
+    pytest.importorskip("pandas")
+    path = tmp_path / "obs_EPSG:4326.csv"
+    path.write_text("sample_id,collector_orcid,is_wild,date\n000123,0000,1,20240501100000.0\n,,,\n")
+
+    df = table_io.read_table(str(path), schema="field_data")
+    assert df["sample_id"].tolist()[0] == "000123"
+    assert df["collector_orcid"].tolist()[0] == "0000"
+    assert str(df["is_wild"].dtype) == "Int64"
+    assert df["date"].tolist()[0] == 20240501100000
+
+    # Cached frames are handed out as copies, so column assignments do not leak
+    df["is_wild"] = 0
+    assert table_io.read_table(str(path), schema="field_data")["is_wild"].tolist()[0] == 1
+
+    path.write_text("sample_id\nabc\n")
+    assert table_io.read_table(str(path), schema="field_data")["sample_id"].tolist() == ["abc"]
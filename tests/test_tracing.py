@@ -0,0 +1,72 @@
+import json
+import threading
+
+import requests
+
+from qfieldcloud_fetcher import metrics, tracing
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 503
+        response.headers["Content-Length"] = "12"
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+@tracing.traced("compress picture", result="file.destination")
+def compress(path):
+    tracing.current().set_attribute("file.size", 42)
+    return path + ".small"
+
+
+def test_the_spans_of_a_run_form_one_tree_under_its_root(tmp_path, monkeypatch):
+    monkeypatch.setenv("PIPELINE_TRACING", "1")
+    monkeypatch.setenv("LOGS_PATH", str(tmp_path))
+    monkeypatch.setenv("RUN_ID", "r1")
+    session = requests.Session()
+    session.mount("http://", FakeAdapter())
+
+    with metrics.measure("pictures_resizer", ["--project", "pA"]):
+        session.get("http://directus/items?access_token=secret")
+        # Threads of the stage have no span of their own to start from
+        worker = threading.Thread(target=compress, args=("a.jpg",))
+        worker.start()
+        worker.join()
+    metrics.finalize_run(
+        {"run_id": "r1", "start": "2024-05-01T03:00:00+00:00", "end": "2024-05-01T03:10:00+00:00"}, str(tmp_path)
+    )
+
+    exports = [json.loads(line) for line in (tmp_path / "traces" / "r1.jsonl").read_text().splitlines()]
+    spans = {
+        span["name"]: span
+        for request in exports
+        for resource in request["resourceSpans"]
+        for scope in resource["scopeSpans"]
+        for span in scope["spans"]
+    }
+    assert set(spans) == {"pipeline run", "stage pictures_resizer", "HTTP GET", "compress picture"}
+    assert len({span["traceId"] for span in spans.values()}) == 1
+    root, stage = spans["pipeline run"], spans["stage pictures_resizer"]
+    assert "parentSpanId" not in root and root["startTimeUnixNano"] == "1714532400000000000"
+    assert stage["parentSpanId"] == root["spanId"]
+    assert spans["HTTP GET"]["parentSpanId"] == spans["compress picture"]["parentSpanId"] == stage["spanId"]
+
+    http = {a["key"]: a["value"] for a in spans["HTTP GET"]["attributes"]}
+    assert http["url.full"] == {"stringValue": "http://directus/items"}
+    assert http["http.response.status_code"] == {"intValue": "503"}
+    assert spans["HTTP GET"]["status"] == {"code": tracing.STATUS_ERROR, "message": "HTTP 503"}
+    compressed = {a["key"]: a["value"] for a in spans["compress picture"]["attributes"]}
+    assert compressed == {"file.size": {"intValue": "42"}, "file.destination": {"stringValue": "a.jpg.small"}}
+
+
+def test_nothing_is_recorded_when_tracing_is_off(tmp_path, monkeypatch):
+    monkeypatch.delenv("PIPELINE_TRACING", raising=False)
+    monkeypatch.setenv("LOGS_PATH", str(tmp_path))
+    assert compress("b.jpg") == "b.jpg.small"
+    tracing.flush()
+    assert not (tmp_path / "traces").exists()